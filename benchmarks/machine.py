@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Times `TeleStateMachine.process_update` end to end, for every bundled database driver,
+with synthetic updates of many users. Nothing goes over the network, the bot is faked.
+
+Every combination of driver, amount of registered states, amount of users,
+distribution of the users (uniform, or zipf where a few users send most updates)
+and size of the state data is run, and printed as one json object per line,
+with the throughput and the latency percentiles in microseconds.
+
+    $ python benchmarks/machine.py
+    $ python benchmarks/machine.py --drivers simple sqlite --states 1 50 --users 100 10000 --payloads 0 10000
+    $ python benchmarks/machine.py --output before.jsonl
+    $ pip install -U telestate teleflask
+    $ python benchmarks/machine.py --baseline before.jsonl --tolerance 1.2
+
+Drivers whose library is not installed (`pony`, `mongomock`) are skipped.
+"""
+import argparse
+import bisect
+import itertools
+import json
+import platform
+import random
+import sys
+import tempfile
+import time
+from os import path
+from typing import Callable, Dict, List, Tuple
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))  # run from a checkout without installing.
+
+from luckydonaldUtils.logger import logging
+from pytgbot.api_types.receivable.peer import Chat, User
+from pytgbot.api_types.receivable.updates import Update, Message
+from teleflask import Teleflask
+
+from telestate import TeleStateMachine, TeleState, TeleStateDatabaseDriver
+from telestate.replay import OfflineBot
+
+__author__ = 'luckydonald'
+
+DRIVERS = ('simple', 'sqlite', 'pony', 'mongo')
+DISTRIBUTIONS = ('uniform', 'zipf')
+KEYS = ('driver', 'states', 'users', 'distribution', 'payload')  # what identifies a run, e.g. to compare with a baseline.
+
+
+def create_simple() -> Tuple[TeleStateDatabaseDriver, Callable[[], None]]:
+    from telestate.contrib.simple import SimpleDictDriver
+    return SimpleDictDriver(), lambda: None
+# end def
+
+
+def create_sqlite() -> Tuple[TeleStateDatabaseDriver, Callable[[], None]]:
+    from telestate.contrib.sqlite import SqliteDriver
+    folder = tempfile.TemporaryDirectory()
+    driver = SqliteDriver(path.join(folder.name, 'benchmark.sqlite'))
+
+    def cleanup():
+        driver.close()
+        folder.cleanup()
+    # end def
+    return driver, cleanup
+# end def
+
+
+def create_pony() -> Tuple[TeleStateDatabaseDriver, Callable[[], None]]:
+    from pony import orm
+    from telestate.contrib.pony_orm import PonyDriver
+    db = orm.Database()
+    driver = PonyDriver(db)
+    db.bind(provider='sqlite', filename=':memory:')
+    db.generate_mapping(create_tables=True)
+    return driver, db.disconnect
+# end def
+
+
+def create_mongo() -> Tuple[TeleStateDatabaseDriver, Callable[[], None]]:
+    import mongomock
+    from telestate.contrib.mongo import MongoDriver
+    client = mongomock.MongoClient()
+    return MongoDriver(client.db.states), client.close
+# end def
+
+
+DRIVER_FACTORIES = {
+    'simple': create_simple,
+    'sqlite': create_sqlite,
+    'pony': create_pony,
+    'mongo': create_mongo,
+}
+
+
+def create_machine(driver: TeleStateDatabaseDriver, states: int, payload: int) -> TeleStateMachine:
+    """
+    Builds a machine with `states` states (including `DEFAULT`).
+    Every message moves the user to the next state, storing `payload` characters of data.
+    """
+    bot = Teleflask(
+        api_key=None, app=None, hostname="localhost", debug_routes=False,
+        disable_setting_webhook_telegram=True, disable_setting_webhook_route=True,
+    )
+    bot._bot = OfflineBot()
+    machine = TeleStateMachine('benchmark', driver, bot)
+    names = ['DEFAULT'] + [f'STATE_{i}' for i in range(1, states)]
+    for name in names[1:]:
+        setattr(machine, name, TeleState(name))
+    # end for
+    blob = 'x' * payload
+    for name, next_name in zip(names, names[1:] + names[:1]):
+        def move(update, next_name=next_name):
+            data = machine.CURRENT.data
+            step = data['step'] + 1 if isinstance(data, dict) else 0
+            machine.set(next_name, data={'step': step, 'blob': blob} if payload else {'step': step})
+        # end def
+        machine.states[name].on_update('message')(move)
+    # end for
+    bot.init_bot()
+    return machine
+# end def
+
+
+def create_update(update_id: int, user_id: int) -> Update:
+    """
+    A text message in the private chat of that user, like `test_data.update1`.
+    """
+    return Update(
+        update_id=update_id,
+        message=Message(
+            message_id=update_id,
+            date=0,
+            chat=Chat(id=user_id, type='private'),
+            from_peer=User(id=user_id, is_bot=False, first_name="user", last_name="test"),
+            text="hello",
+        ),
+    )
+# end def
+
+
+def pick_users(distribution: str, users: int, amount: int, zipf_exponent: float, rand: random.Random) -> List[int]:
+    """
+    :return: `amount` user ids between 1 and `users`.
+    """
+    if distribution == 'uniform':
+        return [rand.randint(1, users) for _ in range(amount)]
+    # end if
+    assert distribution == 'zipf'
+    cumulative = list(itertools.accumulate(1 / rank ** zipf_exponent for rank in range(1, users + 1)))
+    return [bisect.bisect_left(cumulative, rand.random() * cumulative[-1]) + 1 for _ in range(amount)]
+# end def
+
+
+def percentile(latencies: List[float], percent: float) -> float:
+    """
+    :param latencies: sorted.
+    """
+    return latencies[min(int(len(latencies) * percent / 100), len(latencies) - 1)]
+# end def
+
+
+def measure(machine: TeleStateMachine, updates: List[Update], warmup: int) -> Dict[str, float]:
+    """
+    Processes the updates one after another.
+
+    :return: dict with the throughput, and mean, p50, p90, p99 and max latency in microseconds.
+    """
+    for update in updates[:warmup]:
+        machine.process_update(update)
+    # end for
+    updates = updates[warmup:]
+    latencies = []
+    started = time.perf_counter()
+    for update in updates:
+        start = time.perf_counter()
+        machine.process_update(update)
+        latencies.append(time.perf_counter() - start)
+    # end for
+    seconds = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'updates': len(updates),
+        'seconds': seconds,
+        'updates_per_second': len(updates) / seconds,
+        'mean_us': sum(latencies) / len(latencies) * 1e6,
+        'p50_us': percentile(latencies, 50) * 1e6,
+        'p90_us': percentile(latencies, 90) * 1e6,
+        'p99_us': percentile(latencies, 99) * 1e6,
+        'max_us': latencies[-1] * 1e6,
+    }
+# end def
+
+
+def versions() -> Dict[str, str]:
+    """
+    :return: the versions of python and the libraries involved, to tell apart runs before and after an upgrade.
+    """
+    from importlib import metadata
+    result = {'python': platform.python_version()}
+    for package in ('telestate', 'teleflask', 'pytgbot', 'pony', 'pymongo', 'mongomock'):
+        try:
+            result[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            pass
+        # end try
+    # end for
+    return result
+# end def
+
+
+def compare(results: List[dict], baseline_file: str, tolerance: float) -> List[str]:
+    """
+    :return: a message for every run whose p50 latency or throughput got worse than `tolerance` times the baseline.
+    """
+    with open(baseline_file, encoding='utf-8') as f:
+        baseline = {tuple(run[key] for key in KEYS): run for run in map(json.loads, filter(str.strip, f))}
+    # end with
+    problems = []
+    for run in results:
+        before = baseline.get(tuple(run[key] for key in KEYS))
+        if before is None:
+            continue
+        # end if
+        if run['p50_us'] > before['p50_us'] * tolerance or run['updates_per_second'] * tolerance < before['updates_per_second']:
+            problems.append(
+                f"{dict((key, run[key]) for key in KEYS)}: p50 {before['p50_us']:.0f}µs -> {run['p50_us']:.0f}µs, "
+                f"{before['updates_per_second']:.0f} -> {run['updates_per_second']:.0f} updates/s"
+            )
+        # end if
+    # end for
+    return problems
+# end def
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--drivers', nargs='+', choices=DRIVERS, default=list(DRIVERS), help='database drivers to run')
+    parser.add_argument('--states', type=int, nargs='+', default=[1, 10, 100], help='numbers of registered states')
+    parser.add_argument('--users', type=int, nargs='+', default=[100, 10000], help='numbers of users sending updates')
+    parser.add_argument('--distributions', nargs='+', choices=DISTRIBUTIONS, default=list(DISTRIBUTIONS), help='how the updates are spread over the users')
+    parser.add_argument('--zipf-exponent', type=float, default=1.1, help='higher means fewer users send more of the updates')
+    parser.add_argument('--payloads', type=int, nargs='+', default=[0, 1000, 100000], help='characters of state data')
+    parser.add_argument('--updates', type=int, default=2000, help='measured updates per run')
+    parser.add_argument('--warmup', type=int, default=200, help='updates processed before measuring')
+    parser.add_argument('--seed', type=int, default=4458)
+    parser.add_argument('--output', help='file to write the json lines to, in addition to stdout')
+    parser.add_argument('--baseline', help='json lines of an earlier run, exit with an error if a run got slower than --tolerance')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='allowed factor compared to the baseline')
+    parser.add_argument('--verbose', action='store_true', help="don't silence the logging of telestate and teleflask")
+    args = parser.parse_args(argv)
+    assert all(states >= 1 for states in args.states), 'need at least the DEFAULT state'
+
+    if not args.verbose:
+        logging.getLogger('telestate').setLevel(logging.ERROR)
+        logging.getLogger('teleflask').setLevel(logging.ERROR)
+    # end if
+    environment = versions()
+    results = []
+    output = open(args.output, 'w', encoding='utf-8') if args.output else None
+    try:
+        for driver_name in args.drivers:
+            try:
+                DRIVER_FACTORIES[driver_name]()[1]()
+            except ImportError as e:
+                print(f'Skipping driver {driver_name}: {e}', file=sys.stderr)
+                continue
+            # end try
+            for states, users, distribution, payload in itertools.product(args.states, args.users, args.distributions, args.payloads):
+                rand = random.Random(args.seed)
+                user_ids = pick_users(distribution, users, args.warmup + args.updates, args.zipf_exponent, rand)
+                updates = [create_update(update_id, user_id) for update_id, user_id in enumerate(user_ids)]
+                driver, cleanup = DRIVER_FACTORIES[driver_name]()
+                try:
+                    machine = create_machine(driver, states, payload)
+                    result = {
+                        'driver': driver_name, 'states': states, 'users': users,
+                        'distribution': distribution, 'payload': payload,
+                    }
+                    result.update(measure(machine, updates, args.warmup))
+                    result['saves_performed'] = machine.saves_performed
+                    result['versions'] = environment
+                finally:
+                    cleanup()
+                # end try
+                results.append(result)
+                line = json.dumps(result)
+                print(line, flush=True)
+                if output:
+                    output.write(line + '\n')
+                # end if
+            # end for
+        # end for
+    finally:
+        if output:
+            output.close()
+        # end if
+    # end try
+    if args.baseline:
+        problems = compare(results, args.baseline, args.tolerance)
+        for problem in problems:
+            print(f'Slower than the baseline: {problem}', file=sys.stderr)
+        # end for
+        if problems:
+            return 1
+        # end if
+    # end if
+    return 0
+# end def
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+# end if
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Shows that loading and saving with the `SimpleDictDriver` takes the same time,
+no matter if it stores a thousand or a million users.
+
+    $ python benchmarks/simple_driver.py
+    $ python benchmarks/simple_driver.py --sizes 1000 1000000 --check
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))  # run from a checkout without installing.
+
+from telestate.contrib.simple import SimpleDictDriver
+
+__author__ = 'luckydonald'
+
+
+def fill(driver: SimpleDictDriver, users: int):
+    """
+    Stores `users` states, spread over private chats and a few groups.
+    """
+    for user_id in range(users):
+        chat_id = user_id if user_id % 10 else -(user_id % 1000)  # every 10th is in a group
+        driver.save_state_for_chat_user(chat_id, user_id, 'SOME_STATE', {'step': user_id % 7, 'name': 'user'})
+    # end for
+# end def
+
+
+def measure(driver: SimpleDictDriver, users: int, operations: int) -> dict:
+    """
+    Times `operations` load + save cycles of random users.
+
+    :return: dict with `users`, `operations`, mean and p99 latency in microseconds.
+    """
+    rand = random.Random(4458)
+    latencies = []
+    for _ in range(operations):
+        user_id = rand.randrange(users)
+        chat_id = user_id if user_id % 10 else -(user_id % 1000)
+        start = time.perf_counter()
+        state_name, state_data = driver.load_state_for_chat_user(chat_id, user_id)
+        driver.save_state_for_chat_user(chat_id, user_id, state_name, state_data)
+        latencies.append(time.perf_counter() - start)
+    # end for
+    latencies.sort()
+    return {
+        'users': users,
+        'operations': operations,
+        'mean_us': sum(latencies) / len(latencies) * 1e6,
+        'p99_us': latencies[int(len(latencies) * 0.99)] * 1e6,
+    }
+# end def
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000], help='numbers of stored users')
+    parser.add_argument('--operations', type=int, default=20000, help='load + save cycles per size')
+    parser.add_argument('--check', action='store_true', help='exit with an error if the mean latency grows by more than --tolerance')
+    parser.add_argument('--tolerance', type=float, default=3.0, help='allowed factor between the smallest and biggest size')
+    args = parser.parse_args(argv)
+
+    results = []
+    for users in args.sizes:
+        driver = SimpleDictDriver()
+        fill(driver, users)
+        results.append(measure(driver, users, args.operations))
+        print(json.dumps(results[-1]))
+    # end for
+    if args.check:
+        factor = results[-1]['mean_us'] / results[0]['mean_us']
+        if factor > args.tolerance:
+            print(f'Latency grew by factor {factor:.2f} from {results[0]["users"]} to {results[-1]["users"]} users.')
+            return 1
+        # end if
+    # end if
+    return 0
+# end def
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+# end if
@@ -3,10 +3,17 @@
 from luckydonaldUtils.logger import logging
 
 __author__ = 'luckydonald'
-__all__ = ["TeleStateMachine", "TeleStateUpdateHandler", "TeleState", "TeleStateDatabaseDriver"]
+__all__ = ["TeleStateMachine", "TeleStateUpdateHandler", "TeleState", "TeleStateDatabaseDriver", "AsyncTeleStateDatabaseDriver", "AsyncDatabaseDriverAdapter", "StateVersionConflict", "TeleStateContext", "KeyedUpdateExecutor", "MetricsSink", "HistogramMetricsSink", "UpdateLogger", "SlowUpdateRecorder", "StateCodec", "JsonCodec", "MsgpackCodec", "PickleCodec", "StateSchema"]
 logger = logging.getLogger(__name__)
 
 from .constants import KEEP_PREVIOUS
 from .machine import TeleStateMachine, TeleMachine
 from .state import TeleState, TeleStateUpdateHandler
-from .database_driver import TeleStateDatabaseDriver
+from .database_driver import TeleStateDatabaseDriver, AsyncTeleStateDatabaseDriver, AsyncDatabaseDriverAdapter, StateVersionConflict
+from .context import TeleStateContext
+from .executor import KeyedUpdateExecutor
+from .metrics import MetricsSink, HistogramMetricsSink
+from .update_logger import UpdateLogger
+from .slow_updates import SlowUpdateRecorder
+from .codec import StateCodec, JsonCodec, MsgpackCodec, PickleCodec
+from .schema import StateSchema
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import json
+import pickle
+import zlib
+from typing import Any, Union
+
+from luckydonaldUtils.logger import logging
+from luckydonaldUtils.typing import JSONType
+
+__author__ = 'luckydonald'
+__all__ = ['StateCodec', 'JsonCodec', 'MsgpackCodec', 'PickleCodec', 'CODEC_KEY']
+
+logger = logging.getLogger(__name__)
+if __name__ == '__main__':
+    logging.add_colored_handler(level=logging.DEBUG)
+# end if
+
+
+_MAGIC = b'\xf5TS'  # start of every encoded payload, so it can't be mistaken for data stored without a codec.
+_PLAIN = _MAGIC + b'\x00'  # header of an encoded payload stored as is.
+_ZLIB = _MAGIC + b'\x01'  # header of an encoded payload compressed with zlib.
+_HEADER_LENGTH = len(_PLAIN)
+
+CODEC_KEY = '$codec'  # for drivers not `supports_bytes`, the encoded data is stored as `{CODEC_KEY: base64}`.
+
+
+class StateCodec(object):
+    """
+    Turns the data of a state, as returned by `TeleStateMachine.serialize(...)`, into `bytes` for the database, and back.
+
+    Give one to the machine (`TeleStateMachine(..., codec=JsonCodec())`) to use it for all states,
+    or to a single state (`TeleState('WIZARD', codec=...)`) to use it for that one.
+
+    Payloads longer than `compress_threshold` bytes are compressed with zlib.
+    The encoded data starts with a header telling if it is, so the threshold can be changed later on.
+    That header also tells apart data encoded by a codec from data stored before there was one (see `is_encoded`).
+
+    Subclasses implement `dumps(...)` and `loads(...)`.
+    """
+    compress_threshold: Union[int, None]  # compress payloads longer than that many bytes, `None` to never compress.
+    compress_level: int  # zlib level, `1` is fastest, `9` smallest.
+
+    def __init__(self, compress_threshold: Union[int, None] = None, compress_level: int = 6):
+        """
+        :param compress_threshold: Compress payloads longer than that many bytes. `None` to never compress.
+        :param compress_level: The zlib compression level, from `1` (fastest) to `9` (smallest).
+        """
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+    # end def
+
+    def dumps(self, data: Any) -> bytes:
+        """
+        :param data: The serialized data of a state.
+        :return: The data as bytes.
+        """
+        raise NotImplementedError('Your codec subclass must implement this.')
+    # end def
+
+    def loads(self, payload: bytes) -> Any:
+        """
+        :param payload: The bytes as returned by `dumps(...)`.
+        :return: The serialized data of a state.
+        """
+        raise NotImplementedError('Your codec subclass must implement this.')
+    # end def
+
+    def encode(self, data: Any) -> bytes:
+        """
+        :param data: The serialized data of a state.
+        :return: The bytes to store, compressed if longer than `compress_threshold`.
+        """
+        payload = self.dumps(data)
+        if self.compress_threshold is not None and len(payload) > self.compress_threshold:
+            return _ZLIB + zlib.compress(payload, self.compress_level)
+        # end if
+        return _PLAIN + payload
+    # end def
+
+    def decode(self, encoded: bytes) -> Any:
+        """
+        :param encoded: The bytes as returned by `encode(...)`.
+        :return: The serialized data of a state.
+        """
+        header = encoded[:_HEADER_LENGTH]
+        if header == _ZLIB:
+            return self.loads(zlib.decompress(memoryview(encoded)[_HEADER_LENGTH:]))
+        # end if
+        if header != _PLAIN:
+            raise ValueError(f'Unknown header {header!r}, that data was not encoded by a {self.__class__.__name__}.')
+        # end if
+        return self.loads(encoded[_HEADER_LENGTH:])
+    # end def
+
+    @staticmethod
+    def is_encoded(db_data: Any) -> bool:
+        """
+        :param db_data: Data as loaded from the database.
+        :return: If it was returned by `encode(...)`, instead of being stored without a codec.
+        """
+        return isinstance(db_data, bytes) and db_data.startswith(_MAGIC)
+    # end def
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(compress_threshold={self.compress_threshold!r})'
+    # end def
+# end class
+
+
+class JsonCodec(StateCodec):
+    """
+    Compact utf-8 json. Works for the same data as storing it without a codec.
+    """
+    def dumps(self, data: JSONType) -> bytes:
+        return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    # end def
+
+    def loads(self, payload: bytes) -> JSONType:
+        return json.loads(payload)
+    # end def
+# end class
+
+
+class MsgpackCodec(StateCodec):
+    """
+    MessagePack, a binary format for json-like data, which is smaller and faster to (de)code than json.
+    Needs the `msgpack` package (`pip install msgpack`).
+    """
+    def __init__(self, compress_threshold: Union[int, None] = None, compress_level: int = 6):
+        import msgpack
+        self._msgpack = msgpack
+        super().__init__(compress_threshold=compress_threshold, compress_level=compress_level)
+    # end def
+
+    def dumps(self, data: JSONType) -> bytes:
+        return self._msgpack.packb(data, use_bin_type=True)
+    # end def
+
+    def loads(self, payload: bytes) -> JSONType:
+        return self._msgpack.unpackb(payload, raw=False)
+    # end def
+# end class
+
+
+class PickleCodec(StateCodec):
+    """
+    Python's pickle, storing (almost) any python object.
+
+    Only use this if nobody else can write to the database (e.g. an in-memory `SimpleDictDriver`),
+    as loading a pickle can execute arbitrary code.
+    """
+    protocol: int
+
+    def __init__(self, compress_threshold: Union[int, None] = None, compress_level: int = 6, protocol: int = pickle.HIGHEST_PROTOCOL):
+        """
+        :param compress_threshold: Compress payloads longer than that many bytes. `None` to never compress.
+        :param compress_level: The zlib compression level, from `1` (fastest) to `9` (smallest).
+        :param protocol: The pickle protocol to use.
+        """
+        self.protocol = protocol
+        super().__init__(compress_threshold=compress_threshold, compress_level=compress_level)
+    # end def
+
+    def dumps(self, data: Any) -> bytes:
+        return pickle.dumps(data, protocol=self.protocol)
+    # end def
+
+    def loads(self, payload: bytes) -> Any:
+        return pickle.loads(payload)
+    # end def
+# end class
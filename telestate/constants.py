@@ -16,3 +16,14 @@ class KEEP_PREVIOUS:
 
 
 KEEP_PREVIOUS: KEEP_PREVIOUS = KEEP_PREVIOUS()  # now it's a singleton yo.
+
+
+class NOT_DESERIALIZED:
+    """
+    The `data` of a `TeleStateContext` not deserialized yet, with the machine's `lazy_data=True`.
+    """
+    pass
+# end class
+
+
+NOT_DESERIALIZED: NOT_DESERIALIZED = NOT_DESERIALIZED()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from typing import Any, Awaitable, Dict, List, Tuple, Union
+
+from luckydonaldUtils.logger import logging
+from pytgbot.api_types.receivable.updates import Update
+
+__author__ = 'luckydonald'
+__all__ = ["TeleStateContext"]
+
+logger = logging.getLogger(__name__)
+if __name__ == '__main__':
+    logging.add_colored_handler(level=logging.DEBUG)
+# end if
+
+
+class TeleStateContext(object):
+    """
+    Holds everything belonging to the update currently processed:
+    the active state, the state's data and the update causing it.
+
+    The `TeleStateMachine` keeps one of those per processed update (in a `contextvars.ContextVar`),
+    so that different threads (or asyncio tasks) can process updates of different chats at the same time
+    without overwriting each other's `CURRENT` state, `.data` or `.update`.
+    """
+    state: 'TeleState'
+    data: Union[Any, None]
+    update: Union[Update, None]
+    chat_id: Union[int, str, None]
+    user_id: Union[int, str, None]
+    awaitables: Union[List[Tuple['TeleState', Update, Awaitable]], None]  # only a list in `process_update_async(...)`.
+    loaded_fingerprint: Union[bytes, None]  # see `TeleStateMachine.fingerprint(...)`, of the state as loaded.
+    loaded_state_name: Union[str, None]  # the name of the state activated when loading, before the listeners ran.
+    loaded_data: Union[Any, None]  # the data as loaded from the database, while `data` is still `NOT_DESERIALIZED`.
+    timings: Union[Dict[str, float], None]  # seconds per phase, only a dict if the machine is measuring them.
+    log_sampled: bool  # if the messages of this update are logged, see `UpdateLogger`.
+    log_records: Union[List[Tuple[int, str, tuple]], None]  # messages kept to log them if the update turns out slow.
+
+    def __init__(self, state, data=None, update=None, chat_id=None, user_id=None):
+        """
+        :param state: The state being active.
+        :param data: additional data to keep for that state
+        :param update: the telegram update causing the state to be loaded.
+        :param chat_id: ID of the user/group chat the state was loaded for.
+        :param user_id: ID of the user the state was loaded for.
+        """
+        self.state = state
+        self.data = data
+        self.update = update
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.awaitables = None
+        self.loaded_fingerprint = None
+        self.loaded_state_name = None
+        self.loaded_data = None
+        self.timings = None
+        self.log_sampled = True
+        self.log_records = None
+    # end def
+
+    def __repr__(self):
+        return "<{clazz} {state!r} chat={chat_id!r} user={user_id!r}>".format(
+            clazz=self.__class__.__name__,
+            state=self.state,
+            chat_id=self.chat_id,
+            user_id=self.user_id,
+        )
+    # end def
+
+    __str__ = __repr__
+# end class
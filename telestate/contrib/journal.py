@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+import atexit
+import json
+import os
+import threading
+import time
+from typing import Iterable, List, Union, IO
+
+from luckydonaldUtils.logger import logging
+from luckydonaldUtils.typing import JSONType
+
+from ..database_driver import StateItem
+from .simple import SimpleDictDriver
+
+__author__ = 'luckydonald'
+__all__ = ['JournaledDictDriver']
+
+logger = logging.getLogger(__name__)
+if __name__ == '__main__':
+    logging.add_colored_handler(level=logging.DEBUG)
+# end if
+
+
+class JournaledDictDriver(SimpleDictDriver):
+    """
+    A `SimpleDictDriver` which survives restarts:
+    It keeps all the states in memory for fast loading, but also appends every save to a journal file.
+
+    Every `compact_every` saves, the journal is compacted into a snapshot file of the current states.
+    On startup, the snapshot and the journal are replayed.
+    The files are `<path>.snapshot` and `<path>.journal`, both with one json array per line,
+    so the state data has to be json serializable.
+
+    How safe the saves are against power loss, is configured with `fsync_interval`:
+    `0` calls `fsync` after every save, `None` never does (but the data still reaches the OS, so it survives the bot crashing),
+    and any other number of seconds calls it at most that often, but at the latest that many seconds after a save
+    (from a background thread, if no other save comes along), as well as on `close()`.
+
+    Compacting writes the snapshot without blocking saves: the journal is moved to `<path>.journal.compacting`,
+    and new saves go to a new journal, while the snapshot is written. Then the old journal is deleted.
+
+    Usage example:
+
+    >>> driver = JournaledDictDriver('/var/lib/mybot/states', fsync_interval=0.5)
+    >>> states = TeleStateMachine(__name__, database_driver=driver)
+    """
+    supports_bytes = False  # the files are json.
+
+    path: str
+    fsync_interval: Union[float, None]
+    compact_every: int
+    journal_entries: int  # saves in the journal since the last compaction.
+    _journal: Union[IO, None]
+    _last_fsync: float
+    _unsynced: bool  # if the journal was written since the last fsync.
+    _compact_lock: threading.Lock  # only one compaction at a time.
+    _closed: threading.Event  # stops the fsync thread.
+    _fsync_thread: Union[threading.Thread, None]
+
+    def __init__(self, path: str, fsync_interval: Union[float, None] = 1.0, compact_every: int = 10000):
+        """
+        :param path: Base path of the files, `.snapshot` and `.journal` will be appended.
+        :param fsync_interval: `0` to fsync after every save, `None` to never fsync, or the seconds to wait between them.
+        :param compact_every: compact the journal into a new snapshot after this many saves.
+        """
+        assert compact_every > 0
+        super().__init__()
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.compact_every = compact_every
+        self.journal_entries = 0
+        self._journal_lock = threading.Lock()  # keeps the order of the journal the same as in memory.
+        self._compact_lock = threading.Lock()
+        self._last_fsync = time.monotonic()
+        self._unsynced = False
+        self._journal = None
+        complete = self._replay()
+        if os.path.exists(self.compacting_path):
+            # we crashed while compacting, so finish that.
+            self._write_snapshot(self._items())
+            os.remove(self.compacting_path)
+        # end if
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        if not complete:
+            self._journal.write('\n')  # don't continue a half written line.
+        # end if
+        self._closed = threading.Event()
+        self._fsync_thread = None
+        if self.fsync_interval:
+            self._fsync_thread = threading.Thread(target=self._run_fsync, name=f'{self.__class__.__name__}-fsync', daemon=True)
+            self._fsync_thread.start()
+        # end if
+        atexit.register(self.close)
+    # end def
+
+    @property
+    def snapshot_path(self) -> str:
+        return self.path + '.snapshot'
+    # end def
+
+    @property
+    def journal_path(self) -> str:
+        return self.path + '.journal'
+    # end def
+
+    @property
+    def compacting_path(self) -> str:
+        return self.path + '.journal.compacting'
+    # end def
+
+    def save_state_for_chat_user(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None],
+        state_name: str,
+        state_data: JSONType
+    ) -> None:
+        self.save_states_bulk([(chat_id, user_id, state_name, state_data)])
+    # end def
+
+    def save_states_bulk(
+        self,
+        items: Iterable[StateItem]
+    ) -> None:
+        items = list(items)
+        if not items:
+            return
+        # end if
+        # serialize first, so non-json data fails before anything is changed.
+        lines = ''.join(json.dumps(list(item), separators=(',', ':')) + '\n' for item in items)
+        with self._journal_lock:
+            if self._journal is None:
+                raise ValueError('Driver is already closed.')
+            # end if
+            self._journal.write(lines)
+            self._journal.flush()
+            self._unsynced = True
+            self._maybe_fsync()
+            super().save_states_bulk(items)
+            self.journal_entries += len(items)
+            needs_compaction = self.journal_entries >= self.compact_every
+        # end with
+        if needs_compaction and self._compact_lock.acquire(blocking=False):  # else another thread is already on it.
+            try:
+                self._compact()
+            except Exception:
+                # the states are saved (in the journal), so don't fail the save. The next one tries again.
+                logger.exception('Compacting the journal failed.')
+            finally:
+                self._compact_lock.release()
+            # end try
+        # end if
+    # end def
+
+    def _maybe_fsync(self):
+        """
+        Calls `fsync` on the journal, if the `fsync_interval` says so. Must be called with `self._journal_lock` held.
+        """
+        if self.fsync_interval is None:
+            return
+        # end if
+        now = time.monotonic()
+        if self._unsynced and now - self._last_fsync >= self.fsync_interval:
+            os.fsync(self._journal.fileno())
+            self._last_fsync = now
+            self._unsynced = False
+        # end if
+    # end def
+
+    def _run_fsync(self):
+        """
+        The background thread, syncing saves no later save did sync within `fsync_interval`.
+        """
+        while not self._closed.wait(self.fsync_interval):
+            with self._journal_lock:
+                if self._journal is not None:
+                    self._maybe_fsync()
+                # end if
+            # end with
+        # end while
+    # end def
+
+    def compact(self):
+        """
+        Writes all current states to a new snapshot, and empties the journal.
+        """
+        with self._compact_lock:
+            self._compact()
+        # end with
+    # end def
+
+    def _compact(self):
+        """
+        Must be called with `self._compact_lock` held.
+
+        Only moving the journal aside blocks saves, the snapshot is written afterwards.
+        If we crash before the old journal is deleted, it is replayed (and compacted) again on startup,
+        between the snapshot and the new journal.
+        If writing the snapshot failed, the old journal is still there, so that one's snapshot is written first,
+        before the current journal may be moved over it.
+        """
+        if os.path.exists(self.compacting_path):
+            logger.debug(f'Finishing the previous compaction of {self.compacting_path!r} first.')
+            self._write_snapshot(self._items())
+            os.remove(self.compacting_path)
+        # end if
+        with self._journal_lock:
+            if self._journal is None:
+                raise ValueError('Driver is already closed.')
+            # end if
+            logger.debug(f'Compacting {self.journal_entries} journal entries into {self.snapshot_path!r}.')
+            items = self._items()
+            self._journal.close()  # flushes, the snapshot will fsync the content.
+            os.replace(self.journal_path, self.compacting_path)
+            self._journal = open(self.journal_path, 'w', encoding='utf-8')
+            self.journal_entries = 0
+            self._unsynced = False
+        # end with
+        self._write_snapshot(items)
+        os.remove(self.compacting_path)
+    # end def
+
+    def _items(self) -> List[StateItem]:
+        """
+        :return: A copy of all the states in memory.
+        """
+        with self._lock:
+            return [
+                (chat_id, user_id, state_name, state_data)
+                for chat_id, users in self.cache.items()
+                for user_id, (state_name, state_data) in users.items()
+            ]
+        # end with
+    # end def
+
+    def _write_snapshot(self, items: List[StateItem]):
+        """
+        Writes the new snapshot to a temporary file first, and then moves it over the old one.
+        """
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for item in items:
+                f.write(json.dumps(list(item), separators=(',', ':')) + '\n')
+            # end for
+            f.flush()
+            os.fsync(f.fileno())
+        # end with
+        os.replace(tmp_path, self.snapshot_path)
+    # end def
+
+    def _replay(self) -> bool:
+        """
+        Loads the snapshot and the journal into memory.
+
+        :return: If the journal ends with a complete line.
+        """
+        complete = True
+        entries = 0
+        for file_path in (self.snapshot_path, self.compacting_path, self.journal_path):
+            if not os.path.exists(file_path):
+                continue
+            # end if
+            with open(file_path, 'r', encoding='utf-8') as f:
+                for line_number, line in enumerate(f, start=1):
+                    if file_path == self.journal_path:
+                        complete = line.endswith('\n')
+                    # end if
+                    if not line.strip():
+                        continue
+                    # end if
+                    try:
+                        chat_id, user_id, state_name, state_data = json.loads(line)
+                    except ValueError:
+                        # most likely the last line, being only half written before a crash.
+                        logger.warning(f'Skipping broken line {line_number} of {file_path!r}.')
+                        continue
+                    # end try
+                    with self._lock:
+                        self._set((chat_id, user_id), (state_name, state_data))
+                    # end with
+                    entries += 1
+                # end for
+            # end with
+            if file_path == self.journal_path:
+                self.journal_entries = entries
+            # end if
+            entries = 0
+        # end for
+        return complete
+    # end def
+
+    def close(self):
+        """
+        Syncs and closes the journal, and stops the fsync thread. Saving afterwards is not possible.
+        """
+        self._closed.set()
+        if self._fsync_thread is not None and self._fsync_thread is not threading.current_thread():
+            self._fsync_thread.join()
+        # end if
+        with self._journal_lock:
+            if self._journal is None:
+                return
+            # end if
+            self._journal.flush()
+            if self.fsync_interval is not None:
+                os.fsync(self._journal.fileno())
+            # end if
+            self._journal.close()
+            self._journal = None
+        # end with
+        atexit.unregister(self.close)
+    # end def
+
+    def __enter__(self):
+        return self
+    # end def
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+    # end def
+# end class
@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
-from typing import Tuple, Union, Optional
+from typing import Any, Dict, Iterable, Tuple, Union, Optional
 
 from luckydonaldUtils.logger import logging
 from luckydonaldUtils.typing import JSONType
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import DuplicateKeyError
 from pymongo.collection import Collection
 
-from ..database_driver import TeleStateDatabaseDriver
+from ..database_driver import TeleStateDatabaseDriver, ChatUserKey, StateItem, StateVersionConflict
 
 __author__ = 'luckydonald'
 __all__ = ['MongoDriver']
@@ -23,16 +25,47 @@ class MongoDriver(TeleStateDatabaseDriver):
         'user_id': user_id,
         'state': state_name,
         'data': state_data,
+        'version': 1,  # increased on every save
     }
     ```
     Note, if `user_id` or `chat_id` are `None`, that will be stored as `"null"`. See `msg_get_chat_and_user_mongo_prepared(...)`
+
+    A unique index on `(chat_id, user_id)` is created, unless `ensure_index` is `False`.
+    `save_state_versioned(...)` needs that index to detect two processes creating the same new user.
     """
-    def __init__(self, mongodb_table):
-        assert isinstance(mongodb_table, Collection)
+    supports_versioning = True
+    supports_bytes = True
+    INDEX_NAME = 'telestate_chat_id_user_id'
+    LOAD_PROJECTION = {'_id': False, 'state': True, 'data': True, 'version': True}
+    LOAD_BULK_PROJECTION = {'_id': False, 'chat_id': True, 'user_id': True, 'state': True, 'data': True, 'version': True}
+
+    def __init__(self, mongodb_table: Collection, ensure_index: bool = True):
+        """
+        :param mongodb_table: The collection to store the states in.
+                              Anything with the same interface works as well, e.g. a `mongomock` collection.
+        :param ensure_index: Create the unique `(chat_id, user_id)` index, if missing.
+        """
+        assert all(hasattr(mongodb_table, attr) for attr in ('find_one', 'find', 'insert_one', 'update_one', 'bulk_write', 'create_index'))
         self.mongodb_table = mongodb_table
+        if ensure_index:
+            self.ensure_index()
+        # end if
         super().__init__()
     # end def
 
+    def ensure_index(self):
+        """
+        Creates the unique index on `(chat_id, user_id)`, so loading doesn't need to scan the whole collection.
+        Does nothing if it already exists.
+        Fails if the collection already contains more than one document for the same chat and user.
+        """
+        self.mongodb_table.create_index(
+            [('chat_id', ASCENDING), ('user_id', ASCENDING)],
+            name=self.INDEX_NAME,
+            unique=True,
+        )
+    # end def
+
     def load_state_for_chat_user(
         self,
         chat_id: Union[int, str, None],
@@ -41,6 +74,7 @@ class MongoDriver(TeleStateDatabaseDriver):
         chat_id, user_id = self.msg_get_chat_and_user_mongo_prepared(chat_id, user_id)
         data = self.mongodb_table.find_one(
             filter={'chat_id': chat_id, 'user_id': user_id},
+            projection=self.LOAD_PROJECTION,
         )
         if not data:
             return None, None
@@ -76,14 +110,163 @@ class MongoDriver(TeleStateDatabaseDriver):
         state_data: JSONType
     ) -> None:
         chat_id, user_id = self.msg_get_chat_and_user_mongo_prepared(chat_id, user_id)
-        self.mongodb_table.replace_one(
+        self.mongodb_table.update_one(
             filter={'chat_id': chat_id, 'user_id': user_id},
-            replacement={
+            update=self.state_update(state_name, state_data),
+            upsert=True,
+        )
+    # end def
+
+    def load_state_versioned(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None]
+    ) -> Tuple[Optional[str], JSONType, Optional[int]]:
+        chat_id, user_id = self.msg_get_chat_and_user_mongo_prepared(chat_id, user_id)
+        data = self.mongodb_table.find_one(
+            filter={'chat_id': chat_id, 'user_id': user_id},
+            projection=self.LOAD_PROJECTION,
+        )
+        if not data:
+            return None, None, None
+        # end if
+        return data['state'], data['data'], data.get('version', 0)  # documents stored before there were versions have none.
+    # end def
+
+    def save_state_versioned(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None],
+        state_name: str,
+        state_data: JSONType,
+        expected_version: Optional[int]
+    ) -> int:
+        original_chat_id, original_user_id = chat_id, user_id
+        chat_id, user_id = self.msg_get_chat_and_user_mongo_prepared(chat_id, user_id)
+        if expected_version is None:
+            try:
+                self.mongodb_table.insert_one(self.state_document(chat_id, user_id, state_name, state_data))
+            except DuplicateKeyError:
+                raise StateVersionConflict(original_chat_id, original_user_id, expected_version)
+            # end try
+            return 1
+        # end if
+        result = self.mongodb_table.update_one(
+            filter={
                 'chat_id': chat_id,
                 'user_id': user_id,
-                'state': state_name,
-                'data': state_data,
-            }
+                'version': {'$in': [0, None]} if expected_version == 0 else expected_version,
+            },
+            update=self.state_update(state_name, state_data),
         )
+        if not result.matched_count:
+            raise StateVersionConflict(original_chat_id, original_user_id, expected_version)
+        # end if
+        return expected_version + 1
+    # end def
+
+    @staticmethod
+    def state_update(
+        state_name: str,
+        state_data: JSONType
+    ) -> dict:
+        """
+        Builds the update operation storing a state in an existing document, increasing it's version.
+
+        :param state_name: the name of the current state.
+        :param state_data: the additional data for that state.
+
+        :return: the mongo update operation.
+        """
+        return {
+            '$set': {'state': state_name, 'data': state_data},
+            '$inc': {'version': 1},
+        }
+    # end def
+
+    @staticmethod
+    def state_document(
+        chat_id: Union[int, str],
+        user_id: Union[int, str],
+        state_name: str,
+        state_data: JSONType,
+        version: int = 1
+    ) -> dict:
+        """
+        Builds the document stored in the collection.
+
+        :param chat_id: ID of the user/group chat, already prepared by `msg_get_chat_and_user_mongo_prepared(...)`.
+        :param user_id: ID of the user, already prepared by `msg_get_chat_and_user_mongo_prepared(...)`.
+        :param state_name: the name of the current state.
+        :param state_data: the additional data for that state.
+        :param version: the version of the state.
+
+        :return: the mongo document.
+        """
+        return {
+            'chat_id': chat_id,
+            'user_id': user_id,
+            'state': state_name,
+            'data': state_data,
+            'version': version,
+        }
+    # end def
+
+    def load_states_bulk(
+        self,
+        keys: Iterable[ChatUserKey]
+    ) -> Dict[ChatUserKey, Tuple[Optional[str], JSONType]]:
+        return {
+            key: (state_name, state_data)
+            for key, (state_name, state_data, version) in self.load_states_versioned_bulk(keys).items()
+        }
+    # end def
+
+    def load_states_versioned_bulk(
+        self,
+        keys: Iterable[ChatUserKey]
+    ) -> Dict[ChatUserKey, Tuple[Optional[str], JSONType, Optional[int]]]:
+        result = {}
+        prepared_keys = {}  # prepared (chat_id, user_id): original (chat_id, user_id)
+        for key in keys:
+            result[key] = (None, None, None)
+            prepared_keys[self.msg_get_chat_and_user_mongo_prepared(*key)] = key
+        # end for
+        if not prepared_keys:
+            return result
+        # end if
+        cursor = self.mongodb_table.find(
+            filter={
+                'chat_id': {'$in': list({chat_id for chat_id, user_id in prepared_keys})},
+                'user_id': {'$in': list({user_id for chat_id, user_id in prepared_keys})},
+            },
+            projection=self.LOAD_BULK_PROJECTION,
+        )
+        for data in cursor:
+            # the $in filters can match combinations we didn't ask for.
+            key = prepared_keys.get((data['chat_id'], data['user_id']))
+            if key is not None:
+                result[key] = data['state'], data['data'], data.get('version', 0)
+            # end if
+        # end for
+        return result
+    # end def
+
+    def save_states_bulk(
+        self,
+        items: Iterable[StateItem]
+    ) -> None:
+        requests = []
+        for chat_id, user_id, state_name, state_data in items:
+            chat_id, user_id = self.msg_get_chat_and_user_mongo_prepared(chat_id, user_id)
+            requests.append(UpdateOne(
+                filter={'chat_id': chat_id, 'user_id': user_id},
+                update=self.state_update(state_name, state_data),
+                upsert=True,
+            ))
+        # end for
+        if requests:
+            self.mongodb_table.bulk_write(requests, ordered=True)
+        # end if
     # end def
 # end class
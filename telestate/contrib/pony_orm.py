@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
-from typing import Type, Union, Tuple, Optional
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Type, Union, Tuple, Optional
 
 from luckydonaldUtils.logger import logging
 from luckydonaldUtils.typing import JSONType
 from pony import orm
 
-from ..database_driver import TeleStateDatabaseDriver
+from ..database_driver import TeleStateDatabaseDriver, ChatUserKey, StateItem, StateVersionConflict
 
 
 __author__ = 'luckydonald'
@@ -20,7 +22,22 @@ if __name__ == '__main__':
 class PonyDriver(TeleStateDatabaseDriver):
     """
      A TeleStateMachine implementation preserving it's values in a sql instance via PonyORM.
+
+     Saves only lock the row of the chat/user being saved, so saves for different users don't block each other.
+     Two workers creating the row for the same new user at once are caught by the unique `(chat_id, user_id)` key,
+     the session is then retried, updating the row the other one created.
+     As `NULL` is never equal to anything in a unique key, only creating rows with a `None` id takes the table wide `StateUpsertLock`.
+
+     With `session_per_update` (the default), `TeleStateMachine.process_update` loads, runs the listeners and saves
+     within a single `db_session`, so that's only one transaction, and the row loaded is updated without querying it again.
+     Listeners using the same database take part in that transaction as well.
+
+     With `versioning=True`, the generated table gets a `version` column, increased on every save,
+     which `save_state_versioned(...)` checks. It's off by default, as tables created before don't have that column;
+     add it (`ALTER TABLE "State" ADD COLUMN version INTEGER NOT NULL DEFAULT 0`) before turning it on.
+     A custom `state_table` supports versioning if it has such a column.
     """
+    SAVE_RETRIES = 3  # how often a save is retried if a concurrent one created the same row first.
 
     class State(object):
         """
@@ -30,6 +47,7 @@ class PonyDriver(TeleStateDatabaseDriver):
         chat_id: int
         state: str
         data: dict
+        version: int  # optional (`versioning=True`), needed for `save_state_versioned(...)`.
 
         def __init__(self):
             raise NotImplementedError(
@@ -38,14 +56,22 @@ class PonyDriver(TeleStateDatabaseDriver):
     # end class
     StateTable: Type[State]
 
-    def __init__(self, db: orm.Database, state_table=None, state_upsert_lock=None):
+    def __init__(
+        self, db: orm.Database, state_table=None, state_upsert_lock=None, session_per_update: bool = True,
+        versioning: bool = False,
+    ):
         """
         A TeleStateMachine implementation preserving it's values in a sql instance via PonyORM.
         :param db: The database instance to append our tables to.
         :param state_table: overwrite the db.State table. If None, the generate one will be accessible at `self.StateTable`.
         :param state_upsert_lock: overwrite the db.StateUpsertLock table. If None, the generate one will be accessible at `self.UpsertLockTable`.
+        :param session_per_update: use one `db_session` for loading and saving an update's state, see `session(...)`.
+        :param versioning: give the generated table a `version` column, needed for `save_state_versioned(...)`.
+                           Existing tables need to get that column added first.
         """
         super().__init__()
+        self.session_per_update = session_per_update
+        self._local = threading.local()  # like pony's db_session, the unit of work is per thread.
 
         if state_table is not None:
             assert issubclass(state_table, self.State), "Needs to be subclass of PonyDriver.State"
@@ -57,6 +83,10 @@ class PonyDriver(TeleStateDatabaseDriver):
                 chat_id = orm.Optional(int, size=64, default=None, index=True, nullable=True)  # can be None (e.g. inline_query)
                 state = orm.Required(str)
                 data = orm.Optional(orm.Json, default=None, nullable=True)  # can be None
+                if versioning:
+                    version = orm.Required(int, default=0)  # increased on every save
+                # end if
+                orm.composite_key(chat_id, user_id)
             # end class
             self.StateTable = State
         # end if
@@ -70,6 +100,54 @@ class PonyDriver(TeleStateDatabaseDriver):
         # end if
     # end def
 
+    @property
+    def supports_versioning(self) -> bool:
+        return hasattr(self.StateTable, 'version')
+    # end def
+
+    @contextmanager
+    def session(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None]
+    ):
+        """
+        Processes the update within a single `db_session`, remembering the loaded rows so saving can update them directly.
+
+        If another worker created the row of a new user in the meantime, committing fails on the unique key.
+        Then the states are saved again in a new session, updating the other one's row.
+        If that happens for a versioned save, or another worker updated the row, it's a `StateVersionConflict` instead.
+        """
+        if not self.session_per_update or getattr(self._local, 'rows', None) is not None:
+            yield
+            return
+        # end if
+        self._local.rows = {}  # (chat_id, user_id): loaded db_state or None
+        self._local.saved = {}  # (chat_id, user_id): (state_name, state_data, versioned)
+        committing = False
+        try:
+            with orm.db_session:
+                yield
+                committing = True
+            # end with
+        except orm.TransactionError as e:
+            if not committing or not self._local.saved:
+                raise
+            # end if
+            if any(versioned for state_name, state_data, versioned in self._local.saved.values()):
+                raise StateVersionConflict(chat_id, user_id) from e
+            # end if
+            logger.debug('Committing the update\'s session failed, saving the states again.', exc_info=True)
+            saved, self._local.rows = self._local.saved, None
+            for (chat_id, user_id), (state_name, state_data, versioned) in saved.items():
+                self.save_state_for_chat_user(chat_id, user_id, state_name, state_data)
+            # end for
+        finally:
+            self._local.rows = None
+            self._local.saved = None
+        # end try
+    # end def
+
     @orm.db_session
     def load_state_for_chat_user(
         self,
@@ -77,6 +155,10 @@ class PonyDriver(TeleStateDatabaseDriver):
         user_id: Union[int, str, None]
     ) -> Tuple[Optional[str], JSONType]:
         db_state = self.StateTable.get(chat_id=chat_id, user_id=user_id)
+        rows = getattr(self._local, 'rows', None)
+        if rows is not None:
+            rows[chat_id, user_id] = db_state
+        # end if
         if not db_state:
             # switch into the default state
             return None, None
@@ -84,7 +166,6 @@ class PonyDriver(TeleStateDatabaseDriver):
         return db_state.state, db_state.data
     # end def
 
-    @orm.db_session
     def save_state_for_chat_user(
         self,
         chat_id: Union[int, str, None],
@@ -92,31 +173,210 @@ class PonyDriver(TeleStateDatabaseDriver):
         state_name: str,
         state_data: JSONType
     ) -> None:
+        if getattr(self._local, 'rows', None) is not None:
+            # within our session, a failed commit is handled there.
+            self._local.saved[chat_id, user_id] = (state_name, state_data, False)
+            self._save_state(chat_id, user_id, state_name, state_data)
+        elif orm.core.local.db_context_counter:
+            # within someone else's db_session, which we can't retry.
+            self._save_state(chat_id, user_id, state_name, state_data)
+        else:
+            orm.db_session(retry=self.SAVE_RETRIES)(self._save_state)(chat_id, user_id, state_name, state_data)
+        # end if
+    # end def
 
-        ul = self.UpsertLockTable.select().for_update().first()  # enforce only one is in a session.
-        logger.debug(f"Searching entry for chat {chat_id} and user {user_id}.")
+    @orm.db_session
+    def load_state_versioned(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None]
+    ) -> Tuple[Optional[str], JSONType, Optional[int]]:
+        if not self.supports_versioning:
+            return super().load_state_versioned(chat_id, user_id)
+        # end if
+        state_name, state_data = self.load_state_for_chat_user(chat_id, user_id)
+        if state_name is None:
+            return None, None, None
+        # end if
         # noinspection PyUnresolvedReferences
-        db_state = self.StateTable.get(
-            chat_id=chat_id,
-            user_id=user_id
-        )
+        return state_name, state_data, self.StateTable.get(chat_id=chat_id, user_id=user_id).version  # from the session's cache
+    # end def
+
+    def save_state_versioned(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None],
+        state_name: str,
+        state_data: JSONType,
+        expected_version: Optional[int]
+    ) -> Optional[int]:
+        if not self.supports_versioning:
+            return super().save_state_versioned(chat_id, user_id, state_name, state_data, expected_version)
+        # end if
+        if getattr(self._local, 'rows', None) is not None:
+            # within our session, a failed commit is handled there.
+            self._local.saved[chat_id, user_id] = (state_name, state_data, True)
+            return self._save_state(chat_id, user_id, state_name, state_data, versioned=True, expected_version=expected_version)
+        elif orm.core.local.db_context_counter:
+            return self._save_state(chat_id, user_id, state_name, state_data, versioned=True, expected_version=expected_version)
+        # end if
+        try:
+            with orm.db_session:
+                return self._save_state(chat_id, user_id, state_name, state_data, versioned=True, expected_version=expected_version)
+            # end with
+        except orm.TransactionIntegrityError as e:
+            # somebody else created the row in the meantime.
+            raise StateVersionConflict(chat_id, user_id, expected_version) from e
+        # end try
+    # end def
+
+    def _save_state(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None],
+        state_name: str,
+        state_data: JSONType,
+        versioned: bool = False,
+        expected_version: Optional[int] = None,
+    ) -> Optional[int]:
+        """
+        Updates or creates the database entry. Must be called within a `db_session`, which is retried on integrity errors.
+
+        :param versioned: If the stored version has to be `expected_version`.
+        :param expected_version: The version loaded before, `None` if there was no entry.
+
+        :return: The new version, if `versioned`.
+        :raises StateVersionConflict: if `versioned` and the stored version differs.
+        """
+        rows = getattr(self._local, 'rows', None)
+        if rows is not None and (chat_id, user_id) in rows:
+            # loaded in this session already, if that found nothing the unique key catches concurrent inserts.
+            db_state = rows[chat_id, user_id]
+        else:
+            logger.debug(f"Searching entry for chat {chat_id} and user {user_id}.")
+            # noinspection PyUnresolvedReferences
+            db_state = self.StateTable.select(lambda s: s.chat_id == chat_id and s.user_id == user_id).for_update().first()
+        # end if
+        if not db_state and (chat_id is None or user_id is None):
+            # the unique key can't catch duplicates with NULL, so we lock and check again.
+            ul = self.UpsertLockTable.select().for_update().first()
+            # noinspection PyUnresolvedReferences
+            db_state = self.StateTable.get(chat_id=chat_id, user_id=user_id)
+        # end if
+        if versioned and (db_state.version if db_state else None) != expected_version:
+            raise StateVersionConflict(chat_id, user_id, expected_version)
+        # end if
         if db_state:
             logger.debug(f"Found existing entry for chat {chat_id} and user {user_id}. Last state: {db_state.state!r}")
-            db_state.set(
-                chat_id=chat_id,
-                user_id=user_id,
-                state=state_name,
-                data=state_data,
-            )
+            db_state.set(state=state_name, data=state_data, **self._next_version(db_state))
         else:
             logger.debug(f"Creating new entry for chat {chat_id} and user {user_id} with state {state_name!r} and data:\n{state_data!r}.")
             # noinspection PyArgumentList
-            self.StateTable(
+            db_state = self.StateTable(
                 chat_id=chat_id,
                 user_id=user_id,
                 state=state_name,
                 data=state_data,
+                **self._next_version(None),
             )
         # end if
+        return db_state.version if versioned else None
+    # end def
+
+    def _next_version(self, db_state: Union[State, None]) -> Dict[str, int]:
+        """
+        :param db_state: The existing database entry, or `None` if it will be created.
+
+        :return: The keyword arguments to set the increased version, empty if our table has no version column.
+        """
+        if not self.supports_versioning:
+            return {}
+        # end if
+        return {'version': db_state.version + 1 if db_state else 1}
+    # end def
+
+    def _select_states(self, keys: List[ChatUserKey], for_update: bool = False) -> Dict[ChatUserKey, State]:
+        """
+        Fetches the database entries for all the given keys, with a single query.
+        Must be called within a `db_session`.
+
+        :param keys: The `(chat_id, user_id)` tuples to load.
+        :param for_update: lock the found rows until the end of the session.
+
+        :return: Dict of the found `(chat_id, user_id)` keys to the database entry.
+        """
+        wanted = set(keys)
+        if not wanted:
+            return {}
+        # end if
+        chat_ids = list({chat_id for chat_id, user_id in wanted if chat_id is not None})
+        user_ids = list({user_id for chat_id, user_id in wanted if user_id is not None})
+        # `IN (...)` never matches NULL, so those need to be checked separately.
+        null_chat = any(chat_id is None for chat_id, user_id in wanted)
+        null_user = any(user_id is None for chat_id, user_id in wanted)
+        # noinspection PyUnresolvedReferences
+        query = self.StateTable.select(
+            lambda s: (s.chat_id in chat_ids or null_chat and s.chat_id is None) and (s.user_id in user_ids or null_user and s.user_id is None)
+        )
+        if for_update:
+            query = query.for_update()
+        # end if
+        # the IN filters can match combinations we didn't ask for.
+        return {(db_state.chat_id, db_state.user_id): db_state for db_state in query if (db_state.chat_id, db_state.user_id) in wanted}
+    # end def
+
+    @orm.db_session
+    def load_states_bulk(
+        self,
+        keys: Iterable[ChatUserKey]
+    ) -> Dict[ChatUserKey, Tuple[Optional[str], JSONType]]:
+        keys = list(keys)
+        db_states = self._select_states(keys)
+        result = {}
+        for key in keys:
+            db_state = db_states.get(key)
+            result[key] = (db_state.state, db_state.data) if db_state else (None, None)
+        # end for
+        return result
+    # end def
+
+    def save_states_bulk(
+        self,
+        items: Iterable[StateItem]
+    ) -> None:
+        if orm.core.local.db_context_counter:
+            self._save_states(list(items))
+            return
+        # end if
+        orm.db_session(retry=self.SAVE_RETRIES)(self._save_states)(list(items))
+    # end def
+
+    def _save_states(self, items: List[StateItem]) -> None:
+        """
+        Updates or creates the database entries. Must be called within a `db_session`, which is retried on integrity errors.
+        """
+        keys = [(chat_id, user_id) for chat_id, user_id, state_name, state_data in items]
+        db_states = self._select_states(keys, for_update=True)
+        if any((chat_id is None or user_id is None) and (chat_id, user_id) not in db_states for chat_id, user_id in keys):
+            # the unique key can't catch duplicates with NULL, so we lock and check again.
+            ul = self.UpsertLockTable.select().for_update().first()
+            db_states = self._select_states(keys)
+        # end if
+        for chat_id, user_id, state_name, state_data in items:
+            db_state = db_states.get((chat_id, user_id))
+            if db_state:
+                db_state.set(state=state_name, data=state_data, **self._next_version(db_state))
+            else:
+                # noinspection PyArgumentList
+                db_states[chat_id, user_id] = self.StateTable(
+                    chat_id=chat_id,
+                    user_id=user_id,
+                    state=state_name,
+                    data=state_data,
+                    **self._next_version(None),
+                )
+            # end if
+        # end for
+        logger.debug(f"Stored {len(items)} states in bulk.")
     # end def
 # end class
@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
-from typing import Union, Tuple, Optional
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Union, Tuple, Optional
 
 from luckydonaldUtils.logger import logging
 from luckydonaldUtils.typing import JSONType
 
-from ..database_driver import TeleStateDatabaseDriver
+from ..database_driver import TeleStateDatabaseDriver, ChatUserKey, StateItem, StateVersionConflict
 
 __author__ = 'luckydonald'
 __all__ = ['SimpleDictDriver']
@@ -25,31 +29,97 @@ class SimpleDictDriver(TeleStateDatabaseDriver):
             )
         },
     }
+    ```
+
+    By default that dict grows with every chat/user ever seen.
+    To keep the memory bounded, you can set a maximum number of entries (`max_entries`),
+    an approximate byte budget (`max_bytes`), and/or evict users being idle for too long (`ttl`).
+    The least recently used entries are evicted first.
+    Evicted users start in the DEFAULT state again, unless a `backing_driver` is given:
+    Then all saves are written through to that one as well, and states missing in memory are loaded from there.
+
+    Loading and saving take constant time, regardless of how many states are stored.
+    For debugging, `dump()` returns a copy of everything stored, and `stats()` some numbers.
+
+    For `save_state_versioned(...)`, the version is the stored `(state, data)` tuple itself, as every save stores a new one.
     """
-    def __init__(self):
+    supports_versioning = True
+
+    max_entries: Union[int, None]
+    max_bytes: Union[int, None]
+    ttl: Union[float, None]
+    backing_driver: Union[TeleStateDatabaseDriver, None]
+    hits: int  # loads answered from memory.
+    misses: int  # loads not found in memory.
+    evictions: int  # entries removed because of `max_entries` or `max_bytes`.
+    expirations: int  # entries removed because of `ttl`.
+    _lru: 'OrderedDict[ChatUserKey, Tuple[float, int]]'  # (chat_id, user_id): (last access, size), least recently used first.
+    _bytes: int  # sum of the sizes in `_lru`.
+
+    def __init__(
+        self,
+        max_entries: Union[int, None] = None,
+        max_bytes: Union[int, None] = None,
+        ttl: Union[float, None] = None,
+        backing_driver: Union[TeleStateDatabaseDriver, None] = None,
+    ):
+        """
+        :param max_entries: Maximum number of chat/user states to keep. `None` for unlimited.
+        :param max_bytes: Approximate maximum memory the stored states may use. `None` for unlimited.
+        :param ttl: Seconds after which a state not being loaded or saved is evicted. `None` to keep forever.
+        :param backing_driver: Driver to write through to, and to load evicted states from.
+        """
         logger.debug('creating new SimpleDictDriver instance.')
+        assert backing_driver is None or isinstance(backing_driver, TeleStateDatabaseDriver)
         self.cache = dict()  # {'chat_id': {'user_id': 'state'}}
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.backing_driver = backing_driver
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._lru = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._versioned_save_lock = threading.Lock()  # makes checking the version and saving atomic.
         super().__init__()
     # end def
 
+    @property
+    def bounded(self) -> bool:
+        """
+        :return: If any of `max_entries`, `max_bytes` or `ttl` is set, so we need to track the usage of entries.
+        """
+        return self.max_entries is not None or self.max_bytes is not None or self.ttl is not None
+    # end def
+
     def load_state_for_chat_user(
         self,
         chat_id: Union[int, str, None],
         user_id: Union[int, str, None]
     ) -> Tuple[Optional[str], JSONType]:
-        logger.debug('states: {!r}'.format(self.cache))
-        cache_data = self.cache.get(chat_id, {})
-        # cache_data now contains all the users for the current chat, as dict.
-        state_name, cache_data = cache_data.get(user_id, (None, None))
+        with self._lock:
+            state_name, cache_data = self._get((chat_id, user_id))
+        # end with
         # cache_data now is the state's data or None,
         # state_name is the state's name or None.
-        logger.debug(f'cached state for {chat_id}|{user_id}: {state_name!r}\ndata: {cache_data!r}')
+        logger.debug('cached state for %s|%s: %r\ndata: %r', chat_id, user_id, state_name, cache_data)
         if state_name:
             return state_name, cache_data
-        else:
-            logger.debug('no state found for update.')
-            return None, None
-        # end def
+        # end if
+        if self.backing_driver is not None:
+            state_name, cache_data = self.backing_driver.load_state_for_chat_user(chat_id, user_id)
+            if state_name:
+                with self._lock:
+                    self._set((chat_id, user_id), (state_name, cache_data))
+                # end with
+                return state_name, cache_data
+            # end if
+        # end if
+        logger.debug('no state found for update.')
+        return None, None
     # end def
 
     def save_state_for_chat_user(
@@ -59,15 +129,257 @@ class SimpleDictDriver(TeleStateDatabaseDriver):
         state_name: str,
         state_data: JSONType
     ) -> None:
-        logger.debug(f'storing state for {chat_id}|{user_id}: {state_name!r}\ndata: {state_data!r}')
+        logger.debug('storing state for %s|%s: %r\ndata: %r', chat_id, user_id, state_name, state_data)
+        with self._lock:
+            self._set((chat_id, user_id), (state_name, state_data))
+        # end with
+        if self.backing_driver is not None:
+            self.backing_driver.save_state_for_chat_user(chat_id, user_id, state_name, state_data)
+        # end if
+    # end def
+
+    def load_state_versioned(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None]
+    ) -> Tuple[Optional[str], JSONType, Any]:
+        state_name, state_data = self.load_state_for_chat_user(chat_id, user_id)
+        with self._lock:
+            version = self.cache.get(chat_id, {}).get(user_id)
+        # end with
+        if version is None or version[0] != state_name or version[1] is not state_data:
+            # changed right after loading, so we can't tell which version we loaded.
+            version = (state_name, state_data) if state_name else None
+        # end if
+        return state_name, state_data, version
+    # end def
+
+    def save_state_versioned(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None],
+        state_name: str,
+        state_data: JSONType,
+        expected_version: Any
+    ) -> Any:
+        with self._versioned_save_lock:
+            with self._lock:
+                current = self.cache.get(chat_id, {}).get(user_id)
+            # end with
+            if current is not expected_version:
+                raise StateVersionConflict(chat_id, user_id, expected_version)
+            # end if
+            self.save_state_for_chat_user(chat_id, user_id, state_name, state_data)
+            with self._lock:
+                return self.cache.get(chat_id, {}).get(user_id)
+            # end with
+        # end with
+    # end def
 
-        if chat_id not in self.cache:
-            # chat_id level does not exist, create, with the {user_id: (state_name, data)} already inserted.
-            self.cache[chat_id] = {user_id: (state_name, state_data)}
+    def load_states_bulk(
+        self,
+        keys: Iterable[ChatUserKey]
+    ) -> Dict[ChatUserKey, Tuple[Optional[str], JSONType]]:
+        result = {}
+        missing = []
+        with self._lock:
+            for key in keys:
+                state_name, state_data = self._get(key)
+                if state_name:
+                    result[key] = (state_name, state_data)
+                else:
+                    result[key] = (None, None)
+                    missing.append(key)
+                # end if
+            # end for
+        # end with
+        if missing and self.backing_driver is not None:
+            loaded = self.backing_driver.load_states_bulk(missing)
+            with self._lock:
+                for key, (state_name, state_data) in loaded.items():
+                    if state_name:
+                        result[key] = (state_name, state_data)
+                        self._set(key, (state_name, state_data))
+                    # end if
+                # end for
+            # end with
+        # end if
+        return result
+    # end def
+
+    def save_states_bulk(
+        self,
+        items: Iterable[StateItem]
+    ) -> None:
+        items = list(items)
+        with self._lock:
+            for chat_id, user_id, state_name, state_data in items:
+                self._set((chat_id, user_id), (state_name, state_data))
+            # end for
+        # end with
+        if self.backing_driver is not None:
+            self.backing_driver.save_states_bulk(items)
+        # end if
+    # end def
+
+    def _get(self, key: ChatUserKey) -> Tuple[Optional[str], JSONType]:
+        """
+        Looks up a state, marking it as recently used. Must be called with `self._lock` held.
+
+        :param key: `(chat_id, user_id)`
+
+        :return: Tuple of the name of the state and data, or `(None, None)` if not found.
+        """
+        chat_id, user_id = key
+        value = self.cache.get(chat_id, {}).get(user_id)
+        if value is None:
+            self.misses += 1
+            return None, None
+        # end if
+        if self.bounded:
+            last_access, size = self._lru[key]
+            now = time.monotonic()
+            if self.ttl is not None and now - last_access > self.ttl:
+                self._evict(key, expired=True)
+                self.misses += 1
+                return None, None
+            # end if
+            self._lru[key] = (now, size)
+            self._lru.move_to_end(key)
+        # end if
+        self.hits += 1
+        return value
+    # end def
+
+    def _set(self, key: ChatUserKey, value: Tuple[Optional[str], JSONType]):
+        """
+        Stores a state, marking it as recently used and evicting others if we got over our limits.
+        Must be called with `self._lock` held.
+
+        :param key: `(chat_id, user_id)`
+        :param value: `(state_name, state_data)`
+        """
+        chat_id, user_id = key
+        self.cache.setdefault(chat_id, {})[user_id] = value
+        if not self.bounded:
+            return
+        # end if
+        size = self.estimate_size(value) if self.max_bytes is not None else 0
+        old = self._lru.pop(key, None)
+        if old is not None:
+            self._bytes -= old[1]
+        # end if
+        self._lru[key] = (time.monotonic(), size)
+        self._bytes += size
+        self._enforce_limits()
+    # end def
+
+    def _evict(self, key: ChatUserKey, expired: bool = False):
+        """
+        Removes a state from memory. Must be called with `self._lock` held.
+
+        :param key: `(chat_id, user_id)`
+        :param expired: If that is because of the `ttl`, else because of `max_entries` or `max_bytes`.
+        """
+        last_access, size = self._lru.pop(key)
+        self._bytes -= size
+        chat_id, user_id = key
+        users = self.cache[chat_id]
+        del users[user_id]
+        if not users:
+            del self.cache[chat_id]
+        # end if
+        if expired:
+            self.expirations += 1
         else:
-            # chat_id level does exist, just store the state in the user_id dict element. This can overwrite.
-            self.cache[chat_id][user_id] = (state_name, state_data)
+            self.evictions += 1
         # end if
-        logger.debug('states: {!r}'.format(self.cache))
+    # end def
+
+    def _enforce_limits(self):
+        """
+        Evicts the least recently used states until we are within `ttl`, `max_entries` and `max_bytes` again.
+        The most recently used state is always kept. Must be called with `self._lock` held.
+        """
+        if self.ttl is not None:
+            deadline = time.monotonic() - self.ttl
+            while self._lru:
+                key, (last_access, size) = next(iter(self._lru.items()))
+                if last_access >= deadline:
+                    break
+                # end if
+                self._evict(key, expired=True)
+            # end while
+        # end if
+        while len(self._lru) > 1 and (
+            (self.max_entries is not None and len(self._lru) > self.max_entries) or
+            (self.max_bytes is not None and self._bytes > self.max_bytes)
+        ):
+            self._evict(next(iter(self._lru)))
+        # end while
+    # end def
+
+    @property
+    def supports_bytes(self) -> bool:
+        return self.backing_driver is None or self.backing_driver.supports_bytes
+    # end def
+
+    @staticmethod
+    def estimate_size(obj: Any, _seen: Union[set, None] = None) -> int:
+        """
+        Approximates the memory used by a state, by summing up `sys.getsizeof` of it and all contained elements.
+
+        :param obj: The object to measure, e.g. the `(state_name, state_data)` tuple.
+
+        :return: size in bytes.
+        """
+        if _seen is None:
+            _seen = set()
+        # end if
+        if id(obj) in _seen:
+            return 0
+        # end if
+        _seen.add(id(obj))
+        size = sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            size += sum(
+                SimpleDictDriver.estimate_size(k, _seen) + SimpleDictDriver.estimate_size(v, _seen)
+                for k, v in obj.items()
+            )
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            size += sum(SimpleDictDriver.estimate_size(item, _seen) for item in obj)
+        # end if
+        return size
+    # end def
+
+    def dump(self) -> Dict[Union[int, str, None], Dict[Union[int, str, None], Tuple[Optional[str], JSONType]]]:
+        """
+        A snapshot of all the stored states, for debugging.
+        This copies the whole store, so don't call it for every update.
+
+        :return: dict like `cache`, i.e. `{chat_id: {user_id: (state_name, state_data)}}`.
+        """
+        with self._lock:
+            return {chat_id: dict(users) for chat_id, users in self.cache.items()}
+        # end with
+    # end def
+
+    def stats(self) -> Dict[str, Union[int, float, None]]:
+        """
+        :return: dict with the number of stored `entries`, their approximate `bytes` (if `max_bytes` is set),
+                 `hits`, `misses`, `hit_rate`, `evictions` and `expirations`.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': sum(len(users) for users in self.cache.values()),
+                'bytes': self._bytes if self.max_bytes is not None else None,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+        # end with
     # end def
 # end class
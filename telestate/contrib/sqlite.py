@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+import json
+import re
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Tuple, Union, Optional
+
+from luckydonaldUtils.logger import logging
+from luckydonaldUtils.typing import JSONType
+
+from ..database_driver import TeleStateDatabaseDriver, ChatUserKey, StateItem, StateVersionConflict
+
+__author__ = 'luckydonald'
+__all__ = ['SqliteDriver']
+
+logger = logging.getLogger(__name__)
+if __name__ == '__main__':
+    logging.add_colored_handler(level=logging.DEBUG)
+# end if
+
+
+_TABLE_NAME_REGEX = '^[A-Za-z_][A-Za-z0-9_]*$'
+
+
+class SqliteDriver(TeleStateDatabaseDriver):
+    """
+    A TeleStateMachine implementation preserving it's values in a SQLite database, using the `sqlite3` standard library.
+
+    One row per chat/user, with `(chat_id, user_id)` as primary key, and the data stored as json text (or as a BLOB, if encoded by a `StateCodec`).
+    Saving is a single `INSERT ... ON CONFLICT DO UPDATE`, bulk saves use `executemany` in one transaction.
+    The database runs in WAL mode, so other processes can read while we write.
+    Every save increases the row's `version`, which `save_state_versioned(...)` checks.
+    That column is added to existing tables which don't have it yet.
+
+    Note, if `user_id` or `chat_id` are `None`, that will be stored as `"null"`,
+    as `NULL` would never be equal in the primary key. See `msg_get_chat_and_user_sqlite_prepared(...)`.
+
+    Usage example:
+
+    >>> driver = SqliteDriver('/var/lib/mybot/states.sqlite')
+    >>> states = TeleStateMachine(__name__, database_driver=driver)
+    """
+    supports_versioning = True
+    supports_bytes = True
+    BULK_CHUNK_SIZE = 400  # keys per query, as sqlite limits the number of parameters.
+
+    def __init__(self, filename: str, table: str = 'telestate', synchronous: str = 'NORMAL'):
+        """
+        :param filename: The database file, or `':memory:'`.
+        :param table: The name of the table to use. Will be created if missing.
+        :param synchronous: The `PRAGMA synchronous` setting. `NORMAL` is safe with WAL, `FULL` also survives power loss.
+        """
+        if not re.match(_TABLE_NAME_REGEX, table):
+            raise ValueError(f'Invalid table name: {table!r}')
+        # end if
+        if synchronous.upper() not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+            raise ValueError(f'Invalid synchronous setting: {synchronous!r}')
+        # end if
+        super().__init__()
+        self.filename = filename
+        self.table = table
+        # a single connection, sqlite only has one writer at a time anyway.
+        self._connection = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute(f'PRAGMA synchronous={synchronous.upper()}')
+            self._connection.execute(
+                f'CREATE TABLE IF NOT EXISTS "{table}" ('
+                f' chat_id NOT NULL,'
+                f' user_id NOT NULL,'
+                f' state TEXT,'
+                f' data TEXT,'
+                f' version INTEGER NOT NULL DEFAULT 1,'
+                f' PRIMARY KEY (chat_id, user_id)'
+                f') WITHOUT ROWID'
+            )
+            columns = [row[1] for row in self._connection.execute(f'PRAGMA table_info("{table}")')]
+            if 'version' not in columns:
+                logger.warning(f'Adding the missing version column to the {table!r} table.')
+                self._connection.execute(f'ALTER TABLE "{table}" ADD COLUMN version INTEGER NOT NULL DEFAULT 1')
+            # end if
+        # end with
+        # the sqlite3 module caches the prepared statement per sql string, so we keep those constant.
+        self._sql_load = f'SELECT state, data, version FROM "{table}" WHERE chat_id = ? AND user_id = ?'
+        self._sql_save = (
+            f'INSERT INTO "{table}" (chat_id, user_id, state, data) VALUES (?, ?, ?, ?)'
+            f' ON CONFLICT (chat_id, user_id) DO UPDATE SET state = excluded.state, data = excluded.data, version = version + 1'
+        )
+        self._sql_insert = f'INSERT INTO "{table}" (chat_id, user_id, state, data) VALUES (?, ?, ?, ?)'
+        self._sql_update_versioned = (
+            f'UPDATE "{table}" SET state = ?, data = ?, version = version + 1'
+            f' WHERE chat_id = ? AND user_id = ? AND version = ?'
+        )
+    # end def
+
+    @staticmethod
+    def msg_get_chat_and_user_sqlite_prepared(
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None]
+    ) -> Tuple[Union[int, str], Union[int, str]]:
+        """
+        Replaces `None` with the string `"null"`, like `MongoDriver.msg_get_chat_and_user_mongo_prepared(...)`.
+
+        :param chat_id: ID of the user/group chat.
+        :param user_id: ID of the user.
+
+        :return: tuple of (chat_id, user_id)
+        """
+        chat_id = 'null' if chat_id is None else chat_id
+        user_id = 'null' if user_id is None else user_id
+        return chat_id, user_id
+    # end def
+
+    def load_state_for_chat_user(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None]
+    ) -> Tuple[Optional[str], JSONType]:
+        state_name, state_data, version = self.load_state_versioned(chat_id, user_id)
+        return state_name, state_data
+    # end def
+
+    def load_state_versioned(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None]
+    ) -> Tuple[Optional[str], JSONType, Optional[int]]:
+        chat_id, user_id = self.msg_get_chat_and_user_sqlite_prepared(chat_id, user_id)
+        with self._lock:
+            row = self._connection.execute(self._sql_load, (chat_id, user_id)).fetchone()
+        # end with
+        if row is None:
+            return None, None, None
+        # end if
+        state_name, state_data, version = row
+        return state_name, self._decode(state_data), version
+    # end def
+
+    def save_state_versioned(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None],
+        state_name: str,
+        state_data: JSONType,
+        expected_version: Optional[int]
+    ) -> int:
+        prepared_chat_id, prepared_user_id = self.msg_get_chat_and_user_sqlite_prepared(chat_id, user_id)
+        state_data = self._encode(state_data)
+        with self._lock:
+            if expected_version is None:
+                try:
+                    self._connection.execute(self._sql_insert, (prepared_chat_id, prepared_user_id, state_name, state_data))
+                except sqlite3.IntegrityError:
+                    raise StateVersionConflict(chat_id, user_id, expected_version)
+                # end try
+                return 1
+            # end if
+            cursor = self._connection.execute(
+                self._sql_update_versioned, (state_name, state_data, prepared_chat_id, prepared_user_id, expected_version)
+            )
+        # end with
+        if not cursor.rowcount:
+            raise StateVersionConflict(chat_id, user_id, expected_version)
+        # end if
+        return expected_version + 1
+    # end def
+
+    def save_state_for_chat_user(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None],
+        state_name: str,
+        state_data: JSONType
+    ) -> None:
+        chat_id, user_id = self.msg_get_chat_and_user_sqlite_prepared(chat_id, user_id)
+        params = (chat_id, user_id, state_name, self._encode(state_data))
+        with self._lock:
+            self._connection.execute(self._sql_save, params)
+        # end with
+    # end def
+
+    def load_states_bulk(
+        self,
+        keys: Iterable[ChatUserKey]
+    ) -> Dict[ChatUserKey, Tuple[Optional[str], JSONType]]:
+        return {
+            key: (state_name, state_data)
+            for key, (state_name, state_data, version) in self.load_states_versioned_bulk(keys).items()
+        }
+    # end def
+
+    def load_states_versioned_bulk(
+        self,
+        keys: Iterable[ChatUserKey]
+    ) -> Dict[ChatUserKey, Tuple[Optional[str], JSONType, Optional[int]]]:
+        result = {}
+        prepared_keys = {}  # prepared (chat_id, user_id): original (chat_id, user_id)
+        for key in keys:
+            result[key] = (None, None, None)
+            prepared_keys[self.msg_get_chat_and_user_sqlite_prepared(*key)] = key
+        # end for
+        prepared_list: List[Tuple[Union[int, str], Union[int, str]]] = list(prepared_keys)
+        for start in range(0, len(prepared_list), self.BULK_CHUNK_SIZE):
+            chunk = prepared_list[start:start + self.BULK_CHUNK_SIZE]
+            sql = (
+                f'SELECT chat_id, user_id, state, data, version FROM "{self.table}"'
+                f' WHERE (chat_id, user_id) IN (VALUES {", ".join(["(?, ?)"] * len(chunk))})'
+            )
+            with self._lock:
+                rows = self._connection.execute(sql, [param for key in chunk for param in key]).fetchall()
+            # end with
+            for chat_id, user_id, state_name, state_data, version in rows:
+                result[prepared_keys[chat_id, user_id]] = (state_name, self._decode(state_data), version)
+            # end for
+        # end for
+        return result
+    # end def
+
+    def save_states_bulk(
+        self,
+        items: Iterable[StateItem]
+    ) -> None:
+        params = [
+            (*self.msg_get_chat_and_user_sqlite_prepared(chat_id, user_id), state_name, self._encode(state_data))
+            for chat_id, user_id, state_name, state_data in items
+        ]
+        if not params:
+            return
+        # end if
+        with self._lock:
+            self._connection.execute('BEGIN')
+            try:
+                self._connection.executemany(self._sql_save, params)
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+            # end try
+            self._connection.execute('COMMIT')
+        # end with
+    # end def
+
+    @staticmethod
+    def _encode(state_data: JSONType) -> Union[str, bytes, None]:
+        if state_data is None or isinstance(state_data, bytes):
+            return state_data  # bytes are stored as a BLOB
+        # end if
+        return json.dumps(state_data, separators=(',', ':'))
+    # end def
+
+    @staticmethod
+    def _decode(db_data: Union[str, bytes, None]) -> JSONType:
+        if db_data is None or isinstance(db_data, bytes):
+            return db_data
+        # end if
+        return json.loads(db_data)
+    # end def
+
+    def close(self):
+        """
+        Closes the database connection.
+        """
+        with self._lock:
+            self._connection.close()
+        # end with
+    # end def
+# end class
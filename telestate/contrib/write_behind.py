@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+import atexit
+import copy
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Tuple, Optional, Union
+
+from luckydonaldUtils.logger import logging
+from luckydonaldUtils.typing import JSONType
+
+from ..database_driver import TeleStateDatabaseDriver, ChatUserKey, StateItem
+
+__author__ = 'luckydonald'
+__all__ = ['WriteBehindDriver']
+
+logger = logging.getLogger(__name__)
+if __name__ == '__main__':
+    logging.add_colored_handler(level=logging.DEBUG)
+# end if
+
+
+class WriteBehindDriver(TeleStateDatabaseDriver):
+    """
+    Wraps any other `TeleStateDatabaseDriver`, buffering the saves and writing them to the wrapped driver in batches.
+
+    Repeated saves for the same chat/user are coalesced, so only the latest state is written.
+    Loads are answered from the buffer if there is a not yet written state.
+    The buffer is flushed (via the wrapped driver's `save_states_bulk`) in a background thread
+    when it holds `flush_size` states or after `flush_interval` seconds, and when calling `close()`,
+    which also is done automatically at interpreter shutdown.
+
+    The buffer is bounded to `max_pending` states, counting the ones currently being written as well,
+    so states put back after a failed flush still fit.
+    A save of a new chat/user waits for the flush (backpressure) if it is full,
+    or, without the background thread, flushes right away (raising if that fails).
+
+    The buffer holds copies of the data, so changing a loaded or saved object doesn't change the buffered state.
+
+    Usage example:
+
+    >>> from telestate.contrib.mongo import MongoDriver
+    >>> driver = WriteBehindDriver(MongoDriver(db.states), flush_size=100, flush_interval=2.0)
+    >>> states = TeleStateMachine(__name__, database_driver=driver)
+
+    Note, states in the buffer are lost if the process is killed without a chance to run `close()`.
+    """
+    driver: TeleStateDatabaseDriver
+    max_pending: int
+    flush_size: int
+    flush_interval: Union[float, None]
+    coalesced: int  # how many saves replaced a not yet written one.
+    flushed: int  # how many states were written to the wrapped driver.
+    flushes: int  # how often we wrote to the wrapped driver.
+    _pending: 'OrderedDict[ChatUserKey, Tuple[Union[str, None], JSONType]]'  # saved, waiting for the next flush.
+    _flushing: Dict[ChatUserKey, Tuple[Union[str, None], JSONType]]  # currently being written by a flush.
+
+    def __init__(
+        self,
+        driver: TeleStateDatabaseDriver,
+        max_pending: int = 10000,
+        flush_size: int = 100,
+        flush_interval: Union[float, None] = 1.0,
+    ):
+        """
+        :param driver: The driver to write to.
+        :param max_pending: The maximum number of states kept in the buffer. Saves block while it is full.
+        :param flush_size: Flush as soon as this many states are buffered.
+        :param flush_interval: Flush after this many seconds at the latest.
+                               `None` disables the background thread, you have to call `flush()` yourself then.
+        """
+        assert isinstance(driver, TeleStateDatabaseDriver)
+        assert max_pending >= flush_size > 0
+        super().__init__()
+        self.driver = driver
+        self.max_pending = max_pending
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.coalesced = 0
+        self.flushed = 0
+        self.flushes = 0
+        self._pending = OrderedDict()
+        self._flushing = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)  # notified when states are added or removed.
+        self._flush_lock = threading.Lock()  # only one flush writing at a time.
+        self._closed = False
+        self._thread = None
+        if flush_interval is not None:
+            self._thread = threading.Thread(target=self._run, name=f'{self.__class__.__name__}-flush', daemon=True)
+            self._thread.start()
+        # end if
+        atexit.register(self.close)
+    # end def
+
+    @property
+    def supports_bytes(self) -> bool:
+        return self.driver.supports_bytes
+    # end def
+
+    def load_state_for_chat_user(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None]
+    ) -> Tuple[Optional[str], JSONType]:
+        key = (chat_id, user_id)
+        with self._lock:
+            buffered = self._pending.get(key) or self._flushing.get(key)
+        # end with
+        if buffered is not None:
+            state_name, state_data = buffered
+            return state_name, copy.deepcopy(state_data)
+        # end if
+        return self.driver.load_state_for_chat_user(chat_id, user_id)
+    # end def
+
+    def save_state_for_chat_user(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None],
+        state_name: str,
+        state_data: JSONType
+    ) -> None:
+        key = (chat_id, user_id)
+        state_data = copy.deepcopy(state_data)
+        while True:
+            with self._changed:
+                while self._thread is not None and self._is_full(key):
+                    logger.debug('Write buffer full, waiting for the flush.')
+                    self._changed.notify_all()  # wake the flusher
+                    self._changed.wait()
+                # end while
+                closed = self._closed
+                if not self._is_full(key):
+                    if not closed:
+                        if key in self._pending:
+                            self.coalesced += 1
+                        # end if
+                        self._pending[key] = (state_name, state_data)
+                        if len(self._pending) >= self.flush_size:
+                            self._changed.notify_all()
+                        # end if
+                    # end if
+                    break
+                # end if
+            # end with
+            logger.debug('Write buffer full, flushing it first.')
+            self.flush()  # no background thread to wait for.
+        # end while
+        if closed:
+            logger.debug('Already closed, writing directly.')
+            self.driver.save_state_for_chat_user(chat_id, user_id, state_name, state_data)
+        elif self._thread is None and len(self._pending) >= self.flush_size:
+            self.flush()
+        # end if
+    # end def
+
+    def load_states_bulk(
+        self,
+        keys: Iterable[ChatUserKey]
+    ) -> Dict[ChatUserKey, Tuple[Optional[str], JSONType]]:
+        result = {}
+        missing = []
+        with self._lock:
+            for key in keys:
+                if key in self._pending:
+                    result[key] = self._pending[key]
+                elif key in self._flushing:
+                    result[key] = self._flushing[key]
+                else:
+                    missing.append(key)
+                # end if
+            # end for
+        # end with
+        result = {key: (state_name, copy.deepcopy(state_data)) for key, (state_name, state_data) in result.items()}
+        if missing:
+            result.update(self.driver.load_states_bulk(missing))
+        # end if
+        return result
+    # end def
+
+    def save_states_bulk(
+        self,
+        items: Iterable[StateItem]
+    ) -> None:
+        for chat_id, user_id, state_name, state_data in items:
+            self.save_state_for_chat_user(chat_id, user_id, state_name, state_data)
+        # end for
+    # end def
+
+    def _is_full(self, key: ChatUserKey) -> bool:
+        """
+        Needs `self._lock` to be held.
+
+        :return: If saving a state for that key would buffer more than `max_pending` states.
+        """
+        return (
+            not self._closed and key not in self._pending and key not in self._flushing and
+            len(self._pending) + len(self._flushing) >= self.max_pending
+        )
+    # end def
+
+    @property
+    def pending(self) -> int:
+        """
+        :return: the number of states waiting to be written.
+        """
+        return len(self._pending)
+    # end def
+
+    def flush(self) -> int:
+        """
+        Writes all the buffered states to the wrapped driver now.
+        If that fails, the states are kept in the buffer, unless there were newer saves for them meanwhile.
+
+        :return: the number of states written.
+        """
+        with self._flush_lock:
+            with self._changed:
+                if not self._pending:
+                    return 0
+                # end if
+                self._flushing = dict(self._pending)
+                self._pending.clear()
+            # end with
+            batch = self._flushing
+            try:
+                self.driver.save_states_bulk(
+                    (chat_id, user_id, state_name, state_data)
+                    for (chat_id, user_id), (state_name, state_data) in batch.items()
+                )
+            except:
+                logger.exception(f'Writing {len(batch)} states failed, keeping them for the next flush.')
+                with self._changed:
+                    # they counted towards `max_pending` while being written, so this doesn't exceed it.
+                    for key, value in reversed(list(batch.items())):
+                        if key not in self._pending:
+                            self._pending[key] = value
+                            self._pending.move_to_end(key, last=False)  # older than the ones saved meanwhile.
+                        # end if
+                    # end for
+                    self._flushing = {}
+                    self._changed.notify_all()
+                # end with
+                raise
+            # end try
+            with self._changed:
+                self._flushing = {}
+                self.flushed += len(batch)
+                self.flushes += 1
+                self._changed.notify_all()  # make room for blocked saves.
+            # end with
+            return len(batch)
+        # end with
+    # end def
+
+    def _run(self):
+        """
+        The background thread, flushing when enough states are buffered or the `flush_interval` passed.
+        """
+        while not self._closed:
+            deadline = time.monotonic() + self.flush_interval
+            with self._changed:
+                while not self._closed and len(self._pending) < self.flush_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    # end if
+                    self._changed.wait(remaining)
+                # end while
+            # end with
+            # noinspection PyBroadException
+            try:
+                self.flush()
+            except Exception:
+                time.sleep(min(self.flush_interval, 1.0))  # already logged. Don't hammer a failing database.
+            # end try
+        # end while
+    # end def
+
+    def close(self):
+        """
+        Stops the background thread and writes all the remaining states.
+        """
+        with self._changed:
+            if self._closed:
+                return
+            # end if
+            self._closed = True
+            self._changed.notify_all()
+        # end with
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        # end if
+        self.flush()
+        atexit.unregister(self.close)
+    # end def
+
+    def __enter__(self):
+        return self
+    # end def
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+    # end def
+# end class
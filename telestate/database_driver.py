@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import asyncio
 from abc import abstractmethod
-from typing import Tuple, Union
+from concurrent.futures import Executor
+from contextlib import nullcontext
+from functools import partial
+from typing import Any, ContextManager, Dict, Iterable, Tuple, Union
 from luckydonaldUtils.logger import logging
 from luckydonaldUtils.typing import JSONType
 
@@ -13,7 +17,28 @@ if __name__ == '__main__':
 # end if
 
 
+ChatUserKey = Tuple[Union[int, str, None], Union[int, str, None]]  # (chat_id, user_id)
+StateItem = Tuple[Union[int, str, None], Union[int, str, None], Union[str, None], JSONType]  # (chat_id, user_id, state_name, state_data)
+
+
+class StateVersionConflict(Exception):
+    """
+    Raised by `save_state_versioned(...)` if the stored state changed since it was loaded,
+    i.e. another process stored a state for the same chat and user in the meantime.
+    """
+    def __init__(self, chat_id: Union[int, str, None], user_id: Union[int, str, None], expected_version: Any = None):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.expected_version = expected_version
+        super().__init__(f'State of user {user_id!r} in chat {chat_id!r} changed since loading it.')
+    # end def
+# end class
+
+
 class TeleStateDatabaseDriver(object):
+    supports_versioning: bool = False  # if `save_state_versioned(...)` actually checks the version.
+    supports_bytes: bool = False  # if it can store `bytes` as state data (see `StateCodec`), not only json types.
+
     @abstractmethod
     def load_state_for_chat_user(
         self,
@@ -51,4 +76,323 @@ class TeleStateDatabaseDriver(object):
         """
         raise NotImplementedError('Your database driver subclass must implement this.')
     # end def
+
+    def load_states_bulk(
+        self,
+        keys: Iterable[ChatUserKey]
+    ) -> Dict[ChatUserKey, Tuple[Union[str, None], JSONType]]:
+        """
+        Loads the states of multiple chat/user combinations at once.
+
+        This default implementation simply calls `load_state_for_chat_user` for every key,
+        subclasses can overwrite it to need only a single database round trip.
+
+        :param keys: The `(chat_id, user_id)` tuples to load.
+
+        :return: Dict of every requested `(chat_id, user_id)` to the tuple of the name of the state and optionally data.
+                 Not existing states are `(None, None)`.
+        """
+        return {key: self.load_state_for_chat_user(*key) for key in keys}
+    # end def
+
+    def save_states_bulk(
+        self,
+        items: Iterable[StateItem]
+    ) -> None:
+        """
+        Saves the states of multiple chat/user combinations at once.
+
+        This default implementation simply calls `save_state_for_chat_user` for every item,
+        subclasses can overwrite it to need only a single database round trip.
+
+        :param items: `(chat_id, user_id, state_name, state_data)` tuples to store.
+
+        :return: Nothing.
+        """
+        for chat_id, user_id, state_name, state_data in items:
+            self.save_state_for_chat_user(chat_id, user_id, state_name, state_data)
+        # end for
+    # end def
+
+    def load_state_versioned(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None]
+    ) -> Tuple[Union[str, None], JSONType, Any]:
+        """
+        Like `load_state_for_chat_user(...)`, but also returns the version of the stored state,
+        to be given to `save_state_versioned(...)` afterwards.
+
+        This default implementation has no versions, and returns `None` as such.
+
+        :param chat_id: ID of the user/group chat.
+        :param user_id: ID of the user.
+
+        :return: Tuple of the name of the state, optionally data, and the version.
+                 What the version is, is up to the driver. It's `None` if there is no state stored.
+        """
+        state_name, state_data = self.load_state_for_chat_user(chat_id, user_id)
+        return state_name, state_data, None
+    # end def
+
+    def load_states_versioned_bulk(
+        self,
+        keys: Iterable[ChatUserKey]
+    ) -> Dict[ChatUserKey, Tuple[Union[str, None], JSONType, Any]]:
+        """
+        Like `load_states_bulk(...)`, but also returns the versions, like `load_state_versioned(...)` does.
+
+        This default implementation simply calls `load_state_versioned` for every key,
+        subclasses can overwrite it to need only a single database round trip.
+
+        :param keys: The `(chat_id, user_id)` tuples to load.
+
+        :return: Dict of every requested `(chat_id, user_id)` to the tuple of the name of the state, optionally data, and the version.
+                 Not existing states are `(None, None, None)`.
+        """
+        return {key: self.load_state_versioned(*key) for key in keys}
+    # end def
+
+    def save_state_versioned(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None],
+        state_name: str,
+        state_data: JSONType,
+        expected_version: Any
+    ) -> Any:
+        """
+        Like `save_state_for_chat_user(...)`, but only stores the state if it's version still is `expected_version`.
+        This is a compare-and-swap, so of multiple processes working on the same user, only the first one can save.
+
+        This default implementation doesn't check anything (see `supports_versioning`), and simply saves.
+
+        :param chat_id: ID of the user/group chat.
+        :param user_id: ID of the user.
+        :param state_name: the name of the current state.
+        :param state_data: the additional data for that state.
+        :param expected_version: the version returned by `load_state_versioned(...)`.
+
+        :return: The new version.
+        :raises StateVersionConflict: if the stored version differs from `expected_version`.
+        """
+        self.save_state_for_chat_user(chat_id, user_id, state_name, state_data)
+        return None
+    # end def
+
+    def session(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None]
+    ) -> ContextManager:
+        """
+        A unit of work around processing a single update, i.e. loading it's state, running the listeners and saving it.
+        `TeleStateMachine.process_update` calls the load and save within `with database_driver.session(chat_id, user_id):`.
+
+        This default implementation does nothing,
+        subclasses can overwrite it to e.g. use a single database transaction for both and reuse the loaded entry.
+
+        :param chat_id: ID of the user/group chat.
+        :param user_id: ID of the user.
+
+        :return: A context manager.
+        """
+        return nullcontext()
+    # end def
+# end class
+
+
+class AsyncTeleStateDatabaseDriver(object):
+    """
+    Like `TeleStateDatabaseDriver`, but with `async def` methods, for usage with `TeleStateMachine.process_update_async`.
+    """
+    supports_versioning: bool = False  # if `save_state_versioned(...)` actually checks the version.
+    supports_bytes: bool = False  # if it can store `bytes` as state data (see `StateCodec`), not only json types.
+
+    @abstractmethod
+    async def load_state_for_chat_user(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None]
+    ) -> Tuple[Union[str, None], JSONType]:
+        """
+        Loads a state, and sets it.
+
+        :param chat_id: ID of the user/group chat.
+        :param user_id: ID of the user.
+
+        :return: Tuple of the name of the state and optionally data.
+        """
+        raise NotImplementedError('Your database driver subclass must implement this.')
+    # end def
+
+    @abstractmethod
+    async def save_state_for_chat_user(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None],
+        state_name: str,
+        state_data: JSONType
+    ) -> None:
+        """
+        Saves the current state.
+
+        :param chat_id: ID of the user/group chat.
+        :param user_id: ID of the user.
+        :param state_name: the name of the current state.
+        :param state_data: the additional data for that state.
+
+        :return: Nothing.
+        """
+        raise NotImplementedError('Your database driver subclass must implement this.')
+    # end def
+
+    async def load_state_versioned(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None]
+    ) -> Tuple[Union[str, None], JSONType, Any]:
+        """
+        Loads a state and it's version.
+        See `TeleStateDatabaseDriver.load_state_versioned`.
+        """
+        state_name, state_data = await self.load_state_for_chat_user(chat_id, user_id)
+        return state_name, state_data, None
+    # end def
+
+    async def save_state_versioned(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None],
+        state_name: str,
+        state_data: JSONType,
+        expected_version: Any
+    ) -> Any:
+        """
+        Saves a state, if it's version still is `expected_version`.
+        See `TeleStateDatabaseDriver.save_state_versioned`.
+        """
+        await self.save_state_for_chat_user(chat_id, user_id, state_name, state_data)
+        return None
+    # end def
+
+    async def load_states_bulk(
+        self,
+        keys: Iterable[ChatUserKey]
+    ) -> Dict[ChatUserKey, Tuple[Union[str, None], JSONType]]:
+        """
+        Loads the states of multiple chat/user combinations at once.
+        See `TeleStateDatabaseDriver.load_states_bulk`.
+        """
+        return {key: await self.load_state_for_chat_user(*key) for key in keys}
+    # end def
+
+    async def save_states_bulk(
+        self,
+        items: Iterable[StateItem]
+    ) -> None:
+        """
+        Saves the states of multiple chat/user combinations at once.
+        See `TeleStateDatabaseDriver.save_states_bulk`.
+        """
+        for chat_id, user_id, state_name, state_data in items:
+            await self.save_state_for_chat_user(chat_id, user_id, state_name, state_data)
+        # end for
+    # end def
+# end class
+
+
+class AsyncDatabaseDriverAdapter(AsyncTeleStateDatabaseDriver):
+    """
+    Makes a synchronous `TeleStateDatabaseDriver` usable as `AsyncTeleStateDatabaseDriver`,
+    by running it's calls in an executor, so they don't block the event loop.
+    """
+    driver: TeleStateDatabaseDriver
+    executor: Union[Executor, None]
+
+    def __init__(self, driver: TeleStateDatabaseDriver, executor: Union[Executor, None] = None):
+        """
+        :param driver: The synchronous driver to wrap.
+        :param executor: The executor to run the calls in. `None` uses the event loop's default executor.
+        """
+        assert isinstance(driver, TeleStateDatabaseDriver)
+        self.driver = driver
+        self.executor = executor
+        super().__init__()
+    # end def
+
+    async def load_state_for_chat_user(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None]
+    ) -> Tuple[Union[str, None], JSONType]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, partial(self.driver.load_state_for_chat_user, chat_id, user_id)
+        )
+    # end def
+
+    async def save_state_for_chat_user(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None],
+        state_name: str,
+        state_data: JSONType
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, partial(self.driver.save_state_for_chat_user, chat_id, user_id, state_name, state_data)
+        )
+    # end def
+
+    @property
+    def supports_versioning(self) -> bool:
+        return self.driver.supports_versioning
+    # end def
+
+    @property
+    def supports_bytes(self) -> bool:
+        return self.driver.supports_bytes
+    # end def
+
+    async def load_state_versioned(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None]
+    ) -> Tuple[Union[str, None], JSONType, Any]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, partial(self.driver.load_state_versioned, chat_id, user_id)
+        )
+    # end def
+
+    async def save_state_versioned(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None],
+        state_name: str,
+        state_data: JSONType,
+        expected_version: Any
+    ) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, partial(self.driver.save_state_versioned, chat_id, user_id, state_name, state_data, expected_version)
+        )
+    # end def
+
+    async def load_states_bulk(
+        self,
+        keys: Iterable[ChatUserKey]
+    ) -> Dict[ChatUserKey, Tuple[Union[str, None], JSONType]]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(self.driver.load_states_bulk, list(keys)))
+    # end def
+
+    async def save_states_bulk(
+        self,
+        items: Iterable[StateItem]
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(self.driver.save_states_bulk, list(items)))
+    # end def
 # end class
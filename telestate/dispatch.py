@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+from typing import Any, Callable, Dict, List, Tuple, Union
+
+from luckydonaldUtils.logger import logging
+from pytgbot.api_types.receivable.updates import Update
+from teleflask.exceptions import AbortProcessingPlease
+
+__author__ = 'luckydonald'
+__all__ = ['UPDATE_KINDS', 'ParsedUpdate', 'DispatchTable']
+
+logger = logging.getLogger(__name__)
+if __name__ == '__main__':
+    logging.add_colored_handler(level=logging.DEBUG)
+# end if
+
+
+UPDATE_KINDS = (
+    'message', 'edited_message', 'channel_post', 'edited_channel_post', 'inline_query', 'chosen_inline_result',
+    'callback_query', 'shipping_query', 'pre_checkout_query', 'poll', 'poll_answer', 'my_chat_member', 'chat_member',
+    'chat_join_request',
+)  # the optional fields of an `Update`, of which telegram sets exactly one.
+
+_Listeners = List[Tuple[Callable, List[Union[List[str], None]]]]  # (function, keyword combinations) in registration order.
+
+
+class ParsedUpdate(object):
+    """
+    What the `DispatchTable`s need to know about an update, looked up once per update
+    and shared by the current state's and the `ALL` state's handler.
+    """
+    __slots__ = ('kind', 'message', 'text', 'command', 'command_text')
+    kind: Union[str, None]  # the one of `UPDATE_KINDS` which is set, `None` if none or more than one are.
+    message: Any  # `update.message`
+    text: Union[str, None]  # `update.message.text`, stripped.
+    command: Union[str, None]  # the first word of `text`, if it has more than one word.
+    command_text: Union[str, None]  # the rest of `text`, after `command`.
+
+    def __init__(self, update: Update):
+        kinds = [kind for kind in UPDATE_KINDS if getattr(update, kind, None)]
+        self.kind = kinds[0] if len(kinds) == 1 else None
+        self.message = update.message
+        self.text = self.message.text.strip() if self.message and self.message.text else None
+        if self.text and " " in self.text:
+            self.command, self.command_text = self.text.split(" ", maxsplit=1)
+            self.command_text = self.command_text.strip()
+        else:
+            self.command, self.command_text = None, None
+        # end if
+    # end def
+# end class
+
+
+class DispatchTable(object):
+    """
+    The listeners of a `TeleStateUpdateHandler`, compiled for calling them quickly:
+    Commands are looked up in a dict, and the `@on_update` listeners are indexed by the kind of update they can be called for.
+
+    Calls the same listeners, in the same order, and handles `AbortProcessingPlease` and exclusive commands
+    like teleflask's `BotCommandsMixin`, `MessagesMixin` and `UpdatesMixin` do:
+    Commands first, then the message listeners, then the update listeners.
+    """
+    commands: Dict[str, Tuple[Callable, bool]]  # command: (function, exclusive)
+    message_listeners: _Listeners
+    update_listeners: _Listeners  # all of them, for updates we can't tell the kind of.
+    update_listeners_by_kind: Dict[str, _Listeners]  # only the ones which could be called for that kind.
+
+    def __init__(self, handler):
+        """
+        :param handler: The `TeleStateUpdateHandler` to compile the listeners of.
+        """
+        self.commands = dict(handler.commands)
+        self.message_listeners = list(handler.message_listeners.items())
+        self.update_listeners = list(handler.update_listeners.items())
+        self.update_listeners_by_kind = {
+            kind: [
+                (listener, required_keywords_array) for listener, required_keywords_array in self.update_listeners
+                if any(self._could_match(required_keywords, kind) for required_keywords in required_keywords_array)
+            ]
+            for kind in UPDATE_KINDS
+        }
+    # end def
+
+    @staticmethod
+    def _could_match(required_keywords: Union[List[str], None], kind: str) -> bool:
+        """
+        :return: If an update of that kind could have all those keywords set.
+        """
+        if not required_keywords:
+            return True
+        # end if
+        kinds = [keyword for keyword in required_keywords if keyword in UPDATE_KINDS]
+        return not kinds or kinds == [kind] * len(kinds)
+    # end def
+
+    def process_update(self, handler, update: Update, parsed: ParsedUpdate):
+        """
+        Calls the fitting listeners for the update.
+
+        :param handler: The `TeleStateUpdateHandler`, which processes the results of the listeners.
+        :param update: The Telegram update.
+        :param parsed: The same update, already looked at.
+        """
+        if parsed.text is not None:
+            if parsed.text in self.commands:
+                logger.debug("Running command {input} (no text).".format(input=parsed.text))
+                func, exclusive = self.commands[parsed.text]
+                text = None
+            elif parsed.command is not None and parsed.command in self.commands:
+                logger.debug("Running command {cmd} (text={input!r}).".format(cmd=parsed.command, input=parsed.text))
+                func, exclusive = self.commands[parsed.command]
+                text = parsed.command_text
+            else:
+                func, exclusive, text = None, False, None
+            # end if
+            if func is not None:
+                try:
+                    handler.process_result(update, func(update, text))
+                except AbortProcessingPlease as e:
+                    logger.debug('Asked to stop processing updates.')
+                    if e.return_value:
+                        handler.process_result(update, e.return_value)
+                    # end if
+                    return
+                except Exception:
+                    logger.exception("Failed calling command {cmd!r} ({func}):".format(cmd=parsed.text, func=func))
+                # end try
+            # end if
+            if exclusive:
+                logger.debug("Command function {func!r} marked exclusive, stopping further processing.".format(func=func))
+                return
+            # end if
+        # end if
+        msg = parsed.message
+        if msg and self.message_listeners:
+            if self._call_listeners(handler, update, self.message_listeners, msg, (update, msg)):
+                return
+            # end if
+        # end if
+        listeners = self.update_listeners if parsed.kind is None else self.update_listeners_by_kind[parsed.kind]
+        if listeners:
+            self._call_listeners(handler, update, listeners, update, (update,))
+        # end if
+    # end def
+
+    @staticmethod
+    def _call_listeners(handler, update: Update, listeners: _Listeners, subject: Any, args: tuple) -> bool:
+        """
+        Calls every listener for which any of it's keyword combinations is fully set on the `subject`.
+
+        :return: If a listener asked to stop processing (`AbortProcessingPlease`).
+        """
+        for listener, required_keywords_array in listeners:
+            for required_keywords in required_keywords_array:
+                try:
+                    if not required_keywords or all(getattr(subject, keyword, None) for keyword in required_keywords):
+                        handler.process_result(update, listener(*args))
+                        break  # stop processing other required_keywords combinations
+                    # end if
+                except AbortProcessingPlease as e:
+                    logger.debug('Asked to stop processing updates.')
+                    if e.return_value:
+                        handler.process_result(update, e.return_value)
+                    # end if
+                    return True
+                except Exception:
+                    logger.exception("Error executing the update listener {func}.".format(func=listener))
+                # end try
+            # end for
+        # end for
+        return False
+    # end def
+# end class
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Hashable, List, Tuple, Union
+
+from luckydonaldUtils.logger import logging
+
+__author__ = 'luckydonald'
+__all__ = ["KeyedUpdateExecutor"]
+
+logger = logging.getLogger(__name__)
+if __name__ == '__main__':
+    logging.add_colored_handler(level=logging.DEBUG)
+# end if
+
+
+class KeyedUpdateExecutor(object):
+    """
+    Runs functions on a thread pool, but serializes all the calls sharing the same key.
+
+    The `TeleStateMachine` uses the `(chat_id, user_id)` tuple as key,
+    so updates of the same user in the same chat are processed one after another (in the order they came in),
+    while updates for different users run in parallel.
+
+    Usage example:
+
+    >>> from telestate.contrib.simple import SimpleDictDriver
+    >>> executor = KeyedUpdateExecutor(max_workers=8)
+    >>> states = TeleStateMachine(__name__, SimpleDictDriver(), executor=executor)
+    >>> states.submit_update(update)  # returns a `concurrent.futures.Future`
+    >>> executor.stats()
+    {'queue_depth': 0, 'in_flight_keys': 1, ...}
+    """
+    _pool: ThreadPoolExecutor
+    _lock: threading.Lock
+    _queues: Dict[Hashable, Deque[Tuple[Future, Callable, tuple, dict, float]]]  # key: pending calls, exists while in flight.
+    _shutdown: bool  # `shutdown()` was called, no new calls are accepted.
+    queue_depth: int  # calls submitted, but not yet started.
+    started: int  # calls started.
+    processed: int  # calls finished.
+    wait_time_total: float  # seconds all the calls waited before being started.
+    wait_time_max: float  # seconds the longest waiting call waited before being started.
+
+    def __init__(self, max_workers: Union[int, None] = None, thread_name_prefix: str = 'telestate'):
+        """
+        :param max_workers: The maximum number of threads processing in parallel.
+                            `None` uses the default of `concurrent.futures.ThreadPoolExecutor`.
+        :param thread_name_prefix: Prefix for the names of the worker threads.
+        """
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._shutdown = False
+        self.queue_depth = 0
+        self.started = 0
+        self.processed = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+    # end def
+
+    def submit(self, key: Hashable, func: Callable, *args, **kwargs) -> Future:
+        """
+        Schedules `func(*args, **kwargs)` to be run after all the previously submitted calls with the same `key`.
+
+        :param key: The key to serialize on, e.g. `(chat_id, user_id)`.
+        :param func: The function to call.
+
+        :return: A future resolving to the result of the call.
+        :raises RuntimeError: The executor was already shut down.
+        """
+        future = Future()
+        item = (future, func, args, kwargs, time.monotonic())
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new calls after shutdown')
+            # end if
+            self.queue_depth += 1
+            if key in self._queues:
+                # that key is already being processed, the worker will pick it up once done.
+                self._queues[key].append(item)
+                return future
+            # end if
+            self._queues[key] = deque()
+        # end with
+        try:
+            self._pool.submit(self._run_key, key, item)
+        except BaseException as e:
+            # the pool is gone, so nobody will run this key. Forget it, and fail what got queued behind it meanwhile.
+            with self._lock:
+                queued = self._queues.pop(key)
+                self.queue_depth -= 1 + len(queued)
+            # end with
+            for queued_future, *_ in queued:
+                queued_future.set_exception(e)
+            # end for
+            raise
+        # end try
+        return future
+    # end def
+
+    def _run_key(self, key: Hashable, item: Tuple[Future, Callable, tuple, dict, float]):
+        """
+        Works through all the queued calls of a single key, until there are none left.
+        """
+        while item is not None:
+            future, func, args, kwargs, submitted = item
+            waited = time.monotonic() - submitted
+            with self._lock:
+                self.queue_depth -= 1
+                self.started += 1
+                self.wait_time_total += waited
+                self.wait_time_max = max(self.wait_time_max, waited)
+            # end with
+            if future.set_running_or_notify_cancel():
+                # noinspection PyBroadException
+                try:
+                    result = func(*args, **kwargs)
+                except BaseException as e:
+                    logger.debug(f'Call for key {key!r} failed.', exc_info=True)
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+                # end try
+            # end if
+            with self._lock:
+                self.processed += 1
+                queue = self._queues[key]
+                if queue:
+                    item = queue.popleft()
+                else:
+                    del self._queues[key]
+                    item = None
+                # end if
+            # end with
+        # end while
+    # end def
+
+    def in_flight_keys(self) -> List[Hashable]:
+        """
+        :return: The keys currently being processed or waiting to be processed.
+        """
+        with self._lock:
+            return list(self._queues.keys())
+        # end with
+    # end def
+
+    def key_wait_times(self) -> Dict[Hashable, float]:
+        """
+        :return: For every key with waiting calls the seconds the oldest of those is already waiting.
+        """
+        now = time.monotonic()
+        with self._lock:
+            return {key: now - queue[0][4] for key, queue in self._queues.items() if queue}
+        # end with
+    # end def
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Numbers to help sizing the thread pool.
+
+        :return: dict with `queue_depth`, `in_flight_keys`, `processed`, `wait_time_total`, `wait_time_avg` and `wait_time_max`.
+        """
+        with self._lock:
+            return {
+                'queue_depth': self.queue_depth,
+                'in_flight_keys': len(self._queues),
+                'processed': self.processed,
+                'wait_time_total': self.wait_time_total,
+                'wait_time_avg': self.wait_time_total / self.started if self.started else 0.0,
+                'wait_time_max': self.wait_time_max,
+            }
+        # end with
+    # end def
+
+    def shutdown(self, wait: bool = True):
+        """
+        Stops the thread pool.
+
+        :param wait: If we should wait for all the submitted calls to finish.
+        """
+        with self._lock:
+            self._shutdown = True
+        # end with
+        self._pool.shutdown(wait=wait)
+    # end def
+# end class
@@ -1,7 +1,15 @@
 # -*- coding: utf-8 -*-
+import base64
+import hashlib
 import inspect
+import json
+import pickle
+import threading
+import time
 from abc import ABC
-from typing import Dict, cast, Union, Any, Callable, Tuple, Optional, Type
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, cast, Union, Any, Callable, Tuple, Optional, Type
 
 from luckydonaldUtils.exceptions import assert_type_or_raise
 from luckydonaldUtils.logger import logging
@@ -13,16 +21,17 @@ from teleflask.server.base import TeleflaskMixinBase, TeleflaskBase
 from teleflask.server.blueprints import TBlueprintSetupState
 from teleflask.server.mixins import StartupMixin
 
-from telestate.constants import KEEP_PREVIOUS
+from telestate.constants import KEEP_PREVIOUS, NOT_DESERIALIZED
+from .codec import StateCodec, CODEC_KEY
+from .context import TeleStateContext
 from .state import TeleState, assert_can_be_name, can_be_name
-from .database_driver import TeleStateDatabaseDriver
-
-# if available use pformat for printing the current data.
-try:
-    from pprint import pformat
-except ImportError:
-    pformat = repr
-# end if
+from .database_driver import TeleStateDatabaseDriver, AsyncTeleStateDatabaseDriver, AsyncDatabaseDriverAdapter, StateVersionConflict, StateItem
+from .executor import KeyedUpdateExecutor
+from .metrics import MetricsSink
+from .update_logger import UpdateLogger
+from .slow_updates import SlowUpdateRecorder
+from .update_filter import UpdateFilter
+from .dispatch import ParsedUpdate
 
 __author__ = 'luckydonald'
 __all__ = ["TeleStateMachine"]
@@ -50,29 +59,113 @@ class TeleStateMachine(StartupMixin, TeleflaskMixinBase):
     >>> states = TeleStateMachine(__name__, driver=SimpleDictDriver())  # choose any driver like `SimpleDictDriver`, see the contrib folder.
 
     You can access the current state via `states.CURRENT`, and the default state for a new user/chat is `states.DEFAULT`.
+    The current state, it's data and update are kept per processed update (see `states.context`),
+    so a single machine can process updates of different chats in parallel threads.
 
     You switch the state with `states.set('EXAMPLE_STATE')`, or `states.EXAMPLE_STATE.activate()`.
     If you want to store additional data, both commands support `data='1234'` parameter.
     That data can be any type, which your storage backend is able to process.
     Using basic python types (`dict`, `list`, `str`, `int`, `bool` and `None`) should be safe to use with most of them.
+
+    If you provide an `executor=KeyedUpdateExecutor(...)`, incoming updates are processed on that thread pool:
+    Updates of the same user in the same chat stay in order, while updates of different users run in parallel.
+
+    If an update neither changed the state nor it's data, storing it in the database is skipped.
+    Changes are detected by comparing `fingerprint(...)` of the loaded and the to be stored state.
+    Use `skip_unchanged_saves=False` to always save.
+
+    With `lazy_data=True`, the loaded data is only deserialized when a listener accesses `.data`.
+    If nobody did, and the state stayed the same, neither `deserialize` nor `serialize` are called,
+    and the data as loaded is stored again (or, with `skip_unchanged_saves`, not stored at all).
+
+    With a `codec=JsonCodec(compress_threshold=...)` (or any other `StateCodec`), the serialized data is stored as bytes,
+    compressed if large. A `TeleState(..., codec=...)` can use it's own instead.
+    Drivers which can't store bytes (not `supports_bytes`) get it as `{"$codec": "<base64>"}` instead.
+    Data not encoded like that, e.g. stored before there was a codec, is loaded as it is.
+
+    Instead of overriding `serialize` and `deserialize`, states can declare the type of their data,
+    e.g. `TeleState('WIZARD', schema=WizardData)` with a dataclass. See `StateSchema`.
+
+    Updates no listener of any state (or `ALL`) could be called for, e.g. a message without a command
+    if you only have `@command` listeners, are ignored without loading or storing their state at all.
+    Use `skip_unhandled_updates=False` to process them anyway, see `update_filter`.
+
+    If the database driver `supports_versioning`, a state is only saved if nobody else saved one for the same user
+    since it was loaded (e.g. another bot process). Otherwise, the state is loaded again and the listeners run again,
+    up to `conflict_retries` times. So listeners should be fine with running twice for the same update.
+
+    With a `metrics_sink=HistogramMetricsSink()` (or your own `MetricsSink`),
+    the duration of every phase of `process_update` is recorded: loading, deserializing, the listeners, and so on.
+
+    What is logged for every update can be sampled, shortened and redacted with an `update_logger=UpdateLogger(...)`.
+    To find single slow updates, a `slow_update_recorder=SlowUpdateRecorder(threshold=...)` keeps the recent ones,
+    with the duration of their phases and optionally a profile.
     """
     is_registered: bool  # if we did call self.register_teleflask()
     listeners_registered: bool  # if we did call self.register_listeners()
     blueprint: Union[Teleflask, TBlueprint]
     active_state: Union[None, TeleState]
     did_init: bool
+    executor: Union[KeyedUpdateExecutor, None]  # if set, updates get processed in parallel there.
+    skip_unchanged_saves: bool  # if we don't call the database driver's save when neither state nor data changed.
+    saves_performed: int  # how often we did call the database driver's save.
+    saves_skipped: int  # how often we didn't need to call the database driver's save.
+    lazy_data: bool  # if the loaded data is only deserialized when accessed.
+    codec: Union[StateCodec, None]  # if set, encodes the serialized data of the states not having their own `codec`.
+    skip_unhandled_updates: bool  # if we ignore updates no listener could be called for, see `update_filter`.
+    updates_skipped: int  # how many updates were ignored, as no listener could be called for them.
+    conflict_retries: int  # how often an update is processed again, if saving it's state had a version conflict.
+    conflicts: int  # how many version conflicts happened.
+    metrics_sink: Union[MetricsSink, None]  # if set, gets the durations of the phases of processing an update.
+    update_logger: UpdateLogger  # logs the processing of the updates.
+    slow_update_recorder: Union[SlowUpdateRecorder, None]  # if set, keeps the updates taking too long.
+    _update_filter: Union[UpdateFilter, None]  # built on demand, reset if listeners are added.
+    _context_var: ContextVar  # holds the TeleStateContext of the update currently processed.
+    _default_context: TeleStateContext  # used outside of process_update(...)
 
     def __init__(
         self,
         name: str,
-        database_driver: Union[Type[TeleStateDatabaseDriver], TeleStateDatabaseDriver],
-        teleflask_or_tblueprint: Teleflask = None
+        database_driver: Union[TeleStateDatabaseDriver, AsyncTeleStateDatabaseDriver],
+        teleflask_or_tblueprint: Teleflask = None,
+        executor: Union[KeyedUpdateExecutor, None] = None,
+        skip_unchanged_saves: bool = True,
+        lazy_data: bool = False,
+        codec: Union[StateCodec, None] = None,
+        skip_unhandled_updates: bool = True,
+        conflict_retries: int = 3,
+        metrics_sink: Union[MetricsSink, None] = None,
+        update_logger: Union[UpdateLogger, None] = None,
+        slow_update_recorder: Union[SlowUpdateRecorder, None] = None,
     ):
         self.did_init = False
         self.listeners_registered = False
         self.states: Dict[str, TeleState] = {}  # NAME: telestate_instance
-        assert_type_or_raise(database_driver, TeleStateDatabaseDriver, parameter_name='driver')
+        assert_type_or_raise(database_driver, TeleStateDatabaseDriver, AsyncTeleStateDatabaseDriver, parameter_name='driver')
         self.database_driver = database_driver
+        self._async_database_driver = None  # wrapper for a synchronous driver, see self.async_database_driver
+        assert_type_or_raise(executor, KeyedUpdateExecutor, None, parameter_name='executor')
+        self.executor = executor
+        self.skip_unchanged_saves = skip_unchanged_saves
+        self.saves_performed = 0
+        self.saves_skipped = 0
+        self.lazy_data = lazy_data
+        assert_type_or_raise(codec, StateCodec, None, parameter_name='codec')
+        self.codec = codec
+        self.skip_unhandled_updates = skip_unhandled_updates
+        self.updates_skipped = 0
+        self._update_filter = None
+        self.conflict_retries = conflict_retries
+        self.conflicts = 0
+        assert_type_or_raise(metrics_sink, MetricsSink, None, parameter_name='metrics_sink')
+        self.metrics_sink = metrics_sink
+        assert_type_or_raise(update_logger, UpdateLogger, None, parameter_name='update_logger')
+        self.update_logger = update_logger if update_logger is not None else UpdateLogger(logger)
+        assert_type_or_raise(slow_update_recorder, SlowUpdateRecorder, None, parameter_name='slow_update_recorder')
+        self.slow_update_recorder = slow_update_recorder
+        self._stats_lock = threading.Lock()
+        self._context_var = ContextVar(f'{self.__class__.__name__}.context.{name}')
+        self._default_context = TeleStateContext(state=None)
         super(TeleStateMachine, self).__init__()
         if teleflask_or_tblueprint:
             self.blueprint = teleflask_or_tblueprint
@@ -97,7 +190,7 @@ class TeleStateMachine(StartupMixin, TeleflaskMixinBase):
 
         self.DEFAULT = TeleState('DEFAULT', self)
         self.ALL = TeleState('ALL', self)  # so you can register to states.ALL to be called on all the states.
-        self.CURRENT = self.DEFAULT
+        self._default_context.state = self.DEFAULT
         self.did_init = True
     # end def
 
@@ -137,7 +230,7 @@ class TeleStateMachine(StartupMixin, TeleflaskMixinBase):
         # end if
         self.listeners_registered = True
         self.blueprint.on_startup(self.do_startup)
-        self.blueprint.on_update(self.process_update)
+        self.blueprint.on_update(self.dispatch_update)
     # end def
 
     def register_state(self, name, state=None):
@@ -176,7 +269,7 @@ class TeleStateMachine(StartupMixin, TeleflaskMixinBase):
             # don't overwrite the name when setting as current one.
             logger.debug('changing current.')
             state.register_machine(self)
-            object.__setattr__(self, 'CURRENT', state)
+            self.context.state = state
         elif name == 'ALL':
             # we don't add this to the states array.
             logger.debug('setting up ALL.')
@@ -188,23 +281,25 @@ class TeleStateMachine(StartupMixin, TeleflaskMixinBase):
                 state.register_teleflask(self.teleflask)
             # end if
             object.__setattr__(self, 'ALL', state)
+            self.reset_update_filter()
         elif name in self.states:
             logger.debug('adding new, but is existing.')
             if not overwrite:
                 raise ValueError('State {name!r} already existing.'.format(name=name))
             # end if
             if state:
-                logger.debug('Replacing state {!r} with {!r}.'.format(self.states[name], state))
+                logger.debug('Replacing state %r with %r.', self.states[name], state)
                 state.name = name
                 state.register_machine(self, name)
                 self.states[name] = state
             else:
-                logger.debug('Name given only. Replacing state {!r} with new state.'.format(self.states[name]))
+                logger.debug('Name given only. Replacing state %r with new state.', self.states[name])
                 self.states[name] = TeleState(name, self)
             # end def
+            self.reset_update_filter()
             return self.states[name]
         else:
-            logger.debug('State {name!r} does not exist. Adding newly.'.format(name=name))
+            logger.debug('State %r does not exist. Adding newly.', name)
             if not state:  # name given only
                 logger.debug('Name given only. Creating new state.')
                 state = TeleState(name, self)
@@ -216,9 +311,66 @@ class TeleStateMachine(StartupMixin, TeleflaskMixinBase):
             if self.is_registered:
                 state.register_teleflask(self.teleflask)
             # end if
+            self.reset_update_filter()
         # end if
     # end def
 
+    @property
+    def update_filter(self) -> UpdateFilter:
+        """
+        Knows which updates any listener of any of our states or `ALL` could be called for.
+        Built when first needed, and again after states or listeners got added.
+        """
+        update_filter = self._update_filter
+        if update_filter is None:
+            states = {id(state): state for state in self.states.values()}
+            if hasattr(self, 'ALL'):
+                states[id(self.ALL)] = self.ALL
+            # end if
+            update_filter = UpdateFilter(state.update_handler for state in states.values())
+            self._update_filter = update_filter
+        # end if
+        return update_filter
+    # end def
+
+    def reset_update_filter(self):
+        """
+        Makes the `update_filter` get rebuilt, as listeners were added.
+        That happens automatically for listeners added with the decorators of a state,
+        call this if you add them to a state's `update_handler` directly.
+        This also makes the `dispatch_table` of every state's `update_handler` get compiled again.
+        """
+        self._update_filter = None
+        for state in list(self.states.values()) + ([self.ALL] if hasattr(self, 'ALL') else []):
+            if state.update_handler is not None:
+                state.update_handler.reset_dispatch_table()
+            # end if
+        # end for
+    # end def
+
+    def _is_unhandled(self, update) -> bool:
+        """
+        Checks if no listener could be called for the update, so we don't need to process it.
+        Such updates are counted in `updates_skipped`.
+
+        :param update: The Telegram update, either a `pytgbot` `Update`, or the raw json dict.
+
+        :return: If the update should be skipped.
+        """
+        if not self.skip_unhandled_updates:
+            return False
+        # end if
+        update_filter = self.update_filter
+        if update_filter.matches_dict(update) if isinstance(update, dict) else update_filter.matches(update):
+            return False
+        # end if
+        with self._stats_lock:
+            self.updates_skipped += 1
+        # end with
+        logger.debug('No listener for the update, skipping it.')
+        return True
+    # end def
+
     def __getattr__(self, name):
         logger.debug(name)
         if can_be_name(name) and name in self.states:
@@ -249,6 +401,44 @@ class TeleStateMachine(StartupMixin, TeleflaskMixinBase):
 
     __str__ = __repr__
 
+    @property
+    def context(self) -> TeleStateContext:
+        """
+        The context of the update currently processed in this thread (or asyncio task),
+        holding the current state, it's data and the update.
+        Outside of `process_update(...)` a shared default context is used.
+
+        :return: the currently active context.
+        """
+        return self._context_var.get(self._default_context)
+    # end def
+
+    @property
+    def CURRENT(self) -> TeleState:
+        """
+        The currently active state, for the update currently processed.
+        """
+        return self.context.state
+    # end def
+
+    @contextmanager
+    def _isolated_context(self, chat_id: Union[int, str, None] = None, user_id: Union[int, str, None] = None):
+        """
+        Provides a fresh `TeleStateContext` for the duration of the `with` block,
+        so different threads or asyncio tasks don't see each other's `CURRENT` state.
+
+        :param chat_id: ID of the user/group chat the state will be loaded for.
+        :param user_id: ID of the user the state will be loaded for.
+        """
+        context = TeleStateContext(state=self.DEFAULT, chat_id=chat_id, user_id=user_id)
+        token = self._context_var.set(context)
+        try:
+            yield context
+        finally:
+            self._context_var.reset(token)
+        # end try
+    # end def
+
     def set(
         self,
         state: Union[TeleState, str, None],
@@ -266,9 +456,9 @@ class TeleStateMachine(StartupMixin, TeleflaskMixinBase):
 
         :return: The new current state, i.e. the one you just applied.
         """
-        logger.debug('going to set state {!r}'.format(state))
-        logger.debug('got state data: {!r}'.format(data))
-        logger.debug('got update meta: {!r}'.format(update))
+        logger.debug('going to set state %r', state)
+        logger.debug('got state data: %r', data)
+        logger.debug('got update meta: %r', update)
         assert_type_or_raise(state, str, TeleState, None, parameter_name='state')
         if isinstance(state, TeleState):
             if state.name not in self.states:
@@ -286,43 +476,487 @@ class TeleStateMachine(StartupMixin, TeleflaskMixinBase):
         # end if
 
         # check if we need to keep any previous update/user data.
+        context = self.context
         if update == KEEP_PREVIOUS:
-            if self.CURRENT and self.CURRENT.update:
+            if context.state and context.update:
                 # keep the old update around if we don't specify a new one.
-                update = self.CURRENT.update
+                update = context.update
             else:
                 raise ValueError('Could not KEEP_PREVIOUS update, as there is no current update set.')
         # end def
-        if data == KEEP_PREVIOUS and self.CURRENT:
+        if data == KEEP_PREVIOUS and context.state:
             # keep the old data around if we don't specify a new one.
-            data = self.CURRENT.data
+            data = context.data
         # end def
 
-        # so we have the new or old data now in variables, release the old state's data
-        self.CURRENT.set_update(None)
-        self.CURRENT.set_data(None)
         # now we switch the CURRENT state to be the sate we want
         self._register_state('CURRENT', state, allow_setting_defaults=True)
-        # and apply the new update/user data.
-        self.CURRENT.set_data(data)
-        self.CURRENT.set_update(update)
+        # and apply the new update/user data, replacing the old state's one.
+        context.data = data
+        context.update = update
         # for good measure we return the choosen state as well.
-        return self.CURRENT
+        return context.state
+    # end def
+
+    def dispatch_update(self, update):
+        """
+        Processes the update, either directly, or - if we have an `executor` - by submitting it to the thread pool.
+        This is the function listening for updates of the teleflask instance.
+        Note, when processing in parallel a `AbortProcessingPlease` can't stop the other teleflask listeners any longer,
+        and as nobody waits for the result, errors (e.g. of the database driver) are only logged.
+
+        :param update: The Telegram update
+        :type  update: pytgbot.api_types.receivable.updates.Update
+        """
+        if self.executor is None:
+            return self.process_update(update)
+        # end if
+        future = self.submit_update(update)
+        future.add_done_callback(lambda done: self._log_failed_update(update, done))
+    # end def
+
+    @staticmethod
+    def _log_failed_update(update, future):
+        """
+        Logs the exception of an update processed on the `executor`, if it failed.
+
+        :param update: The Telegram update
+        :param future: The future of processing it, as returned by `submit_update(...)`.
+        """
+        if future.cancelled():
+            return
+        # end if
+        e = future.exception()
+        if e is None or isinstance(e, AbortProcessingPlease):
+            return
+        # end if
+        update_id = update.get('update_id') if isinstance(update, dict) else getattr(update, 'update_id', None)
+        logger.error(f'Processing update {update_id!r} failed.', exc_info=(type(e), e, e.__traceback__))
+    # end def
+
+    def submit_update(self, update):
+        """
+        Schedules the update to be processed on the `executor`'s thread pool.
+        Updates sharing the same `(chat_id, user_id)` key are processed in the order they are submitted.
+
+        :param update: The Telegram update
+        :type  update: pytgbot.api_types.receivable.updates.Update
+
+        :return: A future resolving once the update was processed.
+        :rtype: concurrent.futures.Future
+        """
+        if self.executor is None:
+            raise ValueError('No executor set, can\'t process updates in parallel.')
+        # end if
+        key = self.update_get_chat_and_user(update)
+        return self.executor.submit(key, self.process_update, update)
     # end def
 
     def process_update(self, update):
+        """
+        Loads the state for the update's chat and user, runs the current state's and the `ALL` state's listeners,
+        and saves the resulting state again.
+
+        Every call gets it's own `TeleStateContext` (see `self.context`),
+        so calling this from different threads in parallel does not mix up states.
+
+        :param update: The Telegram update
+        :type  update: pytgbot.api_types.receivable.updates.Update
+        """
+        if isinstance(self.database_driver, AsyncTeleStateDatabaseDriver):
+            raise TypeError('The database driver is asynchronous, use `await process_update_async(update)` instead.')
+        # end if
+        if self._is_unhandled(update):
+            return
+        # end if
+        measuring = self._measuring
+        start = time.perf_counter() if measuring else 0.0
         chat_id, user_id = self.update_get_chat_and_user(update)
-        state_name, state_data = self.database_driver.load_state_for_chat_user(chat_id, user_id)
-        logger.info(
-            f"Loading state {state_name!r} for user {user_id!r} in chat {chat_id!r}.\n"
-            f"Data: {pformat(state_data)}"
-        )
+        with self._isolated_context(chat_id, user_id) as context:
+            self.update_logger.begin(context)
+            if not measuring:
+                self._process_update_in_context(update, chat_id, user_id)
+                return
+            # end if
+            context.timings = {}
+            self._add_timing(context.timings, 'key', start)
+            profiler = self.slow_update_recorder.start_profile() if self.slow_update_recorder is not None else None
+            try:
+                self._process_update_in_context(update, chat_id, user_id)
+            finally:
+                self._finish_measuring(context, start, update, profiler)
+            # end try
+        # end with
+    # end def
+
+    def process_raw_update(self, raw_update: dict):
+        """
+        Like `process_update(...)`, but for an update as the json dict telegram sends, e.g. in a webhook.
+
+        The chat and user are looked up in the dict directly,
+        and the `pytgbot` `Update` object is only built if the current state or the `ALL` state has listeners at all.
+        So updates no state cares about don't pay for constructing it.
+
+        :param raw_update: The Telegram update, as parsed json.
+        :type  raw_update: dict
+        """
+        if isinstance(self.database_driver, AsyncTeleStateDatabaseDriver):
+            raise TypeError('The database driver is asynchronous, use `await process_update_async(update)` instead.')
+        # end if
+        assert_type_or_raise(raw_update, dict, parameter_name='raw_update')
+        if self._is_unhandled(raw_update):
+            return
+        # end if
+        measuring = self._measuring
+        start = time.perf_counter() if measuring else 0.0
+        chat_id, user_id = self.update_dict_get_chat_and_user(raw_update)
+        with self._isolated_context(chat_id, user_id) as context:
+            self.update_logger.begin(context)
+            if not measuring:
+                self._process_update_in_context(raw_update, chat_id, user_id)
+                return
+            # end if
+            context.timings = {}
+            self._add_timing(context.timings, 'key', start)
+            profiler = self.slow_update_recorder.start_profile() if self.slow_update_recorder is not None else None
+            try:
+                self._process_update_in_context(raw_update, chat_id, user_id)
+            finally:
+                self._finish_measuring(context, start, raw_update, profiler)
+            # end try
+        # end with
+    # end def
+
+    def _process_update_in_context(self, update, chat_id, user_id):
+        timings = self.context.timings
+        attempt = 0
+        while True:
+            try:
+                with self.database_driver.session(chat_id, user_id):
+                    start = time.perf_counter() if timings is not None else 0.0
+                    state_name, state_data, version = self.database_driver.load_state_versioned(chat_id, user_id)
+                    if timings is not None:
+                        self._add_timing(timings, 'load', start)
+                    # end if
+                    self._activate_loaded_state(update, chat_id, user_id, state_name, state_data)
+                    handler_update = self._update_for_handlers(update)
+                    abort_e = self._run_update_handlers(handler_update) if handler_update is not None else None
+                    state_name, state_data = self._serialize_current_state(chat_id, user_id)
+                    if self._needs_save(state_name, state_data):
+                        start = time.perf_counter() if timings is not None else 0.0
+                        self.database_driver.save_state_versioned(chat_id, user_id, state_name, state_data, version)
+                        if timings is not None:
+                            self._add_timing(timings, 'save', start)
+                        # end if
+                    # end if
+                # end with
+            except StateVersionConflict:
+                attempt += 1
+                if not self._should_retry_conflict(attempt, chat_id, user_id):
+                    raise
+                # end if
+                continue
+            # end try
+            break
+        # end while
+        if abort_e:
+            logger.debug('Re-raising AbortProcessingPlease exception.')
+            raise abort_e  # re-raise so we don't process other stuff afterwards.
+        # end if
+    # end def
+
+    def process_updates(self, updates):
+        """
+        Processes a batch of updates (e.g. the result of a `getUpdates` call),
+        loading all the needed states with a single `database_driver.load_states_bulk(...)` call.
+
+        The updates of every user are processed in the given order,
+        a later update of the same user in the same chat sees the state the previous one left.
+        A `AbortProcessingPlease` only stops processing of the update raising it.
+        The updates can also be the json dicts telegram sends, like for `process_raw_update(...)`.
+
+        If the database driver `supports_versioning`, the versions are loaded as well (`load_states_versioned_bulk(...)`),
+        and the updates of every user are processed within the driver's `session(...)`,
+        storing their state with `save_state_versioned(...)`.
+        On a `StateVersionConflict` only that user's state is loaded again, and their updates processed again,
+        up to `conflict_retries` times. If it still fails, the other users are processed nevertheless,
+        and the `StateVersionConflict` is raised afterwards.
+
+        Otherwise, all the changed states are stored with a single `save_states_bulk(...)` call at the end.
+        That can't notice other processes storing the same states in the meantime: the last save wins.
+        If that call fails, every state is saved on it's own, so only the ones failing again are lost (and logged),
+        and the first of those errors is raised afterwards.
+
+        :param updates: The Telegram updates
+        :type  updates: list of pytgbot.api_types.receivable.updates.Update | list of dict
+        """
+        if isinstance(self.database_driver, AsyncTeleStateDatabaseDriver):
+            raise TypeError('The database driver is asynchronous, use `await process_update_async(update)` instead.')
+        # end if
+        keyed_updates = {}  # (chat_id, user_id): updates, in order of their first update.
+        for update in updates:
+            if self._is_unhandled(update):
+                continue
+            # end if
+            if isinstance(update, dict):
+                key = self.update_dict_get_chat_and_user(update)
+            else:
+                key = self.update_get_chat_and_user(update)
+            # end if
+            keyed_updates.setdefault(key, []).append(update)
+        # end for
+        if not keyed_updates:
+            return
+        # end if
+        if self.database_driver.supports_versioning:
+            self._process_updates_versioned(keyed_updates)
+            return
+        # end if
+        states = self.database_driver.load_states_bulk(set(keyed_updates))
+        dirty = []  # (chat_id, user_id, state_name, state_data) to be saved.
+        for key, key_updates in keyed_updates.items():
+            state_name, state_data = states.get(key, (None, None))
+            state_name, state_data, needs_save = self._process_loaded_updates(key, key_updates, state_name, state_data)
+            if needs_save:
+                dirty.append((*key, state_name, state_data))
+            # end if
+        # end for
+        if dirty:
+            self._save_states_bulk(dirty)
+        # end if
+    # end def
+
+    def _save_states_bulk(self, dirty: List[StateItem]):
+        """
+        Stores the states with `save_states_bulk(...)`, or one by one if that fails.
+
+        :param dirty: The `(chat_id, user_id, state_name, state_data)` to store.
+        """
+        try:
+            self.database_driver.save_states_bulk(dirty)
+            return
+        except Exception:
+            logger.exception(f'Saving {len(dirty)} states at once failed, saving them one by one.')
+        # end try
+        error = None
+        for chat_id, user_id, state_name, state_data in dirty:
+            try:
+                self.database_driver.save_state_for_chat_user(chat_id, user_id, state_name, state_data)
+            except Exception as e:
+                logger.exception(
+                    f"Saving the state of chat {chat_id!r} and user {user_id!r} failed:\n"
+                    f"Lost state: {state_name}\n"
+                    f"Lost data: {state_data!r}"
+                )
+                error = error or e
+            # end try
+        # end for
+        if error is not None:
+            raise error
+        # end if
+    # end def
+
+    def _process_updates_versioned(self, keyed_updates: Dict[Tuple[Any, Any], list]):
+        """
+        The part of `process_updates(...)` for a database driver which `supports_versioning`.
+
+        :param keyed_updates: The updates of every `(chat_id, user_id)`.
+        """
+        states = self.database_driver.load_states_versioned_bulk(list(keyed_updates))
+        conflict = None
+        for key, key_updates in keyed_updates.items():
+            chat_id, user_id = key
+            state_name, state_data, version = states.get(key, (None, None, None))
+            attempt = 0
+            while True:
+                try:
+                    with self.database_driver.session(chat_id, user_id):
+                        if attempt:
+                            state_name, state_data, version = self.database_driver.load_state_versioned(chat_id, user_id)
+                        # end if
+                        new_name, new_data, needs_save = self._process_loaded_updates(key, key_updates, state_name, state_data)
+                        if needs_save:
+                            self.database_driver.save_state_versioned(chat_id, user_id, new_name, new_data, version)
+                        # end if
+                    # end with
+                except StateVersionConflict as e:
+                    attempt += 1
+                    if self._should_retry_conflict(attempt, chat_id, user_id):
+                        continue
+                    # end if
+                    conflict = conflict or e
+                # end try
+                break
+            # end while
+        # end for
+        if conflict is not None:
+            raise conflict
+        # end if
+    # end def
+
+    def _process_loaded_updates(self, key: Tuple[Any, Any], updates: list, state_name, state_data):
+        """
+        Processes updates of the same chat and user one after another, starting with an already loaded state.
+        Every update gets it's own context, and is measured like in `process_update(...)`.
+
+        :param key: The `(chat_id, user_id)` of the updates.
+        :param updates: The Telegram updates, `pytgbot` `Update`s or json dicts.
+        :param state_name: The name of the state, as loaded from the database driver.
+        :param state_data: The data of the state, as loaded from the database driver.
+
+        :return: Tuple of the name and the serialized data of the state after the last update, and if it needs to be saved.
+        """
+        chat_id, user_id = key
+        needs_save = False
+        for update in updates:
+            measuring = self._measuring
+            start = time.perf_counter() if measuring else 0.0
+            with self._isolated_context(chat_id, user_id) as context:
+                self.update_logger.begin(context)
+                profiler = None
+                if measuring:
+                    context.timings = {}
+                    profiler = self.slow_update_recorder.start_profile() if self.slow_update_recorder is not None else None
+                # end if
+                try:
+                    self._activate_loaded_state(update, chat_id, user_id, state_name, state_data)
+                    handler_update = self._update_for_handlers(update)
+                    abort_e = self._run_update_handlers(handler_update) if handler_update is not None else None
+                    if abort_e:
+                        logger.debug('Update asked to abort (AbortProcessingPlease), continuing with the next one.')
+                    # end if
+                    state_name, state_data = self._serialize_current_state(chat_id, user_id)
+                    if self._needs_save(state_name, state_data):
+                        needs_save = True
+                    # end if
+                finally:
+                    if measuring:
+                        self._finish_measuring(context, start, update, profiler)
+                    # end if
+                # end try
+            # end with
+        # end for
+        return state_name, state_data, needs_save
+    # end def
+
+    async def process_update_async(self, update):
+        """
+        Like `process_update(...)`, but awaiting the database driver and listener functions being `async def`.
+
+        If the `database_driver` is a normal (synchronous) `TeleStateDatabaseDriver`,
+        it's calls will be run in the event loop's default executor, see `AsyncDatabaseDriverAdapter`.
+
+        :param update: The Telegram update
+        :type  update: pytgbot.api_types.receivable.updates.Update
+        """
+        if self._is_unhandled(update):
+            return
+        # end if
+        measuring = self._measuring
+        start = time.perf_counter() if measuring else 0.0
+        chat_id, user_id = self.update_get_chat_and_user(update)
+        with self._isolated_context(chat_id, user_id) as context:
+            context.awaitables = []  # listeners being coroutines will be collected there.
+            self.update_logger.begin(context)
+            if not measuring:
+                await self._process_update_in_context_async(update, chat_id, user_id)
+                return
+            # end if
+            context.timings = {}
+            self._add_timing(context.timings, 'key', start)
+            try:
+                await self._process_update_in_context_async(update, chat_id, user_id)
+            finally:
+                self._finish_measuring(context, start, update)
+            # end try
+        # end with
+    # end def
+
+    async def _process_update_in_context_async(self, update, chat_id, user_id):
+        database_driver = self.async_database_driver
+        timings = self.context.timings
+        attempt = 0
+        while True:
+            try:
+                start = time.perf_counter() if timings is not None else 0.0
+                state_name, state_data, version = await database_driver.load_state_versioned(chat_id, user_id)
+                if timings is not None:
+                    self._add_timing(timings, 'load', start)
+                # end if
+                self._activate_loaded_state(update, chat_id, user_id, state_name, state_data)
+                abort_e = await self._run_update_handlers_async(update)
+                state_name, state_data = self._serialize_current_state(chat_id, user_id)
+                if self._needs_save(state_name, state_data):
+                    start = time.perf_counter() if timings is not None else 0.0
+                    await database_driver.save_state_versioned(chat_id, user_id, state_name, state_data, version)
+                    if timings is not None:
+                        self._add_timing(timings, 'save', start)
+                    # end if
+                # end if
+            except StateVersionConflict:
+                attempt += 1
+                if not self._should_retry_conflict(attempt, chat_id, user_id):
+                    raise
+                # end if
+                continue
+            # end try
+            break
+        # end while
+        if abort_e:
+            logger.debug('Re-raising AbortProcessingPlease exception.')
+            raise abort_e  # re-raise so we don't process other stuff afterwards.
+        # end if
+    # end def
+
+    @property
+    def async_database_driver(self) -> AsyncTeleStateDatabaseDriver:
+        """
+        The `database_driver`, usable with `await`.
+        A synchronous driver will be wrapped in an `AsyncDatabaseDriverAdapter`.
+        """
+        if isinstance(self.database_driver, AsyncTeleStateDatabaseDriver):
+            return self.database_driver
+        # end if
+        if self._async_database_driver is None:
+            self._async_database_driver = AsyncDatabaseDriverAdapter(self.database_driver)
+        # end if
+        return self._async_database_driver
+    # end def
+
+    def _activate_loaded_state(self, update, chat_id, user_id, state_name, state_data):
+        """
+        Deserializes the data as loaded from the database (unless `lazy_data`), and sets the state as `CURRENT`.
+
+        :param update: The Telegram update
+        :param chat_id: ID of the user/group chat.
+        :param user_id: ID of the user.
+        :param state_name: The name of the state, as loaded from the database driver.
+        :param state_data: The data of the state, as loaded from the database driver.
+        """
+        self.update_logger.log_state(self.context, 'Loading', state_name, state_data)
+        loaded_fingerprint = None
+        if self.skip_unchanged_saves and not self.lazy_data:
+            loaded_fingerprint = self.fingerprint(state_name, state_data)
+        # end if
         if state_name is None:
             state_name = "DEFAULT"
         # end if
-        abort_e = None
+        if self.lazy_data:
+            # the fingerprint is calculated as well, if the data is ever accessed. See `_deserialize_loaded_data(...)`.
+            self.set(state_name, data=NOT_DESERIALIZED, update=None if isinstance(update, dict) else update)
+            assert self.CURRENT.name == state_name
+            self.context.loaded_fingerprint = None
+            self.context.loaded_state_name = state_name
+            self.context.loaded_data = state_data
+            return
+        # end if
+        timings = self.context.timings
+        start = time.perf_counter() if timings is not None else 0.0
         try:
-            state_data = self.deserialize(state_name, state_data)
+            state_data = self._deserialize_state_data(state_name, state_data)
+            if timings is not None:
+                self._add_timing(timings, 'deserialize', start)
+            # end if
         except:
             # resets state, make sure we can still function at all.
             logger.exception(
@@ -332,59 +966,453 @@ class TeleStateMachine(StartupMixin, TeleflaskMixinBase):
             )
             state_name, state_data = None, None
         # end try
-        self.set(state_name, data=state_data, update=update)
+        self.set(state_name, data=state_data, update=None if isinstance(update, dict) else update)
         assert self.CURRENT.name == state_name or (state_name is None and self.CURRENT.name == "DEFAULT")
+        self.context.loaded_fingerprint = loaded_fingerprint
+        self.context.loaded_state_name = self.CURRENT.name
+    # end def
+
+    def _deserialize_loaded_data(self, context: TeleStateContext) -> Union[Any, None]:
+        """
+        Deserializes the data of a state loaded with `lazy_data=True`, when it is first accessed.
+        If `deserialize` fails, the state is reset to DEFAULT, like when loading it eagerly.
+
+        :param context: The context whose `data` is still `NOT_DESERIALIZED`.
+
+        :return: The deserialized data, which is now the context's `data`. `None` if it was reset.
+        """
+        state_name, state_data = context.loaded_state_name, context.loaded_data
+        if self.skip_unchanged_saves:
+            context.loaded_fingerprint = self.fingerprint(state_name, state_data)
+        # end if
+        timings = context.timings
+        start = time.perf_counter() if timings is not None else 0.0
+        try:
+            data = self._deserialize_state_data(state_name, state_data)
+            if timings is not None:
+                self._add_timing(timings, 'deserialize', start)
+            # end if
+        except:
+            # resets state, make sure we can still function at all.
+            logger.exception(
+                "Error in deserialize, resetting state to DEFAULT (None):\n"
+                f"Old state: {state_name}\n"
+                f"Lost data: {state_data!r}"
+            )
+            context.loaded_data = None
+            self.set(None, data=None, update=context.update)
+            return None
+        # end try
+        context.data = data
+        context.loaded_data = None
+        return data
+    # end def
+
+    def _deserialize_state_data(self, state_name: str, db_data: Union[JSONType, bytes]) -> Any:
+        """
+        Decodes the data as loaded from the database, and creates the state's `schema` from it,
+        or calls `deserialize(...)` if it has none.
+
+        :param state_name: The name of the state.
+        :param db_data: The data, as loaded by the database driver.
+
+        :return: The data for `STATE.data`.
+        """
+        state_data = self._decode_state_data(state_name, db_data)
+        state = self.states.get(state_name)
+        if state is not None and state.schema is not None:
+            return state.schema.decode(state_data)
+        # end if
+        return self.deserialize(state_name, state_data)
+    # end def
+
+    def _serialize_state_data(self, state_name: str, state_data: Any) -> Union[JSONType, bytes]:
+        """
+        Turns the data into a `dict` with the state's `schema`, or calls `serialize(...)` if it has none,
+        and encodes that.
+
+        :param state_name: The name of the state.
+        :param state_data: The data of the state, i.e. `STATE.data`.
+
+        :return: The data to give to the database driver.
+        """
+        state = self.states.get(state_name)
+        if state is not None and state.schema is not None:
+            return self._encode_state_data(state_name, state.schema.encode(state_data))
+        # end if
+        return self._encode_state_data(state_name, self.serialize(state_name, state_data))
+    # end def
+
+    def _codec_for(self, state_name: str) -> Union[StateCodec, None]:
+        """
+        :return: The codec of that state, or the machine's `codec` if it has none.
+        """
+        state = self.states.get(state_name)
+        if state is not None and state.codec is not None:
+            return state.codec
+        # end if
+        return self.codec
+    # end def
+
+    def _encode_state_data(self, state_name: str, state_data: JSONType) -> Union[JSONType, bytes]:
+        """
+        Encodes the serialized data with the `codec` of the state, if there is one.
+
+        :param state_name: The name of the state.
+        :param state_data: The data, as returned by `serialize(...)`.
+
+        :return: The data to give to the database driver.
+        """
+        codec = self._codec_for(state_name)
+        if codec is None or state_data is None:
+            return state_data
+        # end if
+        encoded = codec.encode(state_data)
+        if not self.database_driver.supports_bytes:
+            return {CODEC_KEY: base64.b64encode(encoded).decode('ascii')}
+        # end if
+        return encoded
+    # end def
+
+    def _decode_state_data(self, state_name: str, db_data: Union[JSONType, bytes]) -> JSONType:
+        """
+        Decodes the data as loaded from the database with the `codec` of the state, if there is one.
+        Data not encoded by a codec, e.g. stored before there was one, is returned unchanged.
+
+        :param state_name: The name of the state.
+        :param db_data: The data, as loaded by the database driver.
+
+        :return: The data to give to `deserialize(...)`.
+        """
+        codec = self._codec_for(state_name)
+        if codec is None:
+            return db_data
+        # end if
+        if isinstance(db_data, dict) and len(db_data) == 1 and isinstance(db_data.get(CODEC_KEY), str):
+            # encoded for a driver not supporting bytes.
+            db_data = base64.b64decode(db_data[CODEC_KEY])
+            if not codec.is_encoded(db_data):
+                raise ValueError(f'The {CODEC_KEY!r} value was not encoded by a codec.')
+            # end if
+        # end if
+        if codec.is_encoded(db_data):
+            return codec.decode(db_data)
+        # end if
+        return db_data
+    # end def
+
+    def _update_for_handlers(self, update) -> Union[TGUpdate, None]:
+        """
+        Builds the `pytgbot` `Update` of a raw update (see `process_raw_update(...)`) for the listeners,
+        but only if the current state or the `ALL` state has any listeners.
+
+        :param update: The Telegram update, either a `pytgbot` `Update`, or the raw json dict.
+
+        :return: The `Update` to run the listeners with, or `None` if there's nothing to run.
+        """
+        if not isinstance(update, dict):
+            return update
+        # end if
+        current_handler, all_handler = self.CURRENT.update_handler, self.ALL.update_handler
+        if not (
+            (current_handler is not None and current_handler.has_listeners) or
+            (all_handler is not None and all_handler.has_listeners)
+        ):
+            self.update_logger.debug(self.context, 'No listeners for state %s, not building the update.', self.CURRENT.name)
+            return None
+        # end if
+        update = TGUpdate.from_array(update)
+        self.context.update = update
+        return update
+    # end def
+
+    @staticmethod
+    def _add_timing(timings: Dict[str, float], phase: str, start: float) -> float:
+        """
+        Adds the time since `start` to the phase. Phases repeated (e.g. on a version conflict) add up.
+
+        :param timings: Dict of the phase to the seconds it took.
+        :param phase: One of `metrics.PHASES`.
+        :param start: `time.perf_counter()` at the start of the phase.
+
+        :return: the current `time.perf_counter()`, to be used as start of the next phase.
+        """
+        now = time.perf_counter()
+        timings[phase] = timings.get(phase, 0.0) + (now - start)
+        return now
+    # end def
+
+    @property
+    def _measuring(self) -> bool:
+        """
+        :return: If we need to time processing the updates,
+                 for the `metrics_sink`, the `slow_update_recorder` or the `update_logger`'s `slow_threshold`.
+        """
+        return (
+            self.metrics_sink is not None or self.slow_update_recorder is not None or
+            self.update_logger.slow_threshold is not None
+        )
+    # end def
+
+    def _finish_measuring(self, context: TeleStateContext, start: float, update, profiler=None):
+        """
+        Hands the phase durations of a processed update to the `metrics_sink` and the `slow_update_recorder`,
+        and the total to the `update_logger`.
+        A failing sink is logged, but doesn't fail processing the update.
+
+        :param context: The context of the processed update, with it's `timings`.
+        :param start: `time.perf_counter()` at the start of processing the update.
+        :param update: The Telegram update, either a `pytgbot` `Update`, or the raw json dict.
+        :param profiler: The profiler started by the `slow_update_recorder`, if any.
+        """
+        timings = context.timings
+        self._add_timing(timings, 'total', start)
+        if self.metrics_sink is not None:
+            # noinspection PyBroadException
+            try:
+                self.metrics_sink.record_update(timings)
+            except:
+                logger.exception('Recording the metrics failed.')
+            # end try
+        # end if
+        if context.log_records is not None:
+            self.update_logger.end(context, timings['total'])
+        # end if
+        if self.slow_update_recorder is not None:
+            self.slow_update_recorder.finish(
+                timings['total'], timings,
+                update.get('update_id') if isinstance(update, dict) else getattr(update, 'update_id', None),
+                context.chat_id, context.user_id,
+                context.loaded_state_name, context.state.name if context.state else None, profiler,
+            )
+        # end if
+    # end def
+
+    def _should_retry_conflict(self, attempt: int, chat_id, user_id) -> bool:
+        """
+        Counts a version conflict, and checks if we have retries left to process the update again.
+
+        :param attempt: How many conflicts this update had, including the current one.
+        :param chat_id: ID of the user/group chat.
+        :param user_id: ID of the user.
+
+        :return: If the update should be processed again.
+        """
+        with self._stats_lock:
+            self.conflicts += 1
+        # end with
+        if attempt > self.conflict_retries:
+            logger.warning(f'State of user {user_id!r} in chat {chat_id!r} changed while processing, giving up after {attempt} attempts.')
+            return False
+        # end if
+        logger.info(f'State of user {user_id!r} in chat {chat_id!r} changed while processing, processing the update again.')
+        return True
+    # end def
+
+    def _needs_save(self, state_name: Union[str, None], state_data: JSONType) -> bool:
+        """
+        Checks if the serialized state differs from the one loaded at the start of processing the update,
+        and counts the performed or skipped saves.
+
+        :param state_name: The name of the state, as it would be stored.
+        :param state_data: The serialized data of the state, as it would be stored.
+
+        :return: If the database driver needs to store it.
+        """
+        context = self.context
+        loaded_fingerprint = context.loaded_fingerprint
+        if context.data is NOT_DESERIALIZED and state_name == context.loaded_state_name:
+            # with lazy_data, nobody even looked at the data.
+            needs_save = not self.skip_unchanged_saves
+        else:
+            needs_save = (
+                not self.skip_unchanged_saves or loaded_fingerprint is None or
+                loaded_fingerprint != self.fingerprint(state_name, state_data)
+            )
+        # end if
+        with self._stats_lock:
+            if needs_save:
+                self.saves_performed += 1
+            else:
+                self.saves_skipped += 1
+            # end if
+        # end with
+        if not needs_save:
+            self.update_logger.debug(self.context, 'State %r unchanged, skipping save.', state_name)
+        # end if
+        return needs_save
+    # end def
+
+    def _run_update_handlers(self, update) -> Union[AbortProcessingPlease, None]:
+        """
+        Runs the listeners of the current state, and afterwards the ones of the `ALL` state.
+
+        :param update: The Telegram update
+        :return: The `AbortProcessingPlease` exception, if a listener requested that.
+        """
         current: TeleState = self.CURRENT  # to suppress race-conditions of the logging exception and setting of states.
-        logger.debug('Got update for state {}.'.format(current.name))
+        context = self.context
+        self.update_logger.debug(context, 'Got update for state %s.', current.name)
+        timings = context.timings
         # noinspection PyBroadException
         try:
+            start = time.perf_counter() if timings is not None else 0.0
+            parsed = ParsedUpdate(update)  # shared by the current state and ALL.
             # noinspection PyBroadException
             try:
-                current.update_handler.process_update(update)
+                current.update_handler.process_update(update, parsed)
             except AbortProcessingPlease as abort_e:
                 logger.debug('Should abort (AbortProcessingPlease), via state\'s process_update(...).', exc_info=True)
                 raise abort_e
             except:
                 logger.exception(f'Update processing for state {current.name} failed.')
+            finally:
+                if timings is not None:
+                    start = self._add_timing(timings, 'state_handler', start)
+                # end if
             # end try
 
             # ok, so we can still continue, as we had no AbortProcessingPlease.
             # noinspection PyBroadException
             try:
-                self.ALL.update_handler.process_update(update)
+                self.ALL.update_handler.process_update(update, parsed)
             except AbortProcessingPlease as abort_e:
                 logger.debug('Should abort (AbortProcessingPlease), via ALL\'s process_update(...).', exc_info=True)
                 raise abort_e
             except:
                 logger.exception('Update processing for special (always active) ALL state failed.')
+            finally:
+                if timings is not None:
+                    self._add_timing(timings, 'all_handler', start)
+                # end if
             # end try
         except AbortProcessingPlease as e:
-            abort_e = e
-        else:
-            abort_e = None
+            return e
+        # end try
+        return None
+    # end def
+
+    async def _run_update_handlers_async(self, update) -> Union[AbortProcessingPlease, None]:
+        """
+        Like `_run_update_handlers(...)`, but awaits listener functions being `async def`,
+        before continuing with the next state.
+
+        :param update: The Telegram update
+        :return: The `AbortProcessingPlease` exception, if a listener requested that.
+        """
+        current: TeleState = self.CURRENT  # to suppress race-conditions of the logging exception and setting of states.
+        context = self.context
+        self.update_logger.debug(context, 'Got update for state %s.', current.name)
+        timings = context.timings
+        # noinspection PyBroadException
+        try:
+            start = time.perf_counter() if timings is not None else 0.0
+            parsed = ParsedUpdate(update)  # shared by the current state and ALL.
+            # noinspection PyBroadException
+            try:
+                current.update_handler.process_update(update, parsed)
+                await self._await_listeners()
+            except AbortProcessingPlease as abort_e:
+                logger.debug('Should abort (AbortProcessingPlease), via state\'s process_update(...).', exc_info=True)
+                raise abort_e
+            except:
+                logger.exception(f'Update processing for state {current.name} failed.')
+            finally:
+                if timings is not None:
+                    start = self._add_timing(timings, 'state_handler', start)
+                # end if
+            # end try
+
+            # ok, so we can still continue, as we had no AbortProcessingPlease.
+            # noinspection PyBroadException
+            try:
+                self.ALL.update_handler.process_update(update, parsed)
+                await self._await_listeners()
+            except AbortProcessingPlease as abort_e:
+                logger.debug('Should abort (AbortProcessingPlease), via ALL\'s process_update(...).', exc_info=True)
+                raise abort_e
+            except:
+                logger.exception('Update processing for special (always active) ALL state failed.')
+            finally:
+                if timings is not None:
+                    self._add_timing(timings, 'all_handler', start)
+                # end if
+            # end try
+        except AbortProcessingPlease as e:
+            return e
         # end try
+        return None
+    # end def
+
+    async def _await_listeners(self):
+        """
+        Awaits the coroutines returned by `async def` listener functions, in the order they were called,
+        and sends their results.
+
+        :raises AbortProcessingPlease: If a listener requested that. Remaining coroutines are closed.
+        """
+        awaitables = self.context.awaitables
+        while awaitables:
+            state, update, awaitable = awaitables.pop(0)
+            # noinspection PyBroadException
+            try:
+                result = await awaitable
+            except AbortProcessingPlease as e:
+                logger.debug('Asked to stop processing updates.')
+                if e.return_value:
+                    state.process_result(update, e.return_value)
+                # end if
+                for _, _, skipped in awaitables:
+                    if inspect.iscoroutine(skipped):
+                        skipped.close()
+                    # end if
+                # end for
+                awaitables.clear()
+                raise e
+            except:
+                logger.exception(f'Error executing the async listener of state {state.name}.')
+            else:
+                state.process_result(update, result)
+            # end try
+        # end while
+    # end def
+
+    def _serialize_current_state(self, chat_id, user_id) -> Tuple[Union[str, None], JSONType]:
+        """
+        Serializes the data of the `CURRENT` state, so it can be stored by the database driver.
+
+        :param chat_id: ID of the user/group chat.
+        :param user_id: ID of the user.
+
+        :return: Tuple of the name of the state and the serialized data.
+        """
         state_name = self.CURRENT.name
+        context = self.context
+        if context.data is NOT_DESERIALIZED and state_name == context.loaded_state_name:
+            # with lazy_data, nobody even looked at the data, so we can store it as loaded.
+            self.update_logger.log_state(context, 'Storing', state_name, context.loaded_data)
+            return state_name, context.loaded_data
+        # end if
+        state_data = None
+        timings = self.context.timings
+        start = time.perf_counter() if timings is not None else 0.0
         # noinspection PyBroadException
         try:
-            state_data = self.serialize(state_name, self.CURRENT.data)
+            state_data = self._serialize_state_data(state_name, self.CURRENT.data)
+            if timings is not None:
+                self._add_timing(timings, 'serialize', start)
+            # end if
         except:
             # resets state, make sure we can still function at all.
             logger.exception(
                 "Error in serialize, resetting state to DEFAULT (None):\n"
                 f"Old state: {state_name}\n"
-                f"Lost data: {state_data!r}"
+                f"Lost data: {self.CURRENT.data!r}"
             )
             state_name, state_data = None, None
         # end try
-        logger.info(
-            f"Storing state {state_name!r} for user {user_id!r} in chat {chat_id!r}.\n"
-            f"Data: {pformat(state_data)}"
-        )
-        self.database_driver.save_state_for_chat_user(chat_id, user_id, state_name, state_data)
-        if abort_e:
-            logger.debug('Re-raising AbortProcessingPlease exception.')
-            raise abort_e  # re-raise so we don't process other stuff afterwards.
-        # end if
+        self.update_logger.log_state(self.context, 'Storing', state_name, state_data)
+        return state_name, state_data
     # end def
 
     @property
@@ -470,9 +1498,8 @@ class TeleStateMachine(StartupMixin, TeleflaskMixinBase):
         :rtype: tuple(int,int)
         """
         assert_type_or_raise(update, TGUpdate, parameter_name="update")
-        assert isinstance(update, TGUpdate)
         chat_id, user_id = None, None
-        msg = TeleStateMachine.update_get_message(update)
+        msg = TeleStateMachine._update_get_message(update)
         if msg:
             if msg.chat and msg.chat.id:
                 chat_id = msg.chat.id
@@ -503,8 +1530,14 @@ class TeleStateMachine(StartupMixin, TeleflaskMixinBase):
         :rtype: tuple(int,int)
         """
         assert_type_or_raise(update, TGUpdate, parameter_name="update")
-        assert isinstance(update, TGUpdate)
+        return TeleStateMachine._update_get_message(update)
+    # end def
 
+    @staticmethod
+    def _update_get_message(update: TGUpdate) -> Union[Message, None]:
+        """
+        `update_get_message(...)`, without checking the type again.
+        """
         if update.message:
             return update.message
         # end if
@@ -523,12 +1556,109 @@ class TeleStateMachine(StartupMixin, TeleflaskMixinBase):
         return None
     # end def
 
+    @staticmethod
+    def update_dict_get_chat_and_user(update: dict) -> Tuple[Union[int, None], Union[int, None]]:
+        """
+        Gets the `chat_id` and `user_id` values from an telegram update as raw json dict,
+        following the same rules as `update_get_chat_and_user(...)`, without needing a `pytgbot` `Update`.
+
+        :param update: The update as telegram sends it, e.g. in a webhook.
+
+        :return: chat_id, user_id
+        :rtype: tuple(int,int)
+        """
+        chat_id, user_id = None, None
+        msg = TeleStateMachine.update_dict_get_message(update)
+        if msg:
+            chat = msg.get('chat')
+            if chat and chat.get('id'):
+                chat_id = chat['id']
+            # end if
+            from_peer = msg.get('from')
+            if from_peer and from_peer.get('id'):
+                user_id = from_peer['id']
+            # end if
+            callback_query = update.get('callback_query')
+            if callback_query and callback_query.get('from') and callback_query['from'].get('id'):
+                # User who clicked the button
+                user_id = callback_query['from']['id']
+            # end if
+            return chat_id, user_id
+        # end if
+        inline_query = update.get('inline_query')
+        if inline_query and inline_query.get('from') and inline_query['from'].get('id'):
+            return None, inline_query['from']['id']
+        # end if
+        logger.debug('Could not find fitting rule for getting user info.')
+        return None, None
+    # end def
+
+    @staticmethod
+    def update_dict_get_message(update: dict) -> Union[dict, None]:
+        """
+        Gets any message we can find in an telegram update as raw json dict,
+        like `update_get_message(...)` does for a `pytgbot` `Update`.
+
+        :param update: The update as telegram sends it, e.g. in a webhook.
+
+        :return: The message as dict, or `None`.
+        """
+        for key in ('message', 'channel_post', 'edited_message', 'edited_channel_post'):
+            msg = update.get(key)
+            if msg:
+                return msg
+            # end if
+        # end for
+        callback_query = update.get('callback_query')
+        if callback_query and callback_query.get('message'):
+            return callback_query['message']
+        # end if
+        return None
+    # end def
+
+    @staticmethod
+    def fingerprint(state_name, db_data) -> Union[bytes, None]:
+        """
+        Subclasses can overwrite this function to provide a cheaper way to detect if a state did change.
+
+        Calculates a digest of the state as stored in the database (i.e. before `deserialize` or after `serialize`),
+        used to skip saving states which didn't change while processing an update.
+        The default implementation hashes the json representation, or if that's not possible, the pickled one.
+
+        :param state_name: The name of the state, as stored in the database.
+        :type  state_name: str | None
+
+        :param db_data: The data as it is stored in the database.
+        :type  db_data: dict | list | int | float | bool | str | bytes
+
+        :return: A digest, or `None` if the state can't be fingerprinted and should therefore always be saved.
+        :rtype: bytes | None
+        """
+        if isinstance(db_data, bytes):
+            # encoded by a `StateCodec`.
+            payload = json.dumps(state_name).encode('utf-8') + b'\n' + db_data
+            return hashlib.blake2b(payload, digest_size=16).digest()
+        # end if
+        try:
+            payload = json.dumps([state_name, db_data], sort_keys=True, separators=(',', ':')).encode('utf-8')
+        except (TypeError, ValueError):
+            # noinspection PyBroadException
+            try:
+                payload = pickle.dumps((state_name, db_data), protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                return None
+            # end try
+        # end try
+        return hashlib.blake2b(payload, digest_size=16).digest()
+    # end def
+
     # noinspection PyMethodMayBeStatic
     @staticmethod
     def deserialize(state_name, db_data):
         """
         Subclasses can overwrite this function to further process the `data` as loaded from the database,
         e.g. to create classes from it or something.
+        Not called for states with a `schema`, which is easier if the data of each state is a different class.
 
         :param db_data: The data as it comes from the database. Probably that's a python dict, if you store that.
         :type  db_data: dict | list | int | float | bool | str
@@ -551,6 +1681,7 @@ class TeleStateMachine(StartupMixin, TeleflaskMixinBase):
 
         The default implementation just returns it unchanged, and therefore works if you use json-serializable types,
         or whatever your chosen database connector actually requires.
+        Not called for states with a `schema`.
 
         :param state_data: Basically `STATE.data`, which you can now convert back to something we can store in the database.
         :type  state_data: Any
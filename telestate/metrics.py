@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+import bisect
+import threading
+from abc import abstractmethod
+from typing import Dict, List, Union
+
+from luckydonaldUtils.logger import logging
+
+__author__ = 'luckydonald'
+__all__ = ['PHASES', 'MetricsSink', 'HistogramMetricsSink']
+
+logger = logging.getLogger(__name__)
+if __name__ == '__main__':
+    logging.add_colored_handler(level=logging.DEBUG)
+# end if
+
+
+PHASES = (
+    'key',  # extracting chat_id and user_id from the update
+    'load',  # the database driver loading the state
+    'deserialize',  # `TeleStateMachine.deserialize(...)`
+    'state_handler',  # the listeners of the current state
+    'all_handler',  # the listeners of the `ALL` state
+    'serialize',  # `TeleStateMachine.serialize(...)`
+    'save',  # the database driver storing the state
+    'total',  # all of the above, for the whole update
+)
+
+
+class MetricsSink(object):
+    """
+    Receives how long the phases of processing an update took, see `TeleStateMachine(metrics_sink=...)`.
+    The phases are listed in `PHASES`. Phases which didn't happen (e.g. no save needed) are missing.
+
+    Subclass it and implement `record(phase, seconds)`,
+    to e.g. forward those to prometheus or statsd.
+    """
+    @abstractmethod
+    def record(self, phase: str, seconds: float) -> None:
+        """
+        Called for every phase of a processed update.
+
+        :param phase: One of `PHASES`.
+        :param seconds: How long that phase took.
+        """
+        raise NotImplementedError('Your metrics sink subclass must implement this.')
+    # end def
+
+    def record_update(self, timings: Dict[str, float]) -> None:
+        """
+        Called once per processed update, with all it's phases.
+        This default implementation calls `record(phase, seconds)` for each of them.
+
+        :param timings: Dict of the phase to the seconds it took.
+        """
+        for phase, seconds in timings.items():
+            self.record(phase, seconds)
+        # end for
+    # end def
+# end class
+
+
+class HistogramMetricsSink(MetricsSink):
+    """
+    Keeps a histogram per phase in memory, with buckets growing exponentially from 1 µs to about 100 s.
+    Percentiles are approximated to the upper bound of their bucket, so they're accurate within `growth` (default 10%).
+
+    >>> sink = HistogramMetricsSink()
+    >>> states = TeleStateMachine(__name__, database_driver=driver, metrics_sink=sink)
+    >>> sink.summary()['load']['p99']
+    """
+    bounds: List[float]  # upper bounds of the buckets, in seconds.
+
+    def __init__(self, smallest: float = 1e-6, largest: float = 100.0, growth: float = 1.1):
+        """
+        :param smallest: upper bound of the first bucket, in seconds.
+        :param largest: upper bound of the last bucket, in seconds. Slower phases are counted there as well.
+        :param growth: factor between two bucket's bounds.
+        """
+        assert 0 < smallest < largest and growth > 1
+        self.bounds = []
+        bound = smallest
+        while bound < largest:
+            self.bounds.append(bound)
+            bound *= growth
+        # end while
+        self.bounds.append(largest)
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, List[int]] = {}
+        self._sums: Dict[str, float] = {}
+        self._maxima: Dict[str, float] = {}
+    # end def
+
+    def record(self, phase: str, seconds: float) -> None:
+        index = min(bisect.bisect_left(self.bounds, seconds), len(self.bounds) - 1)
+        with self._lock:
+            buckets = self._buckets.get(phase)
+            if buckets is None:
+                buckets = self._buckets[phase] = [0] * len(self.bounds)
+                self._sums[phase] = 0.0
+                self._maxima[phase] = 0.0
+            # end if
+            buckets[index] += 1
+            self._sums[phase] += seconds
+            if seconds > self._maxima[phase]:
+                self._maxima[phase] = seconds
+            # end if
+        # end with
+    # end def
+
+    def count(self, phase: str) -> int:
+        """
+        :return: how often the phase was recorded.
+        """
+        with self._lock:
+            return sum(self._buckets.get(phase, ()))
+        # end with
+    # end def
+
+    def percentile(self, phase: str, percent: float) -> Union[float, None]:
+        """
+        :param phase: One of `PHASES`.
+        :param percent: e.g. `99` for the p99.
+
+        :return: the approximated duration in seconds, or `None` if the phase was never recorded.
+        """
+        with self._lock:
+            buckets = self._buckets.get(phase)
+            if not buckets:
+                return None
+            # end if
+            buckets = list(buckets)
+            maximum = self._maxima[phase]
+        # end with
+        wanted = sum(buckets) * percent / 100
+        seen = 0
+        for bound, amount in zip(self.bounds[:-1], buckets):
+            seen += amount
+            if amount and seen >= wanted:
+                return min(bound, maximum)
+            # end if
+        # end for
+        return maximum  # the last bucket also has everything slower than `largest`.
+    # end def
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        :return: per recorded phase a dict with `count`, `mean`, `max`, `p50`, `p90` and `p99`, in seconds.
+        """
+        with self._lock:
+            phases = list(self._buckets)
+        # end with
+        result = {}
+        for phase in phases:
+            count = self.count(phase)
+            with self._lock:
+                total, maximum = self._sums[phase], self._maxima[phase]
+            # end with
+            result[phase] = {
+                'count': count,
+                'mean': total / count if count else 0.0,
+                'max': maximum,
+                'p50': self.percentile(phase, 50),
+                'p90': self.percentile(phase, 90),
+                'p99': self.percentile(phase, 99),
+            }
+        # end for
+        return result
+    # end def
+
+    def reset(self):
+        """
+        Forgets everything recorded.
+        """
+        with self._lock:
+            self._buckets.clear()
+            self._sums.clear()
+            self._maxima.clear()
+        # end with
+    # end def
+# end class
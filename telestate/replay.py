@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+"""
+Replays recorded telegram updates through a `TeleStateMachine`, to see how much traffic it can take.
+
+    $ python -m telestate.replay updates.jsonl mybot.states:machine
+    $ python -m telestate.replay updates.jsonl mybot.states:machine --driver sqlite --database /tmp/replay.sqlite --rate 500 --concurrency 8
+    $ python -m telestate.replay updates.jsonl mybot.states:machine --repeat 10 --json > report.json
+
+The updates file has one update per line, as json like telegram sends it (`Update.to_array()`).
+The machine is given as `module:attribute`, the module is imported, so it must not start the bot on import.
+Nothing is sent to telegram: the bot is replaced by an `OfflineBot`, which answers every request with a fake result.
+With `--driver` the machine's database driver is replaced, by default the machine's own one is used.
+
+Prints the throughput, a latency histogram, the duration of every phase (see `metrics.PHASES`),
+how often each state transition happened, the requests the bot would have sent, and the slowest updates.
+"""
+import argparse
+import importlib
+import itertools
+import json
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, Iterator, List, Tuple, Union
+
+from luckydonaldUtils.logger import logging
+from pytgbot.api_types.receivable.updates import Update
+from pytgbot.bot import Bot
+from teleflask import Teleflask, TBlueprint
+
+from .database_driver import TeleStateDatabaseDriver
+from .executor import KeyedUpdateExecutor
+from .machine import TeleStateMachine
+from .metrics import HistogramMetricsSink
+from .slow_updates import SlowUpdateRecorder
+
+__author__ = 'luckydonald'
+__all__ = ['OfflineBot', 'ReplayRecorder', 'load_machine', 'use_offline_bot', 'read_updates', 'create_driver', 'replay', 'print_report', 'main']
+
+logger = logging.getLogger(__name__)
+
+
+DRIVERS = ('machine', 'simple', 'sqlite', 'pony', 'mongo')
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)  # seconds
+
+
+class OfflineBot(Bot):
+    """
+    A pytgbot `Bot` which never talks to telegram.
+    Every request is counted in `requests`, and answered with a fake result:
+    A message for the `send*` methods, the bot for `getMe`, and `True` otherwise.
+    """
+    requests: Counter  # command: how often it was requested.
+
+    def __init__(self, api_key='OFFLINE', return_python_objects=True):
+        super().__init__(api_key, return_python_objects=return_python_objects)
+        self.requests = Counter()
+        self._requests_lock = threading.Lock()
+        self._message_ids = itertools.count(1)
+    # end def
+
+    def do(self, command, files=None, use_long_polling=False, request_timeout=None, **query):
+        with self._requests_lock:
+            self.requests[command] += 1
+        # end with
+        if command == 'getMe':
+            return {'id': 0, 'is_bot': True, 'first_name': 'OFFLINE', 'username': 'offline4458bot'}
+        # end if
+        if (command.startswith('send') and command != 'sendChatAction') or command == 'forwardMessage':
+            chat_id = query.get('chat_id', 0)
+            return {
+                'message_id': next(self._message_ids), 'date': int(time.time()),
+                'chat': {'id': chat_id if isinstance(chat_id, int) else 0, 'type': 'private'},
+                'text': query.get('text', ''),
+            }
+        # end if
+        return True
+    # end def
+# end class
+
+
+class ReplayRecorder(SlowUpdateRecorder):
+    """
+    Keeps the slow updates like a `SlowUpdateRecorder`,
+    and additionally counts the state transitions and the duration of every update.
+    """
+    transitions: Counter  # (loaded state, new state): how often.
+    latencies: List[float]  # seconds per update.
+
+    def __init__(self, threshold: float = 1.0, capacity: int = 10):
+        super().__init__(threshold=threshold, capacity=capacity)
+        self.transitions = Counter()
+        self.latencies = []
+    # end def
+
+    def finish(self, seconds, timings, update_id, chat_id, user_id, loaded_state, state, profiler=None):
+        with self._lock:
+            self.transitions[(loaded_state, state)] += 1
+            self.latencies.append(seconds)
+        # end with
+        return super().finish(seconds, timings, update_id, chat_id, user_id, loaded_state, state, profiler)
+    # end def
+# end class
+
+
+def load_machine(import_path: str) -> TeleStateMachine:
+    """
+    :param import_path: `module:attribute`, e.g. `mybot.states:machine`.
+                        The attribute may also be a function returning the machine.
+    """
+    module_name, _, attribute = import_path.partition(':')
+    if not attribute:
+        module_name, _, attribute = import_path.rpartition('.')
+    # end if
+    machine = importlib.import_module(module_name)
+    for name in attribute.split('.'):
+        machine = getattr(machine, name)
+    # end for
+    if not isinstance(machine, TeleStateMachine) and callable(machine):
+        machine = machine()
+    # end if
+    if not isinstance(machine, TeleStateMachine):
+        raise TypeError(f'{import_path!r} is not a TeleStateMachine, but {type(machine)!r}.')
+    # end if
+    return machine
+# end def
+
+
+def use_offline_bot(machine: TeleStateMachine) -> OfflineBot:
+    """
+    Makes the machine's teleflask instance use an `OfflineBot`, and starts it.
+    If the machine isn't registered to a teleflask instance yet, a new one is created.
+    """
+    teleflask = machine.blueprint
+    if isinstance(teleflask, TBlueprint):
+        teleflask = teleflask._teleflask if teleflask._got_registered_once else None
+    # end if
+    if teleflask is None:
+        teleflask = Teleflask(
+            api_key=None, app=None, hostname="localhost", debug_routes=False,
+            disable_setting_webhook_telegram=True, disable_setting_webhook_route=True,
+        )
+        if isinstance(machine.blueprint, TBlueprint):
+            teleflask.register_tblueprint(machine.blueprint)
+        else:
+            machine.register_bot(teleflask)
+        # end if
+    # end if
+    bot = OfflineBot(return_python_objects=getattr(teleflask, '_return_python_objects', True))
+    teleflask._bot = bot
+    teleflask.init_bot()
+    return bot
+# end def
+
+
+def create_driver(name: str, database: str = ':memory:', mongo_uri: Union[str, None] = None) -> TeleStateDatabaseDriver:
+    """
+    :param name: One of `DRIVERS`, except `'machine'`.
+    :param database: The file for the `sqlite` and `pony` drivers.
+    :param mongo_uri: The server for the `mongo` driver. `None` to use `mongomock`.
+    """
+    if name == 'simple':
+        from .contrib.simple import SimpleDictDriver
+        return SimpleDictDriver()
+    elif name == 'sqlite':
+        from .contrib.sqlite import SqliteDriver
+        return SqliteDriver(database)
+    elif name == 'pony':
+        from pony import orm
+        from .contrib.pony_orm import PonyDriver
+        db = orm.Database()
+        driver = PonyDriver(db)
+        db.bind(provider='sqlite', filename=database, create_db=True)
+        db.generate_mapping(create_tables=True)
+        return driver
+    elif name == 'mongo':
+        from .contrib.mongo import MongoDriver
+        if mongo_uri is None:
+            import mongomock
+            client = mongomock.MongoClient()
+        else:
+            from pymongo import MongoClient
+            client = MongoClient(mongo_uri)
+        # end if
+        return MongoDriver(client.telestate_replay.states)
+    # end if
+    raise ValueError(f'Unknown driver: {name!r}')
+# end def
+
+
+def read_updates(filename: str, repeat: int = 1, limit: Union[int, None] = None) -> List[Update]:
+    """
+    :param filename: File with one json update per line. `-` for stdin.
+    :param repeat: How often to replay the whole file.
+    :param limit: Maximum amount of updates.
+    """
+    f = sys.stdin if filename == '-' else open(filename, encoding='utf-8')
+    try:
+        updates = [Update.from_array(json.loads(line)) for line in f if line.strip()]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+        # end if
+    # end try
+    updates = updates * repeat
+    return updates[:limit] if limit is not None else updates
+# end def
+
+
+def paced(updates: List[Update], rate: float) -> Iterator[Update]:
+    """
+    Yields the updates, `rate` per second. With a `rate` of `0`, as fast as possible.
+    """
+    start = time.perf_counter()
+    for i, update in enumerate(updates):
+        if rate:
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            # end if
+        # end if
+        yield update
+    # end for
+# end def
+
+
+def histogram(latencies: List[float]) -> List[Tuple[float, int]]:
+    """
+    :return: list of `(upper bound in seconds, amount)`, the last bound being `None` for everything slower.
+    """
+    counts = [0] * (len(LATENCY_BUCKETS) + 1)
+    for seconds in latencies:
+        counts[next((i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), len(LATENCY_BUCKETS))] += 1
+    # end for
+    return list(zip(LATENCY_BUCKETS + (None,), counts))
+# end def
+
+
+def replay(
+    machine: TeleStateMachine,
+    updates: List[Update],
+    rate: float = 0,
+    concurrency: int = 1,
+    slow_threshold: float = 1.0,
+) -> Dict[str, Any]:
+    """
+    Processes the updates with the machine, and measures it.
+    The machine's `metrics_sink`, `slow_update_recorder` and `executor` are replaced for that.
+
+    :param machine: The machine, with the offline bot already set up.
+    :param updates: The updates to process.
+    :param rate: Updates per second to submit. `0` for as fast as possible.
+    :param concurrency: Threads processing the updates. With more than one, updates are processed like
+                        with a `KeyedUpdateExecutor`: in parallel, but in order for each chat and user.
+    :param slow_threshold: Seconds after which an update is listed as slow.
+
+    :return: The report, see `main()` for how it's printed.
+    """
+    sink = HistogramMetricsSink()
+    recorder = ReplayRecorder(threshold=slow_threshold)
+    machine.metrics_sink = sink
+    machine.slow_update_recorder = recorder
+    executor = KeyedUpdateExecutor(max_workers=concurrency, thread_name_prefix='telestate-replay') if concurrency > 1 else None
+    machine.executor = executor
+    failed = 0
+    started = time.perf_counter()
+    try:
+        if executor is None:
+            for update in paced(updates, rate):
+                try:
+                    machine.process_update(update)
+                except Exception:
+                    failed += 1
+                    logger.exception('Processing update failed.')
+                # end try
+            # end for
+        else:
+            futures = [machine.submit_update(update) for update in paced(updates, rate)]
+            for future in futures:
+                if future.exception() is not None:
+                    failed += 1
+                    logger.error('Processing update failed.', exc_info=future.exception())
+                # end if
+            # end for
+        # end if
+    finally:
+        seconds = time.perf_counter() - started
+        if executor is not None:
+            executor.shutdown(wait=True)
+            machine.executor = None
+        # end if
+    # end try
+    return {
+        'updates': len(updates),
+        'failed': failed,
+        'seconds': seconds,
+        'updates_per_second': len(updates) / seconds if seconds else 0.0,
+        'latency_histogram': [
+            {'le': bound, 'count': count} for bound, count in histogram(recorder.latencies) if count
+        ],
+        'phases': sink.summary(),
+        'transitions': [
+            {'from': loaded_state, 'to': state, 'count': count}
+            for (loaded_state, state), count in recorder.transitions.most_common()
+        ],
+        'bot_requests': dict(getattr(machine.bot, 'requests', {})),
+        'slow_updates': [record.to_dict() for record in recorder.records()],
+    }
+# end def
+
+
+def print_report(report: Dict[str, Any], out=sys.stdout):
+    """
+    Prints the report of `replay()` for humans.
+    """
+    def line(text=''):
+        print(text, file=out)
+    # end def
+
+    line(f"Processed {report['updates']} updates in {report['seconds']:.2f}s: {report['updates_per_second']:.1f} updates/s, {report['failed']} failed.")
+    line()
+    line('Latency:')
+    total = sum(bucket['count'] for bucket in report['latency_histogram']) or 1
+    for bucket in report['latency_histogram']:
+        bound = '      -' if bucket['le'] is None else f"{bucket['le'] * 1000:7.2f}"
+        bar = '#' * max(1, round(bucket['count'] / total * 50))
+        line(f"  <= {bound} ms {bucket['count']:8d} {bar}")
+    # end for
+    line()
+    line('Phases (ms):          count      mean       p50       p90       p99       max')
+    for phase, summary in report['phases'].items():
+        line(f"  {phase:15s} {summary['count']:10d} " + ' '.join(
+            f"{summary[key] * 1000:9.3f}" for key in ('mean', 'p50', 'p90', 'p99', 'max')
+        ))
+    # end for
+    line()
+    line('Transitions:')
+    for transition in report['transitions']:
+        line(f"  {transition['from']} -> {transition['to']}: {transition['count']}")
+    # end for
+    if report['bot_requests']:
+        line()
+        line('Bot requests:')
+        for command, count in sorted(report['bot_requests'].items()):
+            line(f"  {command}: {count}")
+        # end for
+    # end if
+    if report['slow_updates']:
+        line()
+        line('Slowest updates:')
+        for record in sorted(report['slow_updates'], key=lambda record: -record['seconds']):
+            line(f"  {record['seconds'] * 1000:.1f}ms update={record['update_id']} chat={record['chat_id']} user={record['user_id']} {record['loaded_state']} -> {record['state']}")
+        # end for
+    # end if
+# end def
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog='python -m telestate.replay', description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('updates', help='file with one json update per line, - for stdin')
+    parser.add_argument('machine', help='the TeleStateMachine to use, as module:attribute')
+    parser.add_argument('--driver', choices=DRIVERS, default='machine', help="database driver to use, 'machine' keeps the machine's one")
+    parser.add_argument('--database', default=':memory:', help='database file for the sqlite and pony drivers')
+    parser.add_argument('--mongo-uri', help='mongodb server for the mongo driver, mongomock if not given')
+    parser.add_argument('--rate', type=float, default=0, help='updates per second, 0 for as fast as possible')
+    parser.add_argument('--concurrency', type=int, default=1, help='threads processing updates')
+    parser.add_argument('--repeat', type=int, default=1, help='replay the file that often')
+    parser.add_argument('--limit', type=int, help='replay at most that many updates')
+    parser.add_argument('--slow', type=float, default=1.0, help='seconds after which an update is listed as slow')
+    parser.add_argument('--json', action='store_true', help='print the report as json')
+    parser.add_argument('--verbose', action='store_true', help="don't silence the logging of every update")
+    args = parser.parse_args(argv)
+
+    if not args.verbose:
+        logging.getLogger('telestate').setLevel(logging.WARNING)
+        logging.getLogger('teleflask').setLevel(logging.WARNING)
+    # end if
+    updates = read_updates(args.updates, repeat=args.repeat, limit=args.limit)
+    machine = load_machine(args.machine)
+    if args.driver != 'machine':
+        machine.database_driver = create_driver(args.driver, database=args.database, mongo_uri=args.mongo_uri)
+    # end if
+    use_offline_bot(machine)
+    report = replay(machine, updates, rate=args.rate, concurrency=args.concurrency, slow_threshold=args.slow)
+    if args.json:
+        print(json.dumps(report, default=repr))
+    else:
+        print_report(report)
+    # end if
+    return 1 if report['failed'] else 0
+# end def
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+# end if
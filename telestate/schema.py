@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+import dataclasses
+import inspect
+import types
+import typing
+from typing import Any, Callable, Dict, Tuple, Union
+
+from luckydonaldUtils.logger import logging
+from luckydonaldUtils.typing import JSONType
+
+__author__ = 'luckydonald'
+__all__ = ['StateSchema']
+
+logger = logging.getLogger(__name__)
+if __name__ == '__main__':
+    logging.add_colored_handler(level=logging.DEBUG)
+# end if
+
+
+_Converter = Callable[[Any], Any]
+_UNION_TYPES = (Union, types.UnionType) if hasattr(types, 'UnionType') else (Union,)  # `int | None` since python 3.10.
+
+
+def _identity(value):
+    return value
+# end def
+
+
+def _check(expected: Union[type, Tuple[type, ...]], name: str) -> _Converter:
+    """
+    :return: A converter returning the value unchanged, if it is of that type (but not a `bool` where a number is expected).
+    """
+    def check(value):
+        if not isinstance(value, expected) or (isinstance(value, bool) and expected is not bool):
+            raise ValueError(f'expected {name}, got {value!r}')
+        # end if
+        return value
+    # end def
+    return check
+# end def
+
+
+class StateSchema(object):
+    """
+    The type of the data of a state, given as `TeleState('WIZARD', schema=WizardData)`.
+
+    The class can be a dataclass, or a class with `__slots__` whose `__init__` takes those as keyword arguments.
+    The data is stored as a `dict` of it's fields, and checked against the type annotations when loading and storing:
+    `int`, `float`, `str`, `bool`, `Any`, `Optional[...]` (or `... | None`), `List[...]`, `Tuple[..., ...]`, `Dict[str, ...]`
+    and other such classes (including the class itself, e.g. for a tree) as fields are supported.
+
+    How to convert every field is figured out once, when creating the schema,
+    so loading and storing the data doesn't need to look at the class again.
+    Data not matching the schema raises a `ValueError` when loading, which resets the user to the `DEFAULT` state,
+    and a `TypeError` when storing.
+    """
+    cls: type
+    fields: Tuple[str, ...]
+    required: Tuple[str, ...]  # fields without a default value.
+    _decoders: Dict[str, _Converter]
+    _encoders: Dict[str, _Converter]  # only the fields which aren't stored without a check.
+
+    def __init__(self, cls: type):
+        """
+        :param cls: A dataclass, or a class with `__slots__`.
+        """
+        self._setup(cls, {cls: self})
+    # end def
+
+    def _setup(self, cls: type, compiling: Dict[type, 'StateSchema']):
+        """
+        :param cls: A dataclass, or a class with `__slots__`.
+        :param compiling: The schemas of the classes currently being set up, used for fields referencing those again.
+        """
+        self.cls = cls
+        hints = typing.get_type_hints(cls, localns={cls.__name__: cls})
+        if dataclasses.is_dataclass(cls):
+            fields = [field for field in dataclasses.fields(cls) if field.init]
+            self.fields = tuple(field.name for field in fields)
+            self.required = tuple(
+                field.name for field in fields
+                if field.default is dataclasses.MISSING and field.default_factory is dataclasses.MISSING
+            )
+        elif '__slots__' in cls.__dict__:
+            slots = cls.__slots__
+            self.fields = (slots,) if isinstance(slots, str) else tuple(slots)
+            parameters = inspect.signature(cls.__init__).parameters
+            self.required = tuple(
+                name for name in self.fields
+                if name in parameters and parameters[name].default is inspect.Parameter.empty
+            )
+        else:
+            raise TypeError(f'{cls!r} needs to be a dataclass or have __slots__.')
+        # end if
+        self._decoders = {}
+        self._encoders = {}
+        for name in self.fields:
+            decoder, encoder = self._compile(hints.get(name, Any), compiling)
+            self._decoders[name] = decoder
+            if encoder is not _identity:
+                self._encoders[name] = encoder
+            # end if
+        # end for
+    # end def
+
+    @classmethod
+    def _compile(cls, hint, compiling: Dict[type, 'StateSchema']) -> Tuple[_Converter, _Converter]:
+        """
+        :param hint: The type annotation of a field.
+        :param compiling: The schemas of the classes currently being set up.
+        :return: Functions to convert a value of that type from the stored (json) form and back, checking it's type.
+        """
+        if hint is Any:
+            return _identity, _identity
+        # end if
+        origin, args = typing.get_origin(hint), typing.get_args(hint)
+        if origin in _UNION_TYPES:
+            options = [arg for arg in args if arg is not type(None)]
+            if len(options) != 1:
+                return _identity, _identity  # we can't tell which one it should be.
+            # end if
+            decoder, encoder = cls._compile(options[0], compiling)  # that's an Optional[...]
+            return (
+                lambda value: None if value is None else decoder(value),
+                encoder if encoder is _identity else (lambda value: None if value is None else encoder(value)),
+            )
+        # end if
+        if hint is list or origin is list:
+            return cls._compile_sequence(args[0] if args else Any, list, 'a list', compiling)
+        # end if
+        if hint is tuple or origin is tuple:
+            homogeneous = len(args) == 2 and args[1] is Ellipsis  # Tuple[int, ...]
+            return cls._compile_sequence(args[0] if homogeneous else Any, tuple, 'a tuple', compiling)
+        # end if
+        if hint is dict or origin is dict:
+            value_decoder, value_encoder = cls._compile(args[1] if args else Any, compiling)
+            check = _check(dict, 'a dict')
+            check_key = _check(str, 'str keys')
+
+            def decode_dict(value):
+                return {check_key(key): value_decoder(item) for key, item in check(value).items()}
+            # end def
+
+            def encode_dict(value):
+                return {check_key(key): value_encoder(item) for key, item in check(value).items()}
+            # end def
+            return decode_dict, encode_dict
+        # end if
+        if hint is float:
+            check = _check((int, float), 'a float')
+            return lambda value: float(check(value)), check
+        # end if
+        if hint in (int, str, bool):
+            check = _check(hint, hint.__name__)
+            return check, check
+        # end if
+        if inspect.isclass(hint) and (dataclasses.is_dataclass(hint) or '__slots__' in hint.__dict__):
+            schema = compiling.get(hint)
+            if schema is None:
+                # registered before it's fields are compiled, so a field of the same class doesn't recurse forever.
+                schema = compiling[hint] = cls.__new__(cls)
+                schema._setup(hint, compiling)
+            # end if
+            return schema.decode_required, schema.encode_required
+        # end if
+        raise TypeError(f'Unsupported type {hint!r} in a state schema.')
+    # end def
+
+    @classmethod
+    def _compile_sequence(
+        cls, item_hint, sequence_type: type, name: str, compiling: Dict[type, 'StateSchema']
+    ) -> Tuple[_Converter, _Converter]:
+        item_decoder, item_encoder = cls._compile(item_hint, compiling)
+        check = _check((list, tuple), name)
+
+        def decode_sequence(value):
+            return sequence_type(item_decoder(item) for item in check(value))
+        # end def
+
+        def encode_sequence(value):
+            return [item_encoder(item) for item in check(value)]
+        # end def
+        return decode_sequence, encode_sequence
+    # end def
+
+    def decode(self, data: Union[Dict[str, JSONType], None]) -> Any:
+        """
+        Creates the data object from the stored `dict`.
+
+        :param data: The data as stored, `None` if the state has no data (yet).
+        :return: An instance of the schema's class, or `None`.
+        :raises ValueError: The data doesn't match the schema.
+        """
+        if data is None:
+            return None
+        # end if
+        return self.decode_required(data)
+    # end def
+
+    def decode_required(self, data: Dict[str, JSONType]) -> Any:
+        """
+        Like `decode(...)`, but `None` isn't allowed either.
+        """
+        if not isinstance(data, dict):
+            raise ValueError(f'{self.cls.__name__}: expected a dict, got {data!r}')
+        # end if
+        unknown = data.keys() - self._decoders.keys()
+        if unknown:
+            raise ValueError(f'{self.cls.__name__}: unknown fields {sorted(unknown)!r}')
+        # end if
+        missing = [name for name in self.required if name not in data]
+        if missing:
+            raise ValueError(f'{self.cls.__name__}: missing fields {missing!r}')
+        # end if
+        kwargs = {}
+        for name, value in data.items():
+            try:
+                kwargs[name] = self._decoders[name](value)
+            except ValueError as e:
+                raise ValueError(f'{self.cls.__name__}.{name}: {e}') from None
+            # end try
+        # end for
+        return self.cls(**kwargs)
+    # end def
+
+    def encode(self, obj: Any) -> Union[Dict[str, JSONType], None]:
+        """
+        Turns the data object into a `dict` to store.
+
+        :param obj: An instance of the schema's class, or `None`.
+        :return: The fields as `dict`, or `None`.
+        :raises TypeError: It is not an instance of the schema's class, or a field doesn't match it's type annotation.
+        """
+        if obj is None:
+            return None
+        # end if
+        return self.encode_required(obj)
+    # end def
+
+    def encode_required(self, obj: Any) -> Dict[str, JSONType]:
+        """
+        Like `encode(...)`, but `None` isn't allowed either.
+        """
+        if not isinstance(obj, self.cls):
+            raise TypeError(f'Expected {self.cls.__name__} as data, got {obj!r}')
+        # end if
+        data = {name: getattr(obj, name) for name in self.fields if hasattr(obj, name)}
+        for name, encoder in self._encoders.items():
+            if name in data:
+                try:
+                    data[name] = encoder(data[name])
+                except (TypeError, ValueError) as e:
+                    raise TypeError(f'{self.cls.__name__}.{name}: {e}') from None
+                # end try
+            # end if
+        # end for
+        return data
+    # end def
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.cls.__name__})'
+    # end def
+# end class
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+import cProfile
+import io
+import itertools
+import json
+import pstats
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Iterator, List, Union
+
+from luckydonaldUtils.logger import logging
+
+__author__ = 'luckydonald'
+__all__ = ['SlowUpdate', 'SlowUpdateRecorder']
+
+logger = logging.getLogger(__name__)
+if __name__ == '__main__':
+    logging.add_colored_handler(level=logging.DEBUG)
+# end if
+
+
+class SlowUpdate(object):
+    """
+    What we know about an update which took longer than the `SlowUpdateRecorder`'s threshold.
+    """
+    timestamp: float  # unix time the update finished.
+    update_id: Union[int, None]
+    chat_id: Union[int, str, None]
+    user_id: Union[int, str, None]
+    loaded_state: Union[str, None]  # the name of the state when the update arrived.
+    state: Union[str, None]  # the name of the state after processing it.
+    seconds: float  # the total duration.
+    timings: Dict[str, float]  # seconds per phase, see `metrics.PHASES`.
+    profile: Union[str, None]  # the `pstats` output, if this update was profiled.
+
+    def __init__(self, timestamp, update_id, chat_id, user_id, loaded_state, state, seconds, timings, profile=None):
+        self.timestamp = timestamp
+        self.update_id = update_id
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.loaded_state = loaded_state
+        self.state = state
+        self.seconds = seconds
+        self.timings = timings
+        self.profile = profile
+    # end def
+
+    def to_dict(self) -> dict:
+        return {
+            'timestamp': self.timestamp,
+            'update_id': self.update_id,
+            'chat_id': self.chat_id,
+            'user_id': self.user_id,
+            'loaded_state': self.loaded_state,
+            'state': self.state,
+            'seconds': self.seconds,
+            'timings': self.timings,
+            'profile': self.profile,
+        }
+    # end def
+
+    def __repr__(self):
+        return "<{clazz} {seconds:.3f}s update={update_id!r} chat={chat_id!r} user={user_id!r} state={loaded_state!r}->{state!r}>".format(
+            clazz=self.__class__.__name__,
+            seconds=self.seconds,
+            update_id=self.update_id,
+            chat_id=self.chat_id,
+            user_id=self.user_id,
+            loaded_state=self.loaded_state,
+            state=self.state,
+        )
+    # end def
+
+    __str__ = __repr__
+# end class
+
+
+class SlowUpdateRecorder(object):
+    """
+    Remembers the updates whose processing took longer than `threshold` seconds, in a ring buffer of the last `capacity` ones.
+    For each one the key, the states, and the duration of every phase are kept, see `SlowUpdate`.
+
+    Optionally, updates are profiled with `cProfile`, and the profile of the slow ones is kept as well.
+    As profiling makes processing slower, that's off by default:
+    Use `profile_every=N` to profile every N-th update, or `profile_next(n)` to profile the next `n` ones.
+    Updates processed with `process_update_async` are never profiled, as other tasks would show up in that profile.
+
+    >>> recorder = SlowUpdateRecorder(threshold=0.5)
+    >>> states = TeleStateMachine(__name__, database_driver=driver, slow_update_recorder=recorder)
+    >>> recorder.profile_next(1000)
+    >>> recorder.dump('/tmp/slow_updates.jsonl')
+    """
+    threshold: float
+    capacity: int
+    profile_every: int
+    profile_lines: int
+    recorded: int  # how many slow updates we've seen, including the ones not in the buffer any longer.
+    _records: Deque[SlowUpdate]
+    _counter: Iterator[int]
+
+    def __init__(self, threshold: float = 1.0, capacity: int = 100, profile_every: int = 0, profile_lines: int = 40):
+        """
+        :param threshold: Seconds an update's processing has to take, to be recorded.
+        :param capacity: How many slow updates to keep. The oldest ones are dropped.
+        :param profile_every: Profile every N-th update. `0` to only profile when asked to via `profile_next(n)`.
+        :param profile_lines: How many of the slowest functions (by cumulative time) to keep in the profile.
+        """
+        assert threshold >= 0 and capacity > 0 and profile_every >= 0
+        self.threshold = threshold
+        self.capacity = capacity
+        self.profile_every = profile_every
+        self.profile_lines = profile_lines
+        self.recorded = 0
+        self._records = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+        self._profile_next = 0
+    # end def
+
+    def profile_next(self, amount: int):
+        """
+        Profiles the next `amount` updates, in addition to `profile_every`.
+        """
+        with self._lock:
+            self._profile_next += amount
+        # end with
+    # end def
+
+    def start_profile(self) -> Union[cProfile.Profile, None]:
+        """
+        Called before processing an update. Starts profiling it, if it's due.
+
+        :return: The running profiler, or `None`.
+        """
+        if self._profile_next:
+            with self._lock:
+                due = self._profile_next > 0
+                if due:
+                    self._profile_next -= 1
+                # end if
+            # end with
+        else:
+            due = self.profile_every and next(self._counter) % self.profile_every == 0
+        # end if
+        if not due:
+            return None
+        # end if
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiler is running already.
+            return None
+        # end try
+        return profiler
+    # end def
+
+    def finish(
+        self,
+        seconds: float,
+        timings: Dict[str, float],
+        update_id: Union[int, None],
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None],
+        loaded_state: Union[str, None],
+        state: Union[str, None],
+        profiler: Union[cProfile.Profile, None] = None,
+    ) -> Union[SlowUpdate, None]:
+        """
+        Called after processing an update. Records it, if it was slower than the `threshold`.
+
+        :param seconds: How long processing took.
+        :param timings: The seconds per phase.
+        :param update_id: The ID of the telegram update.
+        :param chat_id: ID of the user/group chat.
+        :param user_id: ID of the user.
+        :param loaded_state: The name of the state when the update arrived.
+        :param state: The name of the state after processing.
+        :param profiler: The profiler returned by `start_profile()`.
+
+        :return: The record, if it was slow.
+        """
+        if profiler is not None:
+            profiler.disable()
+        # end if
+        if seconds < self.threshold:
+            return None
+        # end if
+        record = SlowUpdate(
+            timestamp=time.time(), update_id=update_id, chat_id=chat_id, user_id=user_id,
+            loaded_state=loaded_state, state=state, seconds=seconds, timings=dict(timings),
+            profile=self.format_profile(profiler) if profiler is not None else None,
+        )
+        with self._lock:
+            self._records.append(record)
+            self.recorded += 1
+        # end with
+        logger.warning('Slow update: %r', record)
+        return record
+    # end def
+
+    def format_profile(self, profiler: cProfile.Profile) -> str:
+        """
+        :return: the `profile_lines` functions with the highest cumulative time, as `pstats` prints them.
+        """
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(self.profile_lines)
+        return stream.getvalue()
+    # end def
+
+    def records(self) -> List[SlowUpdate]:
+        """
+        :return: The kept slow updates, oldest first.
+        """
+        with self._lock:
+            return list(self._records)
+        # end with
+    # end def
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+        # end with
+    # end def
+
+    def dump(self, path: str) -> int:
+        """
+        Writes the kept slow updates to a file, one json object per line, oldest first.
+
+        :param path: The file to write.
+
+        :return: The amount of written updates.
+        """
+        records = self.records()
+        with open(path, 'w', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record.to_dict(), default=repr) + '\n')
+            # end for
+        # end with
+        return len(records)
+    # end def
+# end class
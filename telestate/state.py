@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import inspect
 import re
 from typing import Any, Union, cast
 
@@ -14,7 +15,11 @@ from teleflask.server.mixins import RegisterBlueprintsMixin, BotCommandsMixin, M
 __author__ = 'luckydonald'
 __all__ = ["TeleStateUpdateHandler", "TeleState"]
 
-from telestate.constants import KEEP_PREVIOUS
+from telestate.constants import KEEP_PREVIOUS, NOT_DESERIALIZED
+from telestate.codec import StateCodec
+from telestate.context import TeleStateContext
+from telestate.schema import StateSchema
+from telestate.dispatch import DispatchTable, ParsedUpdate
 
 logger = logging.getLogger(__name__)
 if __name__ == '__main__':
@@ -80,27 +85,62 @@ class TeleStateUpdateHandler(RegisterBlueprintsMixin, BotCommandsMixin, Messages
     """
     This class does the actual @command, @on_update, etc. logic, by extending the mixins providing that functionality.
 
-    TeleStateMachine.process_update will call the current state's TeleStateUpdateHandler's process_update, which will leave that to the mixins.
+    TeleStateMachine.process_update will call the current state's TeleStateUpdateHandler's process_update.
+    The listeners registered by the mixins are compiled into a `DispatchTable` when first needed,
+    which calls them like the mixins would, but without walking all of them for every update.
     """
+    _dispatch_table: Union[DispatchTable, None]
+
     def __init__(self, wrapped_state, teleflask, *args, **kwargs):
         self.wrapped_state: TeleState = wrapped_state
         self.teleflask: Teleflask = teleflask
+        self._dispatch_table = None
         super().__init__(*args, **kwargs)
     # end def
 
-    def process_update(self, update):
+    def process_update(self, update, parsed: Union[ParsedUpdate, None] = None):
         """
-        This method is called from the flask webserver.
-
-        Any Mixin implementing must call super().process_update(update).
-        So catch exceptions in your mixin's code.
+        Calls the listeners fitting the update.
 
         :param update: The Telegram update
         :type  update: pytgbot.api_types.receivable.updates.Update
-        :return:
+
+        :param parsed: The update already looked at, so the current state and `ALL` don't need to do that twice.
+        :type  parsed: ParsedUpdate
         """
-        logger.debug('State {!r} got an update.'.format(self))
-        super().process_update(update)
+        logger.debug('State %r got an update.', self)
+        if parsed is None:
+            parsed = ParsedUpdate(update)
+        # end if
+        self.dispatch_table.process_update(self, update, parsed)
+    # end def
+
+    @property
+    def dispatch_table(self) -> DispatchTable:
+        """
+        The compiled listeners, built when first needed, see `reset_dispatch_table()`.
+        """
+        dispatch_table = self._dispatch_table
+        if dispatch_table is None:
+            dispatch_table = self._dispatch_table = DispatchTable(self)
+        # end if
+        return dispatch_table
+    # end def
+
+    def reset_dispatch_table(self):
+        """
+        Makes the `dispatch_table` get compiled again, as listeners were added.
+        """
+        self._dispatch_table = None
+    # end def
+
+    @property
+    def has_listeners(self) -> bool:
+        """
+        :return: If any `@on_update`, `@on_message` or `@command` listener is registered,
+                 i.e. if processing an update could call anything at all.
+        """
+        return bool(self.update_listeners or self.message_listeners or self.commands)
     # end def
 
     @property
@@ -114,6 +154,22 @@ class TeleStateUpdateHandler(RegisterBlueprintsMixin, BotCommandsMixin, Messages
     # end def
 
     def process_result(self, update, result):
+        if inspect.isawaitable(result):
+            # an `async def` listener, the machine will await that later.
+            awaitables = self.wrapped_state.machine.context.awaitables
+            if awaitables is None:
+                logger.error(
+                    f'Listener of state {self.wrapped_state.name} returned an awaitable, '
+                    f'but the update is not processed via process_update_async(...). Result discarded.'
+                )
+                if inspect.iscoroutine(result):
+                    result.close()
+                # end if
+                return
+            # end if
+            awaitables.append((self.wrapped_state, update, result))
+            return
+        # end if
         return self.wrapped_state.process_result(update, result)
     # end def
 
@@ -130,17 +186,24 @@ class TeleState(TBlueprint):
     warn_on_modifications: bool = True
 
     machine: Union['TeleStateMachine', None]
-    data: Union[Any, None]
-    update: Union[Update, None]  # store the update activation this. Used for sending/updating menus.
+    _data: Union[Any, None]  # only used while this state is not the active one, see `self.data`.
+    _update: Union[Update, None]  # only used while this state is not the active one, see `self.update`.
     update_handler: Union[TeleStateUpdateHandler, None]
+    codec: Union[StateCodec, None]  # how the data is stored, instead of the machine's `codec`.
+    schema: Union[StateSchema, None]  # the type of the data, instead of the machine's `serialize` and `deserialize`.
 
-    def __init__(self, name=None, machine: 'TeleStateMachine' = None):
+    def __init__(
+        self, name=None, machine: 'TeleStateMachine' = None, codec: Union[StateCodec, None] = None,
+        schema: Union[type, StateSchema, None] = None,
+    ):
         """
         A new state.
 
         :param name: Name of the state
         :param data: additional data to keep for that state
         :param machine: Statemachine to register with
+        :param codec: Encodes the data of this state for the database, instead of the machine's `codec`.
+        :param schema: The class of the data of this state, a dataclass or a class with `__slots__`. See `StateSchema`.
         """
         if name:
             assert_can_be_name(name, allow_setting_defaults=True)
@@ -150,9 +213,12 @@ class TeleState(TBlueprint):
         assert machine is None or isinstance(machine, TeleStateMachine)
 
         self.machine: Union[TeleStateMachine, None] = None  # set by self.register_machine(...), below
-        self.data = None
-        self.update = None
+        self._data = None
+        self._update = None
         self.update_handler: Union[TeleStateUpdateHandler, None] = None
+        assert_type_or_raise(codec, StateCodec, None, parameter_name='codec')
+        self.codec = codec
+        self.schema = schema if schema is None or isinstance(schema, StateSchema) else StateSchema(schema)
         super(TeleState, self).__init__(name)  # writes self.name
 
         if machine:
@@ -168,6 +234,10 @@ class TeleState(TBlueprint):
         # end if
         self.update_handler = TeleStateUpdateHandler(self, teleflask)
         self.update_handler.register_tblueprint(self)
+        self.update_handler.reset_dispatch_table()
+        if self.machine is not None:
+            self.machine.reset_update_filter()
+        # end if
     # end def
 
     def activate(self, data: Any = None, update: Union[Update, None, KEEP_PREVIOUS.__class__] = KEEP_PREVIOUS):
@@ -209,7 +279,10 @@ class TeleState(TBlueprint):
         logger.warning(f'late addition to {self.name}: {func}')
         state = self.make_setup_state(self.update_handler, {}, first_registration=False)
         func(state)
-        # end for
+        self.update_handler.reset_dispatch_table()
+        if self.machine is not None:
+            self.machine.reset_update_filter()
+        # end if
     # end def
 
     def process_result(self, update, result):
@@ -264,11 +337,77 @@ class TeleState(TBlueprint):
         return self.machine.user_id
     # end def
 
+    def _active_context(self) -> Union[TeleStateContext, None]:
+        """
+        The context of the currently processed update, if this state is the active one there.
+
+        :return: The context, or `None` if this state is not the current state.
+        """
+        if self.machine is None:
+            return None
+        # end if
+        context = self.machine.context
+        if context.state is not self:
+            return None
+        # end if
+        return context
+    # end def
+
+    @property
+    def data(self) -> Union[Any, None]:
+        """
+        The additional data of this state.
+        While this state is the `CURRENT` one, that is the data stored in the context of the currently processed update.
+        With the machine's `lazy_data=True`, that gets deserialized when first accessed.
+        """
+        context = self._active_context()
+        if context is None:
+            return self._data
+        # end if
+        if context.data is NOT_DESERIALIZED:
+            return self.machine._deserialize_loaded_data(context)
+        # end if
+        return context.data
+    # end def
+
+    @data.setter
+    def data(self, data: Union[JSONType, Any]):
+        self.set_data(data)
+    # end def
+
+    @property
+    def update(self) -> Union[Update, None]:
+        """
+        The update activating this state. Used for sending/updating menus.
+        While this state is the `CURRENT` one, that is the update stored in the context of the currently processed update.
+        """
+        context = self._active_context()
+        if context is None:
+            return self._update
+        # end if
+        return context.update
+    # end def
+
+    @update.setter
+    def update(self, update: Union[Update, None]):
+        self.set_update(update)
+    # end def
+
     def set_data(self, data: Union[JSONType, Any]):
-        self.data = data
+        context = self._active_context()
+        if context is None:
+            self._data = data
+        else:
+            context.data = data
+        # end if
     # end def
 
     def set_update(self, update: Union[Update, None]):
-        self.update = update
+        context = self._active_context()
+        if context is None:
+            self._update = update
+        else:
+            context.update = update
+        # end if
     # end def
 # end class
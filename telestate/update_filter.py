@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+from typing import Iterable, List, Set, Tuple, Union
+
+from luckydonaldUtils.logger import logging
+from pytgbot.api_types.receivable.updates import Update
+
+__author__ = 'luckydonald'
+__all__ = ['UpdateFilter']
+
+logger = logging.getLogger(__name__)
+if __name__ == '__main__':
+    logging.add_colored_handler(level=logging.DEBUG)
+# end if
+
+
+_JSON_KEYS = {'from_peer': 'from'}  # pytgbot attribute: json key, where those differ.
+
+
+class UpdateFilter(object):
+    """
+    Knows which updates could call any listener of a group of `TeleStateUpdateHandler`s at all,
+    by collecting what their `@on_update`, `@on_message` and `@command` listeners require.
+
+    The `TeleStateMachine` builds one over all it's states and `ALL`,
+    to skip loading and storing the state for updates no listener of any state would be called for.
+    It checks the same as teleflask's mixins do when calling the listeners:
+
+    - `@on_update('inline_query')`: the update has all the attributes of any of the listener's keyword combinations.
+    - `@on_message('sticker')`: same, but for the attributes of `update.message`.
+    - `@command('start')`: `update.message.text` is exactly that command, or starts with it followed by a space.
+    """
+    accepts_all: bool  # if some listener is called for every update (or we can't tell), so nothing can be skipped.
+    update_keywords: List[Tuple[str, ...]]  # attributes of the update which all need to be set, any of those.
+    message_keywords: List[Tuple[str, ...]]  # attributes of `update.message` which all need to be set, any of those.
+    commands: Set[str]  # e.g. `/start` and `/start@examplebot`.
+
+    def __init__(self, handlers: Iterable[Union['TeleStateUpdateHandler', None]]):
+        """
+        :param handlers: The update handlers of the states. `None` for a state not registered to teleflask yet,
+                         which makes the filter accept all updates.
+        """
+        self.accepts_all = False
+        update_keywords = set()
+        message_keywords = set()
+        self.commands = set()
+        for handler in handlers:
+            if handler is None:
+                self.accepts_all = True
+                continue
+            # end if
+            for required_keywords_array in handler.update_listeners.values():
+                for required_keywords in required_keywords_array:
+                    if not required_keywords:
+                        self.accepts_all = True
+                    else:
+                        update_keywords.add(tuple(required_keywords))
+                    # end if
+                # end for
+            # end for
+            for required_keywords_array in handler.message_listeners.values():
+                for required_keywords in required_keywords_array:
+                    message_keywords.add(tuple(required_keywords) if required_keywords else ())
+                # end for
+            # end for
+            self.commands.update(handler.commands)
+        # end for
+        # fewer keywords first, those are more likely to match. `()` accepts every message.
+        self.update_keywords = sorted(update_keywords, key=len)
+        self.message_keywords = sorted(message_keywords, key=len)
+    # end def
+
+    def matches(self, update: Update) -> bool:
+        """
+        :param update: The Telegram update.
+
+        :return: If any listener could be called for that update.
+        """
+        if self.accepts_all:
+            return True
+        # end if
+        for keywords in self.update_keywords:
+            if all(getattr(update, keyword, None) for keyword in keywords):
+                return True
+            # end if
+        # end for
+        msg = update.message
+        if not msg:
+            return False
+        # end if
+        for keywords in self.message_keywords:
+            if all(getattr(msg, keyword, None) for keyword in keywords):
+                return True
+            # end if
+        # end for
+        return self._is_command(msg.text)
+    # end def
+
+    def matches_dict(self, update: dict) -> bool:
+        """
+        Like `matches(...)`, but for an update as the json dict telegram sends.
+
+        :param update: The Telegram update, as parsed json.
+
+        :return: If any listener could be called for that update.
+        """
+        if self.accepts_all:
+            return True
+        # end if
+        for keywords in self.update_keywords:
+            if all(update.get(_JSON_KEYS.get(keyword, keyword)) for keyword in keywords):
+                return True
+            # end if
+        # end for
+        msg = update.get('message')
+        if not msg:
+            return False
+        # end if
+        for keywords in self.message_keywords:
+            if all(msg.get(_JSON_KEYS.get(keyword, keyword)) for keyword in keywords):
+                return True
+            # end if
+        # end for
+        return self._is_command(msg.get('text'))
+    # end def
+
+    def _is_command(self, text: Union[str, None]) -> bool:
+        if not text or not self.commands:
+            return False
+        # end if
+        text = text.strip()
+        return text in self.commands or (" " in text and text.split(" ")[0] in self.commands)
+    # end def
+# end class
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+import itertools
+import reprlib
+from typing import Any, Callable, Iterator, Union
+
+from luckydonaldUtils.logger import logging
+
+from .context import TeleStateContext
+
+__author__ = 'luckydonald'
+__all__ = ['UpdateLogger']
+
+logger = logging.getLogger(__name__)
+if __name__ == '__main__':
+    logging.add_colored_handler(level=logging.DEBUG)
+# end if
+
+
+class LoggedData(object):
+    """
+    Formats the data of a state only when the log message is actually emitted, see `UpdateLogger.format_data(...)`.
+    """
+    __slots__ = ('update_logger', 'state_name', 'data')
+
+    def __init__(self, update_logger: 'UpdateLogger', state_name: Union[str, None], data: Any):
+        self.update_logger = update_logger
+        self.state_name = state_name
+        self.data = data
+    # end def
+
+    def __str__(self):
+        return self.update_logger.format_data(self.state_name, self.data)
+    # end def
+
+    __repr__ = __str__
+# end class
+
+
+class UpdateLogger(object):
+    """
+    Logs what `TeleStateMachine.process_update` does, cheaply:
+
+    - Messages are only formatted if the logger would emit them, so a silenced logger costs next to nothing.
+    - With `sample_rate=N` only every N-th update is logged, `0` logs none.
+    - With `slow_threshold` the messages of updates not sampled are kept, and logged only if the update was that slow.
+    - State data is shortened to `max_length` characters, without formatting all of a big payload first.
+    - `redact(state_name, data)` can replace the data before it's logged, e.g. to hide personal information.
+
+    >>> states = TeleStateMachine(__name__, database_driver=driver, update_logger=UpdateLogger(sample_rate=100, slow_threshold=0.5))
+
+    Errors are always logged, this only affects the debug and info messages of every update.
+    """
+    logger: logging.Logger
+    sample_rate: int
+    slow_threshold: Union[float, None]
+    max_length: int
+    redact: Union[Callable[[Union[str, None], Any], Any], None]
+    _counter: Iterator[int]
+
+    def __init__(
+        self,
+        logger: Union[logging.Logger, None] = None,
+        sample_rate: int = 1,
+        slow_threshold: Union[float, None] = None,
+        max_length: int = 1000,
+        redact: Union[Callable[[Union[str, None], Any], Any], None] = None,
+    ):
+        """
+        :param logger: The logger to use. `None` for the one of `telestate.machine`.
+        :param sample_rate: Log every N-th update. `1` logs all of them, `0` none.
+        :param slow_threshold: Seconds after which an update not sampled is logged anyway. `None` to not check.
+        :param max_length: Maximum length of the logged state data.
+        :param redact: Function getting the state name and data, returning what to log instead of that data.
+        """
+        assert sample_rate >= 0
+        assert max_length > 0
+        self.logger = logger if logger is not None else logging.getLogger('telestate.machine')
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.max_length = max_length
+        self.redact = redact
+        self._counter = itertools.count()  # next() of it is atomic, so it's fine for multiple threads.
+        self._repr = reprlib.Repr()
+        self._repr.maxlevel = 10
+        self._repr.maxdict = self._repr.maxlist = self._repr.maxtuple = self._repr.maxset = 100
+        self._repr.maxstring = self._repr.maxother = max_length
+    # end def
+
+    def begin(self, context: TeleStateContext, keep: bool = True):
+        """
+        Decides if the update about to be processed in that context is logged.
+
+        :param context: The fresh context of the update.
+        :param keep: If the messages of an update not sampled should be kept for `end(...)`, if there's a `slow_threshold`.
+        """
+        if self.sample_rate == 1:
+            return  # the context logs by default.
+        # end if
+        context.log_sampled = self.sample_rate > 0 and next(self._counter) % self.sample_rate == 0
+        if keep and not context.log_sampled and self.slow_threshold is not None:
+            context.log_records = []
+        # end if
+    # end def
+
+    def end(self, context: TeleStateContext, seconds: float):
+        """
+        Logs the kept messages of an update not sampled, if it was slower than the `slow_threshold`.
+
+        :param context: The context of the processed update.
+        :param seconds: How long processing it took.
+        """
+        records, context.log_records = context.log_records, None
+        if not records or seconds < self.slow_threshold:
+            return
+        # end if
+        self.logger.info('Update took %.3f seconds:', seconds)
+        for level, msg, args in records:
+            self.logger.log(level, msg, *args)
+        # end for
+    # end def
+
+    def is_enabled(self, context: TeleStateContext, level: int) -> bool:
+        """
+        :return: If a message of that level would be logged (or kept) for the update of that context.
+        """
+        return (context.log_sampled or context.log_records is not None) and self.logger.isEnabledFor(level)
+    # end def
+
+    def log(self, context: TeleStateContext, level: int, msg: str, *args):
+        """
+        Logs the message, if the update is sampled.
+        Like with `logging`, the message is only formatted with the `args` if it's actually emitted.
+        """
+        if not self.is_enabled(context, level):
+            return
+        # end if
+        if context.log_records is not None:
+            # might be logged later, so we keep how the data looks now. That's bounded by max_length.
+            args = tuple(str(arg) if isinstance(arg, LoggedData) else arg for arg in args)
+            context.log_records.append((level, msg, args))
+            return
+        # end if
+        self.logger.log(level, msg, *args)
+    # end def
+
+    def debug(self, context: TeleStateContext, msg: str, *args):
+        self.log(context, logging.DEBUG, msg, *args)
+    # end def
+
+    def info(self, context: TeleStateContext, msg: str, *args):
+        self.log(context, logging.INFO, msg, *args)
+    # end def
+
+    def log_state(self, context: TeleStateContext, action: str, state_name: Union[str, None], state_data: Any):
+        """
+        Logs the state being loaded or stored.
+
+        :param context: The context of the update.
+        :param action: e.g. `'Loading'` or `'Storing'`.
+        :param state_name: The name of the state.
+        :param state_data: The data of the state, formatted only if logged.
+        """
+        if not self.is_enabled(context, logging.INFO):
+            return
+        # end if
+        self.log(
+            context, logging.INFO, '%s state %r for user %r in chat %r.\nData: %s',
+            action, state_name, context.user_id, context.chat_id, LoggedData(self, state_name, state_data),
+        )
+    # end def
+
+    def format_data(self, state_name: Union[str, None], data: Any) -> str:
+        """
+        Applies `redact`, and makes a string of at most `max_length` characters.
+        Big containers are cut short while formatting, so that doesn't take long either.
+
+        :param state_name: The name of the state.
+        :param data: The data to format.
+
+        :return: The string to log.
+        """
+        if self.redact is not None:
+            data = self.redact(state_name, data)
+        # end if
+        text = self._repr.repr(data)
+        if len(text) > self.max_length:
+            text = text[:self.max_length - 3] + '...'
+        # end if
+        return text
+    # end def
+# end class
@@ -0,0 +1,605 @@
+import os
+import time
+import unittest
+
+from telestate.contrib.simple import SimpleDictDriver
+
+from luckydonaldUtils.logger import logging
+
+logger = logging.getLogger(__name__)
+logging.add_colored_handler(level=logging.DEBUG)
+
+
+try:
+    from pony import orm
+except ImportError:
+    orm = None
+# end try
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+# end try
+
+
+class DriverTestMixin(object):
+    """
+    Tests every driver has to pass. Subclasses provide `self.driver` in `setUp`.
+    """
+    driver = None
+
+    def test_load_missing(self):
+        self.assertEqual(self.driver.load_state_for_chat_user(1, 2), (None, None))
+    # end def
+
+    def test_save_and_load(self):
+        self.driver.save_state_for_chat_user(1, 2, 'FOO', {'bar': [4, 4, 5, 8]})
+        self.assertEqual(self.driver.load_state_for_chat_user(1, 2), ('FOO', {'bar': [4, 4, 5, 8]}))
+        self.driver.save_state_for_chat_user(1, 2, 'BAR', None)
+        self.assertEqual(self.driver.load_state_for_chat_user(1, 2), ('BAR', None))
+        self.assertEqual(self.driver.load_state_for_chat_user(2, 1), (None, None))
+    # end def
+
+    def test_none_ids(self):
+        self.driver.save_state_for_chat_user(None, 2, 'INLINE', None)
+        self.driver.save_state_for_chat_user(1, None, 'CHANNEL', None)
+        self.assertEqual(self.driver.load_state_for_chat_user(None, 2), ('INLINE', None))
+        self.assertEqual(self.driver.load_state_for_chat_user(1, None), ('CHANNEL', None))
+    # end def
+
+    def test_bulk(self):
+        self.driver.save_state_for_chat_user(1, 1, 'OLD', 'old')
+        self.driver.save_states_bulk([
+            (1, 1, 'ONE', 1),
+            (1, 2, 'TWO', {'two': 2}),
+            (None, 3, 'THREE', [3]),
+        ])
+        self.assertEqual(
+            self.driver.load_states_bulk([(1, 1), (1, 2), (None, 3), (2, 1), (1, 3)]),
+            {
+                (1, 1): ('ONE', 1),
+                (1, 2): ('TWO', {'two': 2}),
+                (None, 3): ('THREE', [3]),
+                (2, 1): (None, None),
+                (1, 3): (None, None),
+            }
+        )
+        self.assertEqual(self.driver.load_state_for_chat_user(1, 2), ('TWO', {'two': 2}))
+        self.assertEqual(self.driver.load_states_bulk([]), {})
+        self.driver.save_states_bulk([])
+    # end def
+
+    def test_versioned_save(self):
+        from telestate.database_driver import StateVersionConflict
+        if not self.driver.supports_versioning:
+            self.skipTest('driver does not support versioning')
+        # end if
+        self.assertEqual(self.driver.load_state_versioned(1, 2), (None, None, None))
+        self.driver.save_state_versioned(1, 2, 'A', 1, None)
+        with self.assertRaises(StateVersionConflict, msg='created by someone else already'):
+            self.driver.save_state_versioned(1, 2, 'B', 2, None)
+        # end with
+        state_name, state_data, version = self.driver.load_state_versioned(1, 2)
+        self.assertEqual((state_name, state_data), ('A', 1))
+        self.driver.save_state_versioned(1, 2, 'B', 2, version)
+        with self.assertRaises(StateVersionConflict, msg='saved by someone else in the meantime'):
+            self.driver.save_state_versioned(1, 2, 'C', 3, version)
+        # end with
+        state_name, state_data, version = self.driver.load_state_versioned(1, 2)
+        self.driver.save_state_for_chat_user(1, 2, 'D', 4)  # unversioned saves count as well
+        with self.assertRaises(StateVersionConflict):
+            self.driver.save_state_versioned(1, 2, 'E', 5, version)
+        # end with
+        self.assertEqual(self.driver.load_state_for_chat_user(1, 2), ('D', 4))
+        self.assertEqual(
+            self.driver.load_states_versioned_bulk([(1, 2), (5, 5)]),
+            {(1, 2): self.driver.load_state_versioned(1, 2), (5, 5): (None, None, None)},
+        )
+        state_name, state_data, version = self.driver.load_state_versioned(None, 3)
+        self.driver.save_state_versioned(None, 3, 'F', 6, version)
+        self.assertEqual(self.driver.load_state_for_chat_user(None, 3), ('F', 6))
+    # end def
+
+    def test_bytes(self):
+        if not self.driver.supports_bytes:
+            self.skipTest('driver does not support bytes')
+        # end if
+        self.driver.save_state_for_chat_user(1, 2, 'FOO', b'\x01\x00\xffbar')
+        self.assertEqual(self.driver.load_state_for_chat_user(1, 2), ('FOO', b'\x01\x00\xffbar'))
+        self.driver.save_states_bulk([(1, 3, 'BAR', b'\x00')])
+        self.assertEqual(self.driver.load_states_bulk([(1, 3)]), {(1, 3): ('BAR', b'\x00')})
+    # end def
+# end class
+
+
+class SimpleDictDriverTestCase(DriverTestMixin, unittest.TestCase):
+    def setUp(self):
+        self.driver = SimpleDictDriver()
+    # end def
+
+    def test_dump(self):
+        self.driver.save_state_for_chat_user(1, 2, 'FOO', [3])
+        dump = self.driver.dump()
+        self.assertEqual(dump, {1: {2: ('FOO', [3])}})
+        dump[1][2] = ('BAR', None)
+        self.assertEqual(self.driver.load_state_for_chat_user(1, 2), ('FOO', [3]), 'dump should be a copy')
+    # end def
+# end class
+
+
+class BoundedSimpleDictDriverTestCase(DriverTestMixin, unittest.TestCase):
+    def setUp(self):
+        self.driver = SimpleDictDriver(max_entries=10)
+    # end def
+
+    def test_lru_eviction(self):
+        driver = SimpleDictDriver(max_entries=2)
+        driver.save_state_for_chat_user(1, 1, 'A', 1)
+        driver.save_state_for_chat_user(1, 2, 'B', 2)
+        driver.load_state_for_chat_user(1, 1)  # now 1|2 is the least recently used one.
+        driver.save_state_for_chat_user(2, 3, 'C', 3)
+        self.assertEqual(driver.load_state_for_chat_user(1, 2), (None, None))
+        self.assertEqual(driver.load_state_for_chat_user(1, 1), ('A', 1))
+        self.assertEqual(driver.load_state_for_chat_user(2, 3), ('C', 3))
+        stats = driver.stats()
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual((stats['hits'], stats['misses']), (3, 1))
+        self.assertEqual(stats['hit_rate'], 0.75)
+    # end def
+
+    def test_byte_budget(self):
+        driver = SimpleDictDriver(max_bytes=2000)
+        for i in range(100):
+            driver.save_state_for_chat_user(1, i, 'A', 'x' * 100)
+        # end for
+        stats = driver.stats()
+        self.assertLessEqual(stats['bytes'], 2000)
+        self.assertGreater(stats['entries'], 0)
+        self.assertEqual(stats['entries'] + stats['evictions'], 100)
+        self.assertEqual(driver.load_state_for_chat_user(1, 99), ('A', 'x' * 100))
+    # end def
+
+    def test_ttl(self):
+        driver = SimpleDictDriver(ttl=0.01)
+        driver.save_state_for_chat_user(1, 1, 'A', 1)
+        time.sleep(0.02)
+        self.assertEqual(driver.load_state_for_chat_user(1, 1), (None, None))
+        self.assertEqual(driver.stats()['expirations'], 1)
+        self.assertEqual(driver.cache, {})
+    # end def
+
+    def test_backing_driver(self):
+        backing = SimpleDictDriver()
+        driver = SimpleDictDriver(max_entries=1, backing_driver=backing)
+        driver.save_state_for_chat_user(1, 1, 'A', 1)
+        driver.save_state_for_chat_user(1, 2, 'B', 2)
+        self.assertEqual(driver.stats()['entries'], 1)
+        self.assertEqual(driver.load_state_for_chat_user(1, 1), ('A', 1), 'loaded from the backing driver')
+        self.assertEqual(driver.load_states_bulk([(1, 1), (1, 2), (1, 3)]), {
+            (1, 1): ('A', 1), (1, 2): ('B', 2), (1, 3): (None, None),
+        })
+    # end def
+# end class
+
+
+class JournaledDictDriverTestCase(DriverTestMixin, unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        from telestate.contrib.journal import JournaledDictDriver
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = self.tmp.name + '/states'
+        self.driver = JournaledDictDriver(self.path, fsync_interval=0, compact_every=5)
+    # end def
+
+    def tearDown(self):
+        self.driver.close()
+        self.tmp.cleanup()
+    # end def
+
+    def reopen(self):
+        from telestate.contrib.journal import JournaledDictDriver
+        self.driver.close()
+        self.driver = JournaledDictDriver(self.path, fsync_interval=None, compact_every=5)
+        return self.driver
+    # end def
+
+    def test_replay(self):
+        self.driver.save_state_for_chat_user(1, 1, 'A', {'a': 1})
+        self.driver.save_state_for_chat_user(1, 1, 'B', {'b': 2})
+        self.driver.save_state_for_chat_user(None, 2, 'C', None)
+        driver = self.reopen()
+        self.assertEqual(driver.load_state_for_chat_user(1, 1), ('B', {'b': 2}))
+        self.assertEqual(driver.load_state_for_chat_user(None, 2), ('C', None))
+        self.assertEqual(driver.journal_entries, 3)
+    # end def
+
+    def test_compaction(self):
+        for i in range(7):
+            self.driver.save_state_for_chat_user(1, i % 3, 'A', i)
+        # end for
+        self.assertEqual(self.driver.journal_entries, 2, 'compacted after 5 saves')
+        with open(self.path + '.snapshot') as f:
+            self.assertEqual(len(f.readlines()), 3, 'one line per user')
+        # end with
+        driver = self.reopen()
+        self.assertEqual(driver.load_states_bulk([(1, 0), (1, 1), (1, 2)]), {(1, 0): ('A', 6), (1, 1): ('A', 4), (1, 2): ('A', 5)})
+    # end def
+
+    def test_broken_last_line(self):
+        self.driver.save_state_for_chat_user(1, 1, 'A', 1)
+        self.driver.close()
+        with open(self.path + '.journal', 'a') as f:
+            f.write('[1,2,"HALF_WRIT')
+        # end with
+        driver = self.reopen()
+        self.assertEqual(driver.load_state_for_chat_user(1, 1), ('A', 1))
+        self.assertEqual(driver.load_state_for_chat_user(1, 2), (None, None))
+        driver.save_state_for_chat_user(1, 3, 'B', 2)
+        driver = self.reopen()
+        self.assertEqual(driver.load_state_for_chat_user(1, 3), ('B', 2), 'should not be appended to the broken line')
+    # end def
+
+    def test_fsync_when_idle(self):
+        from unittest.mock import patch
+        from telestate.contrib.journal import JournaledDictDriver
+        self.driver.close()
+        synced = []
+        with patch('telestate.contrib.journal.os.fsync', side_effect=synced.append):
+            self.driver = JournaledDictDriver(self.path, fsync_interval=0.05, compact_every=5)
+            self.driver.save_state_for_chat_user(1, 1, 'A', 1)  # too soon after opening to fsync right away.
+            deadline = time.monotonic() + 5
+            while not synced and time.monotonic() < deadline:
+                time.sleep(0.01)
+            # end while
+            self.assertEqual(synced, [self.driver._journal.fileno()], 'synced without another save')
+            time.sleep(0.15)
+            self.assertEqual(len(synced), 1, 'nothing new to sync')
+            self.driver.close()
+        # end with
+        self.assertFalse(self.driver._fsync_thread.is_alive())
+    # end def
+
+    def test_crash_while_compacting(self):
+        self.driver.save_state_for_chat_user(1, 1, 'A', 1)
+        self.driver.save_state_for_chat_user(1, 2, 'B', 2)
+        self.driver.close()
+        # as if we crashed after moving the journal aside, but before writing the snapshot.
+        os.replace(self.path + '.journal', self.path + '.journal.compacting')
+        with open(self.path + '.journal', 'w') as f:
+            f.write('[1,1,"C",3]\n')
+        # end with
+        driver = self.reopen()
+        self.assertEqual(driver.load_states_bulk([(1, 1), (1, 2)]), {(1, 1): ('C', 3), (1, 2): ('B', 2)})
+        self.assertFalse(os.path.exists(self.path + '.journal.compacting'))
+        driver = self.reopen()
+        self.assertEqual(driver.load_states_bulk([(1, 1), (1, 2)]), {(1, 1): ('C', 3), (1, 2): ('B', 2)})
+    # end def
+
+    def test_failed_snapshot_keeps_journal(self):
+        from unittest.mock import patch
+        for i in range(4):
+            self.driver.save_state_for_chat_user(1, i, 'A', i)
+        # end for
+        with patch.object(self.driver, '_write_snapshot', side_effect=OSError('disk full')):
+            for i in range(4, 10):
+                self.driver.save_state_for_chat_user(1, i, 'A', i)  # compacting fails twice, but the saves don't.
+            # end for
+        # end with
+        self.assertTrue(os.path.exists(self.path + '.journal.compacting'))
+        driver = self.reopen()  # as if we crashed now.
+        self.assertEqual(driver.load_states_bulk([(1, i) for i in range(10)]), {(1, i): ('A', i) for i in range(10)})
+        self.assertFalse(os.path.exists(self.path + '.journal.compacting'))
+        driver.compact()
+        driver = self.reopen()
+        self.assertEqual(driver.load_states_bulk([(1, i) for i in range(10)]), {(1, i): ('A', i) for i in range(10)})
+    # end def
+# end class
+
+
+class WriteBehindDriverTestCase(DriverTestMixin, unittest.TestCase):
+    def setUp(self):
+        from telestate.contrib.write_behind import WriteBehindDriver
+        self.inner = SimpleDictDriver()
+        self.driver = WriteBehindDriver(self.inner, max_pending=10, flush_size=3, flush_interval=None)
+    # end def
+
+    def tearDown(self):
+        self.driver.close()
+    # end def
+
+    def test_coalesce_and_flush(self):
+        self.driver.save_state_for_chat_user(1, 1, 'A', 1)
+        self.driver.save_state_for_chat_user(1, 1, 'B', 2)
+        self.driver.save_state_for_chat_user(1, 2, 'C', 3)
+        self.assertEqual(self.driver.pending, 2)
+        self.assertEqual(self.driver.coalesced, 1)
+        self.assertEqual(self.inner.load_state_for_chat_user(1, 1), (None, None), 'not written yet')
+        self.assertEqual(self.driver.load_state_for_chat_user(1, 1), ('B', 2), 'answered from the buffer')
+
+        self.driver.save_state_for_chat_user(1, 3, 'D', 4)  # reaches flush_size
+        self.assertEqual(self.driver.pending, 0)
+        self.assertEqual((self.driver.flushes, self.driver.flushed), (1, 3))
+        self.assertEqual(self.inner.load_state_for_chat_user(1, 1), ('B', 2))
+    # end def
+
+    def test_close_flushes(self):
+        self.driver.save_state_for_chat_user(1, 1, 'A', 1)
+        self.driver.close()
+        self.assertEqual(self.inner.load_state_for_chat_user(1, 1), ('A', 1))
+        self.driver.save_state_for_chat_user(1, 1, 'B', 2)
+        self.assertEqual(self.inner.load_state_for_chat_user(1, 1), ('B', 2), 'written through after closing')
+    # end def
+
+    def test_failed_flush_keeps_states(self):
+        from unittest.mock import MagicMock
+        self.inner.save_states_bulk = MagicMock(side_effect=IOError('database gone'))
+        self.driver.save_state_for_chat_user(1, 1, 'A', 1)
+        with self.assertRaises(IOError):
+            self.driver.flush()
+        # end with
+        self.assertEqual(self.driver.pending, 1)
+        self.assertEqual(self.driver.load_state_for_chat_user(1, 1), ('A', 1))
+        del self.inner.save_states_bulk
+        self.assertEqual(self.driver.flush(), 1)
+    # end def
+
+    def test_failed_flush_respects_max_pending(self):
+        from unittest.mock import MagicMock
+        self.inner.save_states_bulk = MagicMock(side_effect=IOError('database gone'))
+        for i in range(10):
+            try:
+                self.driver.save_state_for_chat_user(1, i, 'A', i)
+            except IOError:
+                pass  # the flush at flush_size failed, the state is buffered anyway.
+            # end try
+        # end for
+        self.assertEqual(self.driver.pending, 10)
+        with self.assertRaises(IOError):
+            self.driver.save_state_for_chat_user(1, 10, 'A', 10)  # full, the flush to make room fails.
+        # end with
+        self.assertEqual(self.driver.pending, 10, 'not buffered')
+        with self.assertRaises(IOError):
+            self.driver.save_state_for_chat_user(1, 0, 'B', 0)  # replacing a buffered one still works, just the flush fails.
+        # end with
+        self.assertEqual(self.driver.pending, 10)
+        self.assertEqual(self.driver.load_state_for_chat_user(1, 0), ('B', 0))
+        del self.inner.save_states_bulk
+        self.driver.save_state_for_chat_user(1, 10, 'A', 10)
+        self.assertEqual(self.driver.pending, 1)
+        self.assertEqual(self.inner.load_state_for_chat_user(1, 0), ('B', 0))
+    # end def
+
+    def test_buffered_data_is_copied(self):
+        data = {'items': [1]}
+        self.driver.save_state_for_chat_user(1, 1, 'A', data)
+        data['items'].append(2)
+        loaded = self.driver.load_state_for_chat_user(1, 1)[1]
+        self.assertEqual(loaded, {'items': [1]}, 'saved object changed afterwards')
+        loaded['items'].append(3)
+        self.assertEqual(self.driver.load_state_for_chat_user(1, 1), ('A', {'items': [1]}), 'loaded object changed')
+        self.assertEqual(self.driver.load_states_bulk([(1, 1)]), {(1, 1): ('A', {'items': [1]})})
+    # end def
+
+    def test_background_flush(self):
+        from telestate.contrib.write_behind import WriteBehindDriver
+        driver = WriteBehindDriver(self.inner, max_pending=2, flush_size=2, flush_interval=0.01)
+        for i in range(10):
+            driver.save_state_for_chat_user(i, i, 'A', i)  # blocks while the buffer is full
+        # end for
+        driver.close()
+        self.assertEqual(driver.pending, 0)
+        self.assertEqual(driver.flushed, 10)
+        self.assertEqual(self.inner.load_state_for_chat_user(9, 9), ('A', 9))
+    # end def
+# end class
+
+
+class SqliteDriverTestCase(DriverTestMixin, unittest.TestCase):
+    def setUp(self):
+        from telestate.contrib.sqlite import SqliteDriver
+        self.driver = SqliteDriver(':memory:')
+    # end def
+
+    def tearDown(self):
+        self.driver.close()
+    # end def
+
+    def test_persistence(self):
+        import tempfile
+        from telestate.contrib.sqlite import SqliteDriver
+        with tempfile.TemporaryDirectory() as tmp:
+            driver = SqliteDriver(tmp + '/states.sqlite')
+            driver.save_state_for_chat_user(1, None, 'A', {'a': 1})
+            driver.save_state_for_chat_user(1, None, 'B', {'b': 2})
+            driver.close()
+            driver = SqliteDriver(tmp + '/states.sqlite')
+            self.assertEqual(driver.load_state_for_chat_user(1, None), ('B', {'b': 2}))
+            self.assertEqual(driver._connection.execute('SELECT COUNT(*) FROM telestate').fetchone(), (1,))
+            driver.close()
+        # end with
+    # end def
+
+    def test_table_without_version(self):
+        import sqlite3
+        import tempfile
+        from telestate.contrib.sqlite import SqliteDriver
+        with tempfile.TemporaryDirectory() as tmp:
+            connection = sqlite3.connect(tmp + '/states.sqlite')
+            connection.execute(  # as created before versioning was added.
+                'CREATE TABLE telestate (chat_id NOT NULL, user_id NOT NULL, state TEXT, data TEXT,'
+                ' PRIMARY KEY (chat_id, user_id)) WITHOUT ROWID'
+            )
+            connection.execute('INSERT INTO telestate VALUES (1, 2, \'OLD\', \'1\')')
+            connection.commit()
+            connection.close()
+            driver = SqliteDriver(tmp + '/states.sqlite')
+            state_name, state_data, version = driver.load_state_versioned(1, 2)
+            self.assertEqual((state_name, state_data), ('OLD', 1))
+            driver.save_state_versioned(1, 2, 'NEW', 2, version)
+            self.assertEqual(driver.load_state_for_chat_user(1, 2), ('NEW', 2))
+            driver.close()
+        # end with
+    # end def
+
+    def test_bulk_chunks(self):
+        self.driver.save_states_bulk([(1, i, 'A', i) for i in range(1000)])
+        loaded = self.driver.load_states_bulk([(1, i) for i in range(1001)])
+        self.assertEqual(loaded[(1, 999)], ('A', 999))
+        self.assertEqual(loaded[(1, 1000)], (None, None))
+        self.assertEqual(len(loaded), 1001)
+    # end def
+
+    def test_invalid_table(self):
+        from telestate.contrib.sqlite import SqliteDriver
+        with self.assertRaises(ValueError):
+            SqliteDriver(':memory:', table='states; DROP TABLE x')
+        # end with
+    # end def
+# end class
+
+
+@unittest.skipIf(mongomock is None, 'mongomock is not installed')
+class MongoDriverTestCase(DriverTestMixin, unittest.TestCase):
+    def setUp(self):
+        from telestate.contrib.mongo import MongoDriver
+        self.collection = mongomock.MongoClient().db.states
+        self.driver = MongoDriver(self.collection)
+    # end def
+
+    def test_upsert_single_document(self):
+        self.driver.save_state_for_chat_user(1, 2, 'A', 1)
+        self.driver.save_state_for_chat_user(1, 2, 'B', 2)
+        self.driver.save_states_bulk([(1, 2, 'C', 3)])
+        self.assertEqual(self.collection.count_documents({}), 1)
+        self.assertEqual(self.driver.load_state_for_chat_user(1, 2), ('C', 3))
+    # end def
+
+    def test_unique_index(self):
+        from telestate.contrib.mongo import MongoDriver
+        info = self.collection.index_information()[MongoDriver.INDEX_NAME]
+        self.assertEqual(info['key'], [('chat_id', 1), ('user_id', 1)])
+        self.assertTrue(info['unique'])
+        MongoDriver(self.collection)  # ensuring again is fine
+    # end def
+# end class
+
+
+@unittest.skipIf(orm is None, 'pony is not installed')
+class PonyDriverTestCase(DriverTestMixin, unittest.TestCase):
+    def setUp(self):
+        from telestate.contrib.pony_orm import PonyDriver
+        db = orm.Database()
+        self.driver = PonyDriver(db, versioning=True)
+        db.bind(provider='sqlite', filename=':memory:')
+        db.generate_mapping(create_tables=True)
+    # end def
+
+    def test_table_without_version(self):
+        from telestate.contrib.pony_orm import PonyDriver
+        db = orm.Database()
+        db.bind(provider='sqlite', filename=':memory:')
+        with orm.db_session:
+            # as created by the previous release.
+            db.execute(
+                'CREATE TABLE "State" ("id" INTEGER PRIMARY KEY AUTOINCREMENT, "user_id" INTEGER, "chat_id" INTEGER,'
+                ' "state" TEXT NOT NULL, "data" JSON, CONSTRAINT "unq_state__chat_id_user_id" UNIQUE ("chat_id", "user_id"))'
+            )
+            db.execute('INSERT INTO "State" ("chat_id", "user_id", "state", "data") VALUES (1, 2, \'OLD\', \'1\')')
+        # end with
+        driver = PonyDriver(db)
+        db.generate_mapping(create_tables=True)
+        self.assertFalse(driver.supports_versioning)
+        self.assertEqual(driver.load_state_versioned(1, 2), ('OLD', 1, None))
+        driver.save_state_versioned(1, 2, 'NEW', 2, None)
+        self.assertEqual(driver.load_state_for_chat_user(1, 2), ('NEW', 2))
+    # end def
+
+    def test_single_row_per_user(self):
+        for chat_id, user_id in [(1, 2), (None, 2), (1, None)]:
+            self.driver.save_state_for_chat_user(chat_id, user_id, 'A', 1)
+            self.driver.save_states_bulk([(chat_id, user_id, 'B', 2)])
+            self.driver.save_state_for_chat_user(chat_id, user_id, 'C', 3)
+        # end for
+        with orm.db_session:
+            self.assertEqual(self.driver.StateTable.select().count(), 3)
+        # end with
+    # end def
+
+    def test_retry_on_concurrent_insert(self):
+        from unittest.mock import MagicMock, patch
+        original_select = self.driver.StateTable.select
+        attempts = []
+
+        def select_racing(*args, **kwargs):
+            attempts.append(True)
+            if len(attempts) > 1:
+                return original_select(*args, **kwargs)
+            # end if
+            # in the first attempt, another worker creates the row right after we found none.
+            self.driver.StateTable._database_.execute("INSERT INTO State (chat_id, user_id, state, version) VALUES (1, 2, 'OTHER', 1)")
+            query = MagicMock()
+            query.for_update.return_value.first.return_value = None
+            return query
+        # end def
+
+        with patch.object(self.driver.StateTable, 'select', side_effect=select_racing):
+            self.driver.save_state_for_chat_user(1, 2, 'MINE', None)
+        # end with
+        self.assertEqual(len(attempts), 2, 'should be retried once')
+        self.assertEqual(self.driver.load_state_for_chat_user(1, 2), ('MINE', None))
+    # end def
+
+    def test_session_reuses_loaded_row(self):
+        from unittest.mock import patch
+        self.driver.save_state_for_chat_user(1, 2, 'A', 1)
+        with patch.object(self.driver.StateTable, 'select', wraps=self.driver.StateTable.select) as select:
+            with self.driver.session(1, 2):
+                self.assertEqual(self.driver.load_state_for_chat_user(1, 2), ('A', 1))
+                self.driver.save_state_for_chat_user(1, 2, 'B', 2)
+            # end with
+            self.assertEqual(select.call_count, 0, 'should update the loaded row')
+        # end with
+        self.assertEqual(self.driver.load_state_for_chat_user(1, 2), ('B', 2))
+    # end def
+
+    def test_session_commit_conflict(self):
+        with self.driver.session(1, 2):
+            self.assertEqual(self.driver.load_state_for_chat_user(1, 2), (None, None))
+            # another worker creates the row meanwhile.
+            self.driver.StateTable._database_.execute("INSERT INTO State (chat_id, user_id, state, version) VALUES (1, 2, 'OTHER', 1)")
+            self.driver.save_state_for_chat_user(1, 2, 'MINE', None)
+        # end with
+        self.assertEqual(self.driver.load_state_for_chat_user(1, 2), ('MINE', None))
+    # end def
+
+    def test_session_version_conflict(self):
+        from telestate.database_driver import StateVersionConflict
+        self.driver.save_state_for_chat_user(1, 2, 'A', 1)
+        with self.assertRaises(StateVersionConflict):
+            with self.driver.session(1, 2):
+                state_name, state_data, version = self.driver.load_state_versioned(1, 2)
+                # another worker saves meanwhile.
+                self.driver.StateTable._database_.execute("UPDATE State SET state = 'OTHER', version = version + 1")
+                self.driver.save_state_versioned(1, 2, 'MINE', None, version)
+            # end with
+        # end with
+        self.assertEqual(self.driver.load_state_for_chat_user(1, 2), ('A', 1), 'rolled back')
+    # end def
+
+    def test_session_rolls_back_on_error(self):
+        with self.assertRaises(ValueError):
+            with self.driver.session(1, 2):
+                self.driver.save_state_for_chat_user(1, 2, 'A', 1)
+                raise ValueError('listener failed')
+            # end with
+        # end with
+        self.assertEqual(self.driver.load_state_for_chat_user(1, 2), (None, None))
+    # end def
+# end class
+
+
+if __name__ == '__main__':
+    unittest.main()
+# end if
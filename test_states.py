@@ -448,15 +448,870 @@ class MyTestCase(unittest.TestCase):
         self.d.load_state_for_chat_user.assert_called_with(update1.message.chat.id, update1.message.from_peer.id)
         self.d.save_state_for_chat_user.assert_called_with(update1.message.chat.id, update1.message.from_peer.id, 'DEFAULT', None)
     # end def
+
+    def test_parallel_updates_isolated(self):
+        import threading
+        from unittest.mock import MagicMock
+        self.m.BEST_PONY = self.s
+        self.d.save_state_for_chat_user: MagicMock = MagicMock(return_value=None)
+        barrier = threading.Barrier(2, timeout=5)
+        seen = {}
+
+        @self.m.DEFAULT.on_update('message')
+        def switch_state(update):
+            self.m.BEST_PONY.activate(data=update.update_id)
+            barrier.wait()  # both threads switched their state now.
+            seen[update.update_id] = (self.m.CURRENT.name, self.m.CURRENT.data, self.m.CURRENT.update)
+        # end def
+
+        updates = [
+            Update(
+                update_id=i,
+                message=Message(
+                    message_id=i, date=0, chat=Chat(id=i, type='private'),
+                    from_peer=User(id=i, is_bot=False, first_name="user"), text="foo"
+                ),
+            )
+            for i in (1, 2)
+        ]
+        threads = [threading.Thread(target=self.m.process_update, args=(u,)) for u in updates]
+        for t in threads:
+            t.start()
+        # end for
+        for t in threads:
+            t.join()
+        # end for
+        self.assertEqual(seen[1], ('BEST_PONY', 1, updates[0]))
+        self.assertEqual(seen[2], ('BEST_PONY', 2, updates[1]))
+        self.d.save_state_for_chat_user.assert_any_call(1, 1, 'BEST_PONY', 1)
+        self.d.save_state_for_chat_user.assert_any_call(2, 2, 'BEST_PONY', 2)
+        self.assertEqual(self.m.CURRENT, self.m.DEFAULT, 'processing should not leak into the default context.')
+    # end def
+
+    def test_process_update_async_sync_driver(self):
+        import asyncio
+        from unittest.mock import MagicMock
+        self.m.BEST_PONY = self.s
+        self.d.save_state_for_chat_user: MagicMock = MagicMock(return_value=None)
+        self.m.process_result = MagicMock(return_value=None)
+
+        @self.m.DEFAULT.on_update('message')
+        async def switch_state(update):
+            await asyncio.sleep(0)
+            self.m.BEST_PONY.activate(data={'awaited': True})
+            return "async result"
+        # end def
+
+        asyncio.run(self.m.process_update_async(update1))
+        self.d.save_state_for_chat_user.assert_called_with(1234, 4458, 'BEST_PONY', {'awaited': True})
+        self.m.process_result.assert_called_with(update1, "async result")
+    # end def
+
+    def test_process_update_async_driver(self):
+        import asyncio
+        from telestate import AsyncTeleStateDatabaseDriver
+
+        class AsyncDictDriver(AsyncTeleStateDatabaseDriver):
+            def __init__(self):
+                self.states = {(1234, 4458): ('BEST_PONY', 'stored')}
+            # end def
+
+            async def load_state_for_chat_user(self, chat_id, user_id):
+                return self.states.get((chat_id, user_id), (None, None))
+            # end def
+
+            async def save_state_for_chat_user(self, chat_id, user_id, state_name, state_data):
+                self.states[chat_id, user_id] = (state_name, state_data)
+            # end def
+        # end class
+
+        driver = AsyncDictDriver()
+        m = TeleStateMachine(__name__, driver, self.b)
+        m.BEST_PONY = TeleState()
+        seen = []
+
+        @m.BEST_PONY.on_update('message')
+        def sync_listener(update):
+            seen.append(m.CURRENT.data)
+            m.DEFAULT.activate(data='done')
+        # end def
+
+        asyncio.run(m.process_update_async(update1))
+        self.assertEqual(seen, ['stored'])
+        self.assertEqual(driver.states[1234, 4458], ('DEFAULT', 'done'))
+        with self.assertRaises(TypeError):
+            m.process_update(update1)
+        # end with
+    # end def
+
+    def test_process_updates_bulk(self):
+        from unittest.mock import MagicMock
+        self.m.BEST_PONY = self.s
+        self.d.load_states_bulk: MagicMock = MagicMock(return_value={(1234, 4458): ('BEST_PONY', 0)})
+        self.d.save_states_bulk: MagicMock = MagicMock(return_value=None)
+        self.d.load_state_for_chat_user: MagicMock = MagicMock(return_value=(None, None))
+        self.d.save_state_for_chat_user: MagicMock = MagicMock(return_value=None)
+
+        @self.m.BEST_PONY.on_update('message')
+        def count(update):
+            self.m.CURRENT.set_data(self.m.CURRENT.data + 1)
+        # end def
+
+        self.m.process_updates([update1, update1, update1])
+        self.d.load_states_bulk.assert_called_once_with({(1234, 4458)})
+        self.assertEqual(list(self.d.save_states_bulk.call_args[0][0]), [(1234, 4458, 'BEST_PONY', 3)])
+        self.d.load_state_for_chat_user.assert_not_called()
+        self.d.save_state_for_chat_user.assert_not_called()
+    # end def
+
+    def test_process_updates_bulk_save_failure(self):
+        from unittest.mock import MagicMock, call
+        other_user = update1.to_array()
+        other_user['message']['from']['id'] = 1
+        self.d.load_states_bulk: MagicMock = MagicMock(return_value={})
+        self.d.save_states_bulk: MagicMock = MagicMock(side_effect=IOError('batch too large'))
+        saved = []
+
+        def save_state_for_chat_user(chat_id, user_id, state_name, state_data):
+            if user_id == 4458:
+                raise ConnectionError('database is gone')
+            # end if
+            saved.append((chat_id, user_id, state_name, state_data))
+        # end def
+        self.d.save_state_for_chat_user: MagicMock = MagicMock(side_effect=save_state_for_chat_user)
+
+        @self.m.DEFAULT.on_update('message')
+        def count(update):
+            self.m.CURRENT.set_data((self.m.CURRENT.data or 0) + 1)
+        # end def
+
+        with self.assertRaises(ConnectionError, msg='the one failing again is raised'):
+            self.m.process_updates([update1, other_user])
+        # end with
+        self.d.save_states_bulk.assert_called_once()
+        self.assertEqual(self.d.save_state_for_chat_user.call_args_list, [
+            call(1234, 4458, 'DEFAULT', 1), call(1234, 1, 'DEFAULT', 1),
+        ])
+        self.assertEqual(saved, [(1234, 1, 'DEFAULT', 1)], 'the other one is still saved')
+    # end def
+
+    def test_process_updates_bulk_versioned(self):
+        from contextlib import contextmanager
+        from telestate.contrib.simple import SimpleDictDriver
+        from telestate.database_driver import StateVersionConflict
+        driver = SimpleDictDriver()
+        machine = TeleStateMachine(__name__, driver, self.b)
+        sessions = []
+
+        @contextmanager
+        def session(chat_id, user_id):
+            sessions.append((chat_id, user_id))
+            yield
+        # end def
+        driver.session = session
+        other_user = update1.to_array()
+        other_user['message']['from']['id'] = 1
+        interfere = {4458: 1, 1: 0}  # how often another process saves a state, while processing the user's updates.
+
+        @machine.DEFAULT.on_update('message')
+        def count(update):
+            user_id = update.message.from_peer.id
+            if interfere[user_id]:
+                interfere[user_id] -= 1
+                driver.save_state_for_chat_user(1234, user_id, 'DEFAULT', 10)
+            # end if
+            machine.CURRENT.data = (machine.CURRENT.data or 0) + 1
+        # end def
+
+        machine.process_updates([update1, other_user, update1.to_array()])
+        self.assertEqual(driver.load_state_for_chat_user(1234, 4458), ('DEFAULT', 12), 'loaded again, and both updates processed again')
+        self.assertEqual(driver.load_state_for_chat_user(1234, 1), ('DEFAULT', 1))
+        self.assertEqual(machine.conflicts, 1)
+        self.assertEqual(sessions, [(1234, 4458), (1234, 4458), (1234, 1)])
+
+        machine.conflict_retries = 0
+        interfere.update({4458: 1, 1: 0})
+        with self.assertRaises(StateVersionConflict):
+            machine.process_updates([update1, other_user])
+        # end with
+        self.assertEqual(driver.load_state_for_chat_user(1234, 4458), ('DEFAULT', 10), 'the other process won')
+        self.assertEqual(driver.load_state_for_chat_user(1234, 1), ('DEFAULT', 2), 'other users are still saved')
+    # end def
+
+    def test_skip_unchanged_save(self):
+        from unittest.mock import MagicMock
+        self.m.BEST_PONY = self.s
+        self.d.load_state_for_chat_user: MagicMock = MagicMock(side_effect=lambda c, u: ('BEST_PONY', {'count': 1}))
+        self.d.save_state_for_chat_user: MagicMock = MagicMock(return_value=None)
+        increase = [False]
+
+        @self.m.BEST_PONY.on_update('message')
+        def maybe_count(update):
+            if increase[0]:
+                self.m.CURRENT.data['count'] += 1  # modified in place
+            # end if
+        # end def
+
+        self.m.process_update(update1)
+        self.d.save_state_for_chat_user.assert_not_called()
+        self.assertEqual((self.m.saves_performed, self.m.saves_skipped), (0, 1))
+
+        increase[0] = True
+        self.m.process_update(update1)
+        self.d.save_state_for_chat_user.assert_called_once_with(1234, 4458, 'BEST_PONY', {'count': 2})
+        self.assertEqual((self.m.saves_performed, self.m.saves_skipped), (1, 1))
+
+        self.m.skip_unchanged_saves = False
+        increase[0] = False
+        self.m.process_update(update1)
+        self.assertEqual(self.d.save_state_for_chat_user.call_count, 2)
+    # end def
+
+    def test_lazy_data(self):
+        from unittest.mock import MagicMock
+        self.m.lazy_data = True
+        self.m.BEST_PONY = self.s
+        self.m.deserialize = MagicMock(side_effect=lambda name, data: dict(data))
+        self.m.serialize = MagicMock(side_effect=lambda name, data: dict(data))
+        self.d.load_state_for_chat_user: MagicMock = MagicMock(side_effect=lambda c, u: ('BEST_PONY', {'count': 1}))
+        self.d.save_state_for_chat_user: MagicMock = MagicMock(return_value=None)
+        action = [None]
+
+        @self.m.BEST_PONY.on_update('message')
+        def maybe_count(update):
+            if action[0] == 'read':
+                self.assertEqual(self.m.CURRENT.data, {'count': 1})
+            elif action[0] == 'count':
+                self.m.CURRENT.data['count'] += 1
+            elif action[0] == 'switch':
+                self.m.set('DEFAULT')  # keeps the data
+            # end if
+        # end def
+
+        self.m.process_update(update1)
+        self.m.deserialize.assert_not_called()
+        self.m.serialize.assert_not_called()
+        self.d.save_state_for_chat_user.assert_not_called()
+
+        action[0] = 'read'
+        self.m.process_update(update1)
+        self.assertEqual(self.m.deserialize.call_count, 1)
+        self.d.save_state_for_chat_user.assert_not_called()
+
+        action[0] = 'count'
+        self.m.process_update(update1)
+        self.assertEqual(self.m.deserialize.call_count, 2)
+        self.d.save_state_for_chat_user.assert_called_once_with(1234, 4458, 'BEST_PONY', {'count': 2})
+
+        action[0] = 'switch'
+        self.m.process_update(update1)
+        self.m.deserialize.assert_called_with('BEST_PONY', {'count': 1})
+        self.d.save_state_for_chat_user.assert_called_with(1234, 4458, 'DEFAULT', {'count': 1})
+
+        self.m.skip_unchanged_saves = False
+        action[0] = None
+        serialize_calls = self.m.serialize.call_count
+        self.m.process_update(update1)
+        self.assertEqual(self.m.serialize.call_count, serialize_calls)
+        self.d.save_state_for_chat_user.assert_called_with(1234, 4458, 'BEST_PONY', {'count': 1})
+    # end def
+
+    def test_lazy_data_deserialize_error(self):
+        from unittest.mock import MagicMock
+        self.m.lazy_data = True
+        self.m.BEST_PONY = self.s
+        self.m.deserialize = MagicMock(side_effect=ValueError('broken data'))
+        self.d.load_state_for_chat_user: MagicMock = MagicMock(side_effect=lambda c, u: ('BEST_PONY', {'count': 1}))
+        self.d.save_state_for_chat_user: MagicMock = MagicMock(return_value=None)
+        seen = []
+
+        @self.m.BEST_PONY.on_update('message')
+        def read(update):
+            seen.append(self.m.CURRENT.data)
+            seen.append(self.m.CURRENT.name)
+        # end def
+
+        self.m.process_update(update1)
+        self.assertEqual(seen, [None, 'DEFAULT'], 'reset like the eager loading does')
+        self.d.save_state_for_chat_user.assert_called_once_with(1234, 4458, 'DEFAULT', None)
+    # end def
+
+    def test_state_codec(self):
+        import base64
+        from telestate import JsonCodec, PickleCodec
+        from telestate.contrib.simple import SimpleDictDriver
+        driver = SimpleDictDriver()
+        machine = TeleStateMachine(__name__, driver, self.b, codec=JsonCodec(compress_threshold=100))
+        machine.SMALL = TeleState('SMALL')
+        machine.LARGE = TeleState('LARGE')
+        machine.PICKLED = TeleState('PICKLED', codec=PickleCodec())
+        steps = ['SMALL', 'LARGE', 'PICKLED', 'SMALL']
+        seen = []
+
+        @machine.ALL.on_update('message')
+        def step(update):
+            seen.append((machine.CURRENT.name, machine.CURRENT.data))
+            state = steps.pop(0)
+            data = {'text': 'x' * 1000} if state == 'LARGE' else ({1, 2} if state == 'PICKLED' else {'n': len(steps)})
+            machine.set(state, data=data)
+        # end def
+
+        machine.process_update(update1)
+        state_name, state_data = driver.load_state_for_chat_user(1234, 4458)
+        self.assertEqual(state_name, 'SMALL')
+        self.assertEqual(state_data, b'\xf5TS\x00{"n":3}')
+        machine.process_update(update1)
+        state_name, state_data = driver.load_state_for_chat_user(1234, 4458)
+        self.assertEqual(state_data[:4], b'\xf5TS\x01', 'compressed')
+        self.assertLess(len(state_data), 100)
+        machine.process_update(update1)
+        machine.process_update(update1)
+        self.assertEqual(seen, [
+            ('DEFAULT', None), ('SMALL', {'n': 3}), ('LARGE', {'text': 'x' * 1000}), ('PICKLED', {1, 2}),
+        ])
+
+        # drivers which can't store bytes get it wrapped in a dict, and data stored before there was a codec still loads.
+        self.d.load_state_for_chat_user = lambda c, u: ('BEST_PONY', {'old': True})
+        saved = []
+        self.d.save_state_for_chat_user = lambda c, u, n, d: saved.append(d)
+        self.m.codec = JsonCodec()
+        self.m.BEST_PONY = self.s
+
+        @self.m.BEST_PONY.on_update('message')
+        def keep(update):
+            self.m.CURRENT.data['new'] = True
+        # end def
+
+        self.m.process_update(update1)
+        self.assertEqual(saved, [{'$codec': base64.b64encode(b'\xf5TS\x00{"old":true,"new":true}').decode('ascii')}])
+        self.assertEqual(self.m._decode_state_data('BEST_PONY', saved[0]), {'old': True, 'new': True})
+    # end def
+
+    def test_state_codec_data_stored_before(self):
+        import tempfile
+        from telestate import JsonCodec
+        from telestate.contrib.journal import JournaledDictDriver
+        from telestate.contrib.simple import SimpleDictDriver
+        with tempfile.TemporaryDirectory() as folder:
+            for driver in (SimpleDictDriver(), JournaledDictDriver(folder + '/states', fsync_interval=None)):
+                self.assertEqual(driver.supports_bytes, isinstance(driver, SimpleDictDriver) and not isinstance(driver, JournaledDictDriver))
+                machine = TeleStateMachine(__name__, driver, self.b, codec=JsonCodec())
+                machine.FOO = TeleState('FOO')
+                seen = []
+
+                @machine.FOO.on_update('message')
+                def keep(update):
+                    seen.append(machine.CURRENT.data)
+                    machine.CURRENT.data = [machine.CURRENT.data]
+                # end def
+
+                for data in ('hello world', {'plain': True}, 4458, None):
+                    driver.save_state_for_chat_user(1234, 4458, 'FOO', data)
+                    machine.process_update(update1)
+                    self.assertEqual(seen[-1], data, f'{data!r} with {driver!r}')
+                    machine.process_update(update1)
+                    self.assertEqual(seen[-1], [data], f'{data!r} with {driver!r}, now encoded')
+                # end for
+                if driver.supports_bytes:
+                    driver.save_state_for_chat_user(1234, 4458, 'FOO', b'\x00\x01')
+                    machine.process_update(update1)
+                    self.assertEqual(seen[-1], b'\x00\x01', 'bytes not encoded by a codec')
+                else:
+                    driver.close()
+                # end if
+            # end for
+        # end with
+    # end def
+
+    def test_state_schema(self):
+        from dataclasses import dataclass, field
+        from typing import Dict, List, Optional, Tuple
+        from telestate import StateSchema
+        from telestate.contrib.simple import SimpleDictDriver
+
+        class Pony(object):
+            __slots__ = ('name', 'wings')
+            name: str
+            wings: bool
+
+            def __init__(self, name, wings=False):
+                self.name = name
+                self.wings = wings
+            # end def
+        # end class
+
+        @dataclass
+        class Wizard:
+            step: int
+            ponies: List[Pony] = field(default_factory=list)
+            scores: Dict[str, float] = field(default_factory=dict)
+            position: Tuple[int, ...] = ()
+            note: Optional[str] = None
+        # end class
+
+        schema = StateSchema(Wizard)
+        wizard = Wizard(step=2, ponies=[Pony('Littlepip', wings=False)], scores={'a': 1}, position=(1, 2))
+        stored = schema.encode(wizard)
+        self.assertEqual(stored, {
+            'step': 2, 'ponies': [{'name': 'Littlepip', 'wings': False}], 'scores': {'a': 1}, 'position': [1, 2], 'note': None,
+        })
+        loaded = schema.decode(stored)
+        self.assertEqual((loaded.step, loaded.ponies[0].name, loaded.scores, loaded.position), (2, 'Littlepip', {'a': 1.0}, (1, 2)))
+        self.assertIsNone(schema.decode(None))
+        for malformed in ({'step': '2'}, {}, {'step': 1, 'unknown': 1}, {'step': True}, {'step': 1, 'ponies': [{}]}, [1]):
+            with self.assertRaises(ValueError, msg=repr(malformed)):
+                schema.decode(malformed)
+            # end with
+        # end for
+        with self.assertRaises(TypeError):
+            schema.encode({'step': 1})
+        # end with
+
+        driver = SimpleDictDriver()
+        machine = TeleStateMachine(__name__, driver, self.b)
+        machine.WIZARD = TeleState('WIZARD', schema=Wizard)
+        machine.deserialize = lambda state_name, data: self.fail('not used for states with a schema')
+        seen = []
+
+        @machine.WIZARD.on_update('message')
+        def next_step(update):
+            seen.append(machine.CURRENT.data.step)
+            machine.CURRENT.data.step += 1
+        # end def
+
+        driver.save_state_for_chat_user(1234, 4458, 'WIZARD', {'step': 1})
+        machine.process_update(update1)
+        self.assertEqual(seen, [1])
+        self.assertEqual(driver.load_state_for_chat_user(1234, 4458), ('WIZARD', {
+            'step': 2, 'ponies': [], 'scores': {}, 'position': [], 'note': None,
+        }))
+
+        driver.save_state_for_chat_user(1234, 4458, 'WIZARD', {'step': 'broken'})
+        machine.process_update(update1)
+        self.assertEqual(len(seen), 1, 'malformed data resets to DEFAULT')
+        self.assertEqual(driver.load_state_for_chat_user(1234, 4458), ('DEFAULT', None))
+    # end def
+
+    def test_state_schema_types(self):
+        import sys
+        from dataclasses import dataclass, field
+        from typing import List, Optional
+        from telestate import StateSchema
+
+        @dataclass
+        class Node:
+            name: str
+            parent: Optional['Node'] = None
+            children: List['Node'] = field(default_factory=list)
+        # end class
+
+        schema = StateSchema(Node)
+        tree = Node('root', children=[Node('leaf')])
+        stored = schema.encode(tree)
+        self.assertEqual(stored, {'name': 'root', 'parent': None, 'children': [{'name': 'leaf', 'parent': None, 'children': []}]})
+        self.assertEqual(schema.decode(stored).children[0].name, 'leaf')
+        for wrong in (Node(4458), Node('root', children=[Node(None)]), Node('root', children=None), Node('root', parent='x')):
+            with self.assertRaises(TypeError, msg=repr(wrong)):
+                schema.encode(wrong)
+            # end with
+        # end for
+
+        if sys.version_info >= (3, 10):
+            @dataclass
+            class Counter:
+                count: 'int | None' = None
+            # end class
+
+            schema = StateSchema(Counter)
+            self.assertEqual(schema.decode({'count': 3}).count, 3)
+            self.assertIsNone(schema.decode({'count': None}).count)
+            with self.assertRaises(ValueError):
+                schema.decode({'count': '3'})
+            # end with
+            with self.assertRaises(TypeError):
+                schema.encode(Counter(count='3'))
+            # end with
+        # end if
+    # end def
+
+    def test_process_update_version_conflict_retry(self):
+        from telestate.contrib.simple import SimpleDictDriver
+        from telestate.database_driver import StateVersionConflict
+        driver = SimpleDictDriver()
+        machine = TeleStateMachine(__name__, driver, self.b)
+        machine.BEST_PONY = TeleState('BEST_PONY')
+        driver.save_state_for_chat_user(1234, 4458, 'BEST_PONY', 0)
+        concurrent_saves = [1]
+
+        @machine.BEST_PONY.on_update('message')
+        def count(update):
+            if concurrent_saves[0]:
+                # another bot process did count as well, while we were processing.
+                concurrent_saves[0] -= 1
+                driver.save_state_for_chat_user(1234, 4458, 'BEST_PONY', 10)
+            # end if
+            machine.CURRENT.set_data(machine.CURRENT.data + 1)
+        # end def
+
+        machine.process_update(update1)
+        self.assertEqual(driver.load_state_for_chat_user(1234, 4458), ('BEST_PONY', 11), 'processed again with the new state')
+        self.assertEqual(machine.conflicts, 1)
+
+        machine.conflict_retries = 0
+        concurrent_saves[0] = 1
+        with self.assertRaises(StateVersionConflict):
+            machine.process_update(update1)
+        # end with
+        self.assertEqual(driver.load_state_for_chat_user(1234, 4458), ('BEST_PONY', 10))
+    # end def
+
+    def test_metrics_sink(self):
+        from telestate.metrics import HistogramMetricsSink
+        sink = HistogramMetricsSink()
+        self.m.metrics_sink = sink
+        self.m.skip_unchanged_saves = False
+        self.m.BEST_PONY = self.s
+        self.d.load_state_for_chat_user = lambda c, u: ('BEST_PONY', None)
+
+        @self.m.BEST_PONY.on_update('message')
+        def slow_listener(update):
+            time.sleep(0.01)
+        # end def
+
+        self.m.process_update(update1)
+        summary = sink.summary()
+        self.assertEqual(
+            set(summary), {'key', 'load', 'deserialize', 'state_handler', 'all_handler', 'serialize', 'save', 'total'}
+        )
+        self.assertGreaterEqual(summary['state_handler']['max'], 0.01)
+        self.assertLess(summary['all_handler']['max'], 0.01)
+        self.assertGreaterEqual(summary['total']['max'], summary['state_handler']['max'])
+    # end def
+
+    def test_update_logger_sampling(self):
+        from telestate.update_logger import UpdateLogger
+        redacted = []
+        self.m.update_logger = UpdateLogger(logging.getLogger('test.sampling'), sample_rate=2, redact=lambda n, d: redacted.append(n) or d)
+        self.m.update_logger.logger.setLevel(logging.WARNING)
+        self.m.skip_unhandled_updates = False
+        for _ in range(4):
+            self.m.process_update(update1)
+        # end for
+        self.assertEqual(redacted, [], 'silenced logger should not format anything')
+
+        self.m.update_logger.logger.setLevel(logging.DEBUG)
+        with self.assertLogs('test.sampling', level=logging.INFO) as logs:
+            for _ in range(4):
+                self.m.process_update(update1)
+            # end for
+        # end with
+        self.assertEqual(sum('Loading state' in line for line in logs.output), 2)
+        self.assertEqual(sum('Storing state' in line for line in logs.output), 2)
+    # end def
+
+    def test_update_logger_slow_only(self):
+        from telestate.update_logger import UpdateLogger
+        self.m.update_logger = UpdateLogger(logging.getLogger('test.slow'), sample_rate=0, slow_threshold=0.05)
+        self.m.update_logger.logger.setLevel(logging.DEBUG)
+        self.m.BEST_PONY = self.s
+        self.d.load_state_for_chat_user = lambda c, u: ('BEST_PONY', {'big': 'x' * 10000})
+        slow = [False]
+
+        @self.m.BEST_PONY.on_update('message')
+        def maybe_slow(update):
+            if slow[0]:
+                time.sleep(0.06)
+            # end if
+        # end def
+
+        with self.assertLogs('test.slow', level=logging.INFO) as logs:
+            self.m.process_update(update1)
+            self.m.update_logger.logger.info('marker')  # assertLogs needs at least one
+            slow[0] = True
+            self.m.process_update(update1)
+        # end with
+        self.assertEqual(logs.output[0], 'INFO:test.slow:marker', 'fast update should not be logged')
+        self.assertTrue(logs.output[1].startswith('INFO:test.slow:Update took 0.0'))
+        self.assertIn("Loading state 'BEST_PONY' for user 4458 in chat 1234.", logs.output[2])
+        self.assertLessEqual(len(logs.output[2]), 1200, 'data should be truncated')
+    # end def
+
+    def test_process_update_driver_session(self):
+        from contextlib import contextmanager
+        calls = []
+
+        @contextmanager
+        def session(chat_id, user_id):
+            calls.append(('enter', chat_id, user_id))
+            yield
+            calls.append(('exit', chat_id, user_id))
+        # end def
+
+        self.d.session = session
+        self.d.load_state_for_chat_user = lambda c, u: calls.append(('load', c, u)) or (None, None)
+        self.d.save_state_for_chat_user = lambda c, u, n, d: calls.append(('save', c, u))
+        self.m.skip_unchanged_saves = False
+        self.m.skip_unhandled_updates = False
+        self.m.process_update(update1)
+        self.assertEqual(calls, [
+            ('enter', 1234, 4458), ('load', 1234, 4458), ('save', 1234, 4458), ('exit', 1234, 4458),
+        ])
+    # end def
+
+    def test_skip_unhandled_updates(self):
+        from test_data import update2
+        calls = []
+        self.d.load_state_for_chat_user = lambda c, u: calls.append(('load', c, u)) or (None, None)
+        self.d.save_state_for_chat_user = lambda c, u, n, d: calls.append(('save', c, u))
+        self.m.skip_unchanged_saves = False
+        self.m.BEST_PONY = self.s
+        self.m.process_update(update1)
+        self.assertEqual(calls, [], 'no listeners at all')
+        self.assertEqual(self.m.updates_skipped, 1)
+
+        @self.m.BEST_PONY.on_update('inline_query')
+        def inline(update):
+            pass
+        # end def
+
+        @self.m.ALL.on_message('sticker')
+        def sticker(update, msg):
+            pass
+        # end def
+
+        @self.m.BEST_PONY.command('start')
+        def start(update, text):
+            pass
+        # end def
+
+        self.m.process_update(update1)  # `/cancel`, no inline query, no sticker.
+        self.assertEqual(calls, [])
+        self.assertFalse(self.m.update_filter.matches_dict(update1.to_array()))
+        self.assertTrue(self.m.update_filter.matches_dict({'update_id': 1, 'inline_query': {'id': '1'}}))
+        self.assertTrue(self.m.update_filter.matches_dict({'update_id': 1, 'message': {'sticker': {'file_id': '1'}}}))
+        self.m.process_update(update2)  # `/start@teleflaskBot test`, but we are @test4458bot.
+        self.assertEqual(calls, [])
+        raw_update = update1.to_array()
+        raw_update['message']['text'] = '/start test'
+        self.m.process_update(Update.from_array(raw_update))
+        self.assertEqual(calls, [('load', 1234, 4458), ('save', 1234, 4458)])
+        self.assertEqual(self.m.updates_skipped, 3)
+
+        self.m.skip_unhandled_updates = False
+        self.m.process_update(update1)
+        self.assertEqual(len(calls), 4)
+    # end def
+
+    def test_dispatch_table(self):
+        from teleflask.exceptions import AbortProcessingPlease
+        calls = []
+        self.m.BEST_PONY = self.s
+        self.d.load_state_for_chat_user = lambda c, u: ('BEST_PONY', None)
+
+        @self.m.BEST_PONY.command('start')
+        def start(update, text):
+            calls.append(('start', text))
+        # end def
+
+        @self.m.BEST_PONY.command('stop', exclusive=True)
+        def stop(update, text):
+            calls.append(('stop', text))
+        # end def
+
+        @self.m.BEST_PONY.on_message('text')
+        def text_message(update, msg):
+            calls.append(('text', msg.text))
+            if msg.text == 'abort':
+                raise AbortProcessingPlease()
+            # end if
+        # end def
+
+        @self.m.BEST_PONY.on_update('inline_query')
+        def inline(update):
+            calls.append(('inline',))
+        # end def
+
+        @self.m.BEST_PONY.on_update('message')
+        def message(update):
+            calls.append(('message',))
+        # end def
+
+        @self.m.ALL.command('start')
+        def all_start(update, text):
+            calls.append(('all_start', text))
+        # end def
+
+        table = self.m.BEST_PONY.update_handler.dispatch_table
+        self.assertIn('/start', table.commands)
+        self.assertEqual([f.__name__ for f, _ in table.update_listeners_by_kind['message']], ['message'])
+        self.assertEqual([f.__name__ for f, _ in table.update_listeners_by_kind['inline_query']], ['inline'])
+
+        for text in ('/start', ' /start  pinkie pie ', '/stop now', 'abort', 'hello'):
+            raw_update = update1.to_array()
+            raw_update['message']['text'] = text
+            self.m.process_update(Update.from_array(raw_update))
+        # end for
+        self.assertEqual(calls, [
+            ('start', None), ('text', '/start'), ('message',), ('all_start', None),
+            ('start', 'pinkie pie'), ('text', ' /start  pinkie pie '), ('message',), ('all_start', 'pinkie pie'),
+            ('stop', 'now'),
+            ('text', 'abort'),
+            ('text', 'hello'), ('message',),
+        ])
+
+        @self.m.BEST_PONY.command('help')
+        def help_command(update, text):
+            calls.append(('help', text))
+        # end def
+
+        self.assertIsNot(self.m.BEST_PONY.update_handler.dispatch_table, table, 'should be compiled again')
+        raw_update = update1.to_array()
+        raw_update['message']['text'] = '/help'
+        calls.clear()
+        self.m.process_update(Update.from_array(raw_update))
+        self.assertEqual(calls[0], ('help', None))
+    # end def
+
+    def test_process_raw_update(self):
+        from unittest import mock
+        from pytgbot.api_types.receivable.updates import Update
+        saved = []
+        self.d.save_state_for_chat_user = lambda c, u, n, d: saved.append((c, u, n, d))
+        self.m.BEST_PONY = self.s
+        with mock.patch.object(Update, 'from_array', wraps=Update.from_array) as from_array:
+            self.m.process_raw_update(update1.to_array())
+            self.assertEqual(from_array.call_count, 0, 'no listeners, so no Update should be built')
+            received = []
+
+            @self.m.DEFAULT.on_update('message')
+            def start(update):
+                received.append(update)
+                self.m.set('BEST_PONY', data={'text': update.message.text})
+            # end def
+
+            self.m.process_raw_update(update1.to_array())
+            self.assertEqual(from_array.call_count, 1)
+        # end with
+        self.assertIsInstance(received[0], Update)
+        self.assertEqual(saved[-1], (1234, 4458, 'BEST_PONY', {'text': '/cancel'}))
+    # end def
+
+    def test_slow_update_recorder(self):
+        import json
+        import tempfile
+        from telestate.slow_updates import SlowUpdateRecorder
+        recorder = SlowUpdateRecorder(threshold=0.05)
+        self.m.slow_update_recorder = recorder
+        self.m.BEST_PONY = self.s
+        self.d.load_state_for_chat_user = lambda c, u: ('BEST_PONY', None)
+        slow = [False]
+
+        @self.m.BEST_PONY.on_update('message')
+        def maybe_slow(update):
+            if slow[0]:
+                time.sleep(0.06)
+            # end if
+            self.m.set('DEFAULT')
+        # end def
+
+        self.m.process_update(update1)
+        self.assertEqual(recorder.records(), [], 'fast update should not be recorded')
+        slow[0] = True
+        recorder.profile_next(1)
+        self.m.process_update(update1)
+        records = recorder.records()
+        self.assertEqual(len(records), 1)
+        record = records[0]
+        self.assertEqual((record.chat_id, record.user_id), (1234, 4458))
+        self.assertEqual((record.loaded_state, record.state), ('BEST_PONY', 'DEFAULT'))
+        self.assertGreaterEqual(record.seconds, 0.06)
+        self.assertGreaterEqual(record.timings['state_handler'], 0.06)
+        self.assertIn('maybe_slow', record.profile)
+        with tempfile.TemporaryDirectory() as folder:
+            path = folder + '/slow.jsonl'
+            self.assertEqual(recorder.dump(path), 1)
+            with open(path) as f:
+                lines = f.readlines()
+            # end with
+        # end with
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])['loaded_state'], 'BEST_PONY')
+    # end def
+
+    def test_replay(self):
+        import json
+        import tempfile
+        from telestate.contrib.simple import SimpleDictDriver
+        from telestate.replay import read_updates, replay
+        self.m.database_driver = SimpleDictDriver()
+        self.m.BEST_PONY = self.s
+
+        @self.m.DEFAULT.on_update('message')
+        def start(update):
+            self.m.set('BEST_PONY')
+        # end def
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = folder + '/updates.jsonl'
+            with open(path, 'w') as f:
+                f.write(json.dumps(update1.to_array()) + '\n\n')
+            # end with
+            updates = read_updates(path, repeat=3)
+        # end with
+        self.assertEqual(len(updates), 3)
+        report = replay(self.m, updates, concurrency=2)
+        self.assertEqual(report['updates'], 3)
+        self.assertEqual(report['failed'], 0)
+        self.assertEqual(sum(bucket['count'] for bucket in report['latency_histogram']), 3)
+        self.assertEqual(report['phases']['total']['count'], 3)
+        self.assertEqual(report['transitions'], [
+            {'from': 'BEST_PONY', 'to': 'BEST_PONY', 'count': 2},
+            {'from': 'DEFAULT', 'to': 'BEST_PONY', 'count': 1},
+        ])
+        self.assertIsNone(self.m.executor)
+        json.dumps(report)
+    # end def
 # end class
 
 
 class AnotherTestCase(unittest.TestCase):
+    def test_offline_bot(self):
+        from telestate.replay import OfflineBot
+        bot = OfflineBot()
+        self.assertEqual(bot.get_me().username, 'offline4458bot')
+        message = bot.send_message(chat_id=1234, text='Hello')
+        self.assertEqual((message.chat.id, message.text), (1234, 'Hello'))
+        self.assertTrue(bot.send_chat_action(chat_id=1234, action='typing'))
+        self.assertEqual(bot.requests, {'getMe': 1, 'sendMessage': 1, 'sendChatAction': 1})
+    # end def
+
     def test_msg_get_chat_and_user_message(self):
         result = TeleStateMachine.update_get_chat_and_user(update1)
         self.assertEqual(result, (1234, 4458))
     # end def
 
+    def test_update_dict_get_chat_and_user(self):
+        from test_data import update2
+        for update in (update1, update2):
+            self.assertEqual(
+                TeleStateMachine.update_dict_get_chat_and_user(update.to_array()),
+                TeleStateMachine.update_get_chat_and_user(update),
+            )
+        # end for
+        user = {'id': 4458, 'is_bot': False, 'first_name': 'user'}
+        clicker = {'id': 10717954, 'is_bot': False, 'first_name': 'clicker'}
+        message = {'message_id': 1, 'date': 0, 'chat': {'id': -1234, 'type': 'group'}, 'from': user, 'text': 'hi'}
+        cases = [
+            ({'update_id': 1, 'edited_message': message}, (-1234, 4458)),
+            ({'update_id': 1, 'callback_query': {'id': '1', 'from': clicker, 'chat_instance': '1', 'message': message}}, (-1234, 10717954)),
+            ({'update_id': 1, 'inline_query': {'id': '1', 'from': user, 'query': '', 'offset': ''}}, (None, 4458)),
+            ({'update_id': 1, 'poll': {'id': '1'}}, (None, None)),
+        ]
+        for raw_update, expected in cases:
+            self.assertEqual(TeleStateMachine.update_dict_get_chat_and_user(raw_update), expected)
+        # end for
+    # end def
+
     def test_blueprintability(self):
         # test should just not raise any errors.
         states_tbp = TBlueprint(__name__)
@@ -562,6 +1417,154 @@ class AnotherTestCase(unittest.TestCase):
 # end class
 
 
+class UpdateLoggerTestCase(unittest.TestCase):
+    def test_format_data(self):
+        from telestate.update_logger import UpdateLogger
+        update_logger = UpdateLogger(max_length=50, redact=lambda state_name, data: {**data, 'token': '***'})
+        text = update_logger.format_data('FOO', {'token': 'secret', 'items': list(range(100000))})
+        self.assertNotIn('secret', text)
+        self.assertEqual(update_logger.format_data('FOO', {'token': 'secret'}), "{'token': '***'}")
+        self.assertEqual(len(text), 50)
+        self.assertTrue(text.endswith('...'))
+        self.assertEqual(UpdateLogger().format_data(None, None), 'None')
+    # end def
+# end class
+
+
+class HistogramMetricsSinkTestCase(unittest.TestCase):
+    def test_percentiles(self):
+        from telestate.metrics import HistogramMetricsSink
+        sink = HistogramMetricsSink()
+        self.assertIsNone(sink.percentile('load', 50))
+        for i in range(1, 101):
+            sink.record('load', i / 1000)  # 1 ms to 100 ms
+        # end for
+        self.assertEqual(sink.count('load'), 100)
+        self.assertAlmostEqual(sink.percentile('load', 50), 0.050, delta=0.005)
+        self.assertAlmostEqual(sink.percentile('load', 99), 0.099, delta=0.010)
+        self.assertEqual(sink.percentile('load', 100), 0.1)
+        summary = sink.summary()['load']
+        self.assertAlmostEqual(summary['mean'], 0.0505)
+        self.assertEqual(summary['max'], 0.1)
+        sink.record('save', 1000)  # bigger than the last bucket
+        self.assertEqual(sink.percentile('save', 99), 1000)
+        sink.reset()
+        self.assertEqual(sink.summary(), {})
+    # end def
+# end class
+
+
+class KeyedUpdateExecutorTestCase(unittest.TestCase):
+    def setUp(self):
+        from telestate import KeyedUpdateExecutor
+        self.executor = KeyedUpdateExecutor(max_workers=4)
+    # end def
+
+    def tearDown(self):
+        self.executor.shutdown(wait=True)
+    # end def
+
+    def test_same_key_in_order(self):
+        import threading
+        started = threading.Event()
+        gate = threading.Event()
+        calls = []
+
+        def work(i):
+            if i == 0:
+                started.set()
+                gate.wait(timeout=5)
+            # end if
+            calls.append(i)
+            return i
+        # end def
+
+        futures = [self.executor.submit((1, 2), work, i) for i in range(5)]
+        self.assertTrue(started.wait(timeout=5))
+        self.assertEqual(self.executor.in_flight_keys(), [(1, 2)])
+        self.assertEqual(self.executor.stats()['queue_depth'], 4, 'first one is running, blocking the other ones.')
+        self.assertIn((1, 2), self.executor.key_wait_times())
+        gate.set()
+        self.assertEqual([f.result(timeout=5) for f in futures], [0, 1, 2, 3, 4])
+        self.assertEqual(calls, [0, 1, 2, 3, 4])
+        stats = self.executor.stats()
+        self.assertEqual(stats['processed'], 5)
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(stats['in_flight_keys'], 0)
+    # end def
+
+    def test_different_keys_in_parallel(self):
+        import threading
+        barrier = threading.Barrier(2, timeout=5)
+        futures = [self.executor.submit(key, barrier.wait) for key in ((1, 1), (2, 2))]
+        for f in futures:
+            f.result(timeout=5)  # would raise BrokenBarrierError if not in parallel.
+        # end for
+    # end def
+
+    def test_exception_in_future(self):
+        def fail():
+            raise ValueError('nope')
+        # end def
+        future = self.executor.submit(None, fail)
+        with self.assertRaises(ValueError):
+            future.result(timeout=5)
+        # end with
+        self.assertEqual(self.executor.submit(None, int, '4458').result(timeout=5), 4458)
+    # end def
+
+    def test_submit_after_shutdown(self):
+        self.executor.shutdown()
+        with self.assertRaises(RuntimeError):
+            self.executor.submit((1, 2), int, '4458')
+        # end with
+        self.assertEqual(self.executor.in_flight_keys(), [])
+        self.assertEqual(self.executor.stats()['queue_depth'], 0)
+    # end def
+
+    def test_submit_pool_failure_rolls_back(self):
+        from unittest.mock import patch
+        with patch.object(self.executor._pool, 'submit', side_effect=RuntimeError('pool is gone')):
+            with self.assertRaises(RuntimeError):
+                self.executor.submit((1, 2), int, '4458')
+            # end with
+        # end with
+        self.assertEqual(self.executor.in_flight_keys(), [])
+        self.assertEqual(self.executor.stats()['queue_depth'], 0)
+        self.assertEqual(self.executor.submit((1, 2), int, '4458').result(timeout=5), 4458, 'key is usable again')
+    # end def
+
+    def test_machine_submit_update(self):
+        from unittest.mock import MagicMock
+        driver = SilentDriver()
+        driver.save_state_for_chat_user: MagicMock = MagicMock(return_value=None)
+        m = TeleStateMachine(__name__, driver, executor=self.executor)
+        m.submit_update(update1).result(timeout=5)
+        driver.save_state_for_chat_user.assert_called_with(1234, 4458, 'DEFAULT', None)
+        with self.assertRaises(ValueError):
+            TeleStateMachine(__name__, driver).submit_update(update1)
+        # end with
+    # end def
+
+    def test_machine_dispatch_update_logs_failure(self):
+        import threading
+        from unittest.mock import MagicMock, patch
+        driver = SilentDriver()
+        driver.load_state_for_chat_user: MagicMock = MagicMock(side_effect=ConnectionError('database is gone'))
+        m = TeleStateMachine(__name__, driver, executor=self.executor)
+        logged = threading.Event()
+        with patch('telestate.machine.logger') as machine_logger:
+            machine_logger.error.side_effect = lambda *args, **kwargs: logged.set()
+            m.dispatch_update(update1)
+            self.assertTrue(logged.wait(timeout=5), 'the error is logged, even as nobody waits for the future')
+        # end with
+        message = machine_logger.error.call_args[0][0]
+        exc_info = machine_logger.error.call_args[1]['exc_info']
+        self.assertIn(str(update1.update_id), message)
+        self.assertIsInstance(exc_info[1], ConnectionError)
+    # end def
+# end class
+
 
 if __name__ == '__main__':
     unittest.main()